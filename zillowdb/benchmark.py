@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End to end crawl benchmark: run the level crawlers against a
+:class:`~zillowdb.fixture_site.FixtureSite`, writing to a throwaway local
+``mongod``, and record per level:
+
+- pages: number of http requests, captcha pages included.
+- pages_per_sec: pages / wall clock seconds of the level.
+- p50_ms / p99_ms: http request latency.
+- parse_p50_ms / parse_p99_ms: html parsing time.
+- peak_rss_mb: peak resident memory of this process while crawling the level.
+- captcha, errors: captcha pages, and requests or stages that failed.
+
+Every run is appended as one json line to the results file, with the site
+parameters, number of workers and git revision, so runs are comparable::
+
+    >>> from zillowdb.benchmark import run_benchmark, print_results
+    >>> run_benchmark(n_worker=8, latency=0.05, captcha_rate=0.01,
+    ...               results_path="benchmark.jsonl", label="bulk insert")
+    >>> print_results("benchmark.jsonl")
+
+``mongod`` has to be in ``PATH``, or pass ``mongod_path``. The benchmark
+process connects :data:`zillowdb.mongodb.connection_manager` to the
+throwaway server, don't run it in a crawler process.
+
+**中文文档**
+
+端到端的爬虫性能测试。启动一个本地的虚拟 zillow 网站和一个临时的 mongod, 依次运行
+各个层级的爬虫, 记录每个层级的每秒页面数, 请求延迟的 p50/p99, 以及内存峰值。每次
+运行的结果以一行 json 追加到结果文件中, 便于比较优化前后的性能。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+
+try:
+    from time import perf_counter
+except ImportError:  # python2
+    from time import time as perf_counter
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from zillowdb.fixture_site import FixtureSite, DEFAULT_FANOUT
+
+#: levels in crawl order, ``house_detail`` is the detail page of addresses
+LEVELS = ["state", "county", "zipcode", "street", "address", "house_detail"]
+
+#: columns of :func:`print_results`
+RESULT_COLUMNS = [
+    "pages", "pages_per_sec", "p50_ms", "p99_ms", "parse_p50_ms",
+    "parse_p99_ms", "peak_rss_mb", "captcha", "errors",
+]
+
+
+class NullLogger(object):
+
+    """Logger of crawlers during benchmark, logging every page to a file
+    isn't what we measure.
+    """
+
+    def debug(self, msg, indent=0):
+        pass
+
+    info = warning = error = critical = debug
+
+
+#--- mongod ---
+def free_port(host="127.0.0.1"):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class MongodProcess(object):
+
+    """A throwaway ``mongod`` in a temp dir, removed when stopped.
+
+    :param mongod_path: executable of mongod.
+    :param port: None means any free port.
+    :param startup_timeout: seconds to wait for the server to accept
+      connection.
+    """
+
+    def __init__(self, mongod_path="mongod", port=None, host="127.0.0.1",
+                 startup_timeout=30):
+        self.mongod_path = mongod_path
+        self.host = host
+        self.port = port
+        self.startup_timeout = startup_timeout
+        self.dbpath = None
+        self.process = None
+
+    def start(self):
+        import pymongo
+
+        if self.port is None:
+            self.port = free_port(self.host)
+        self.dbpath = tempfile.mkdtemp(prefix="zillowdb-benchmark-")
+        args = [
+            self.mongod_path,
+            "--dbpath", self.dbpath,
+            "--port", str(self.port),
+            "--bind_ip", self.host,
+        ]
+        if os.name != "nt":
+            args.append("--nounixsocket")
+        with open(os.devnull, "wb") as devnull:
+            self.process = subprocess.Popen(
+                args, stdout=devnull, stderr=subprocess.STDOUT)
+
+        deadline = time.time() + self.startup_timeout
+        while True:
+            if self.process.poll() is not None:
+                self._cleanup()
+                raise RuntimeError(
+                    "mongod exited with code %s" % self.process.returncode)
+            try:
+                client = pymongo.MongoClient(
+                    self.host, self.port, serverSelectionTimeoutMS=500)
+                client.admin.command("ping")
+                client.close()
+                return self
+            except pymongo.errors.PyMongoError:
+                if time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError("mongod didn't start in %s seconds" %
+                                       self.startup_timeout)
+                time.sleep(0.2)
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except TypeError:  # python2, no timeout
+                    self.process.wait()
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+        self._cleanup()
+
+    def _cleanup(self):
+        if self.dbpath is not None:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
+            self.dbpath = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+#--- Peak memory ---
+class PeakRSS(object):
+
+    """Sample resident memory of this process in a daemon thread, keep the
+    peak. Without ``psutil``, it's the peak of the whole process life time
+    reported by ``getrusage``, not of the measured block.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        if psutil is not None:
+            return psutil.Process(os.getpid()).memory_info().rss
+        if resource is not None:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on linux, bytes on mac
+            return rss if sys.platform == "darwin" else rss * 1024
+        return 0
+
+    def _sample(self):
+        self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self._stop.clear()
+        self._sample()
+
+        def run():
+            while not self._stop.wait(self.interval):
+                self._sample()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+#--- Crawl ---
+def make_levels(base_url, stats=None):
+    """Levels of :mod:`zillowdb.crawler_mongo`, without state filter, urls
+    point to the fixture site.
+    """
+    from crawl_zillow import zilo_urlencoder as urlencoder
+    from zillowdb.mongodb import db
+    from zillowdb.model import State, County, Zipcode, Street, Address
+    from zillowdb.crawler_engine import Level
+
+    class FixtureLevel(Level):
+
+        def url_of(self, parent):
+            url = super(FixtureLevel, self).url_of(parent)
+            return url.replace(urlencoder.domain, base_url, 1)
+
+    levels = OrderedDict()
+    levels["state"] = FixtureLevel(child_model=State, stats=stats)
+    levels["county"] = FixtureLevel(
+        child_model=County,
+        parent_model=State,
+        propagate=[("state", "key")],
+        stats=stats,
+    )
+    levels["zipcode"] = FixtureLevel(
+        child_model=Zipcode,
+        parent_model=County,
+        propagate=[("state", "state"), ("county", "key")],
+        stats=stats,
+    )
+    levels["street"] = FixtureLevel(
+        child_model=Street,
+        parent_model=Zipcode,
+        propagate=[("state", "state"), ("county", "county"),
+                   ("zipcode", "key")],
+        stats=stats,
+    )
+    levels["address"] = FixtureLevel(
+        child_model=Address,
+        parent_model=Street,
+        propagate=[
+            ("state", "state"), ("county", "county"),
+            ("zipcode", "zipcode"), ("street", "key"),
+        ],
+        child_collection=lambda street: db[street["state"]],
+        stats=stats,
+    )
+    return levels
+
+
+def crawl_house_detail(base_url, n_worker=4, max_captcha_retry=3,
+                       stats=None):
+    """Crawl detail page of every address with a :class:`Spider`, the same
+    fetch, parse and write as
+    :func:`zillowdb.crawler_mongo.crawl_house_detail_from_zillow`, in
+    ``n_worker`` threads.
+
+    :param stats: optional :class:`~zillowdb.crawl_stats.CrawlStats`, status
+      changes are counted as the crawler does.
+    """
+    from crawl_zillow import zilo_urlencoder as urlencoder
+    from zillowdb.model import StatusCode
+    from zillowdb.mongodb import address_col_mapper
+    from zillowdb.crawl_stats import ZILLOW_DETAIL
+    from zillowdb.crawler_engine import CAPTCHA_MARK
+    from zillowdb.htmlparser import htmlparser
+    from zillowdb.packages.crawlib.spider import Spider, get_domain_name
+    from zillowdb.packages.sfm import pymongo_mate
+    from zillowdb.packages.sfm.metrics import metrics
+    from zillowdb.packages.sfm.pymongo_mate import WriteBehindBuffer
+
+    address_col_mapper.refresh()
+    url_to_doc = dict()
+    for col in address_col_mapper.values():
+        for doc in pymongo_mate.iter_docs(
+                col, {}, {"_id": True, "state": True}):
+            url = urlencoder.url_join(doc["_id"])
+            url = url.replace(urlencoder.domain, base_url, 1)
+            url_to_doc[url] = (col, doc["_id"], doc.get("state"))
+
+    spider = Spider(pool_maxsize=n_worker)
+    buffer = WriteBehindBuffer(max_size=500, max_age=5.0)
+    n_retry = dict()
+    with spider, buffer:
+        urls = list(url_to_doc)
+        while urls:
+            retry_urls = list()
+            for url, html, error in spider.get_html_many(
+                    urls, concurrency=n_worker):
+                labels = {"level": ZILLOW_DETAIL,
+                          "domain": get_domain_name(url)}
+                metrics.counter("pages", **labels).inc()
+                col, _id, state = url_to_doc[url]
+                set_doc = dict()
+                if error is not None:
+                    status = StatusCode.failed_to_crawl
+                elif CAPTCHA_MARK in html:
+                    metrics.counter("captcha", **labels).inc()
+                    n_retry[url] = n_retry.get(url, 0) + 1
+                    if n_retry[url] <= max_captcha_retry:
+                        retry_urls.append(url)
+                        continue
+                    status = StatusCode.failed_to_crawl
+                else:
+                    try:
+                        data = htmlparser.get_house_detail(html)
+                        if data is None:
+                            status = StatusCode.crawled_but_has_error
+                        else:
+                            set_doc["zillow_detail"] = data
+                            status = StatusCode.finished
+                    except Exception:
+                        status = StatusCode.crawled_but_has_error
+                set_doc["status_zillow"] = status
+                buffer.update_one(col, {"_id": _id}, {"$set": set_doc})
+                if stats is not None:
+                    stats.on_status(ZILLOW_DETAIL, state, StatusCode.todo,
+                                    status, buffer=buffer)
+            urls = retry_urls
+
+
+def _percentile_ms(histograms, p):
+    """Percentile in milliseconds of merged histograms.
+    """
+    from zillowdb.packages.sfm.metrics import Histogram
+
+    merged = Histogram()
+    for histogram in histograms:
+        merged.merge(histogram)
+    value = merged.percentile(p)
+    if value is None:
+        return None
+    return round(value * 1000, 3)
+
+
+def summarize_level(registry, seconds, peak_rss):
+    """Build the result row of a level from metrics collected while it's
+    crawled.
+    """
+    http = registry.select("http_seconds")
+    parse = registry.select("parse_seconds")
+    pages = sum([histogram.count for histogram in http])
+    errors = sum([counter.value for counter in
+                  registry.select("http_errors") +
+                  registry.select("stage_errors")])
+    return OrderedDict([
+        ("pages", pages),
+        ("seconds", round(seconds, 3)),
+        ("pages_per_sec", round(pages / seconds, 2) if seconds else None),
+        ("p50_ms", _percentile_ms(http, 50)),
+        ("p99_ms", _percentile_ms(http, 99)),
+        ("parse_p50_ms", _percentile_ms(parse, 50)),
+        ("parse_p99_ms", _percentile_ms(parse, 99)),
+        ("peak_rss_mb", round(peak_rss / 1024.0 ** 2, 1)),
+        ("captcha", sum([counter.value
+                         for counter in registry.select("captcha")])),
+        ("errors", errors),
+    ])
+
+
+def git_revision():
+    try:
+        with open(os.devnull, "wb") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull,
+            ).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(n_worker=4, levels=None, fanout=DEFAULT_FANOUT,
+                  latency=0.0, jitter=0.0, captcha_rate=0.0, padding=0,
+                  seed=0, mongod=None, mongod_path="mongod",
+                  results_path=None, label=None):
+    """Run the benchmark, return the result dict, and append it to
+    ``results_path`` as a json line if given.
+
+    :param levels: names of levels to crawl, default is all
+      :data:`LEVELS`. A level needs all levels before it crawled in the same
+      run.
+    :param mongod: an object with ``host`` and ``port`` attributes, the
+      database server to use, its database is dropped first. Default is a
+      new :class:`MongodProcess`.
+    :param label: a short note of what's being measured.
+
+    Other arguments are passed to :class:`~zillowdb.fixture_site.FixtureSite`.
+    """
+    from zillowdb.mongodb import connection_manager, address_col_mapper, db
+    from zillowdb.crawl_stats import CrawlStats
+    from zillowdb.crawler_engine import LevelCrawler
+    from zillowdb.indexes import ensure_indexes
+    from zillowdb.packages.crawlib.spider import Spider
+    from zillowdb.packages.sfm.metrics import metrics
+
+    if levels is None:
+        levels = LEVELS
+    site = FixtureSite(fanout=fanout, latency=latency, jitter=jitter,
+                       captcha_rate=captcha_rate, padding=padding, seed=seed)
+    own_mongod = mongod is None
+    if own_mongod:
+        mongod = MongodProcess(mongod_path=mongod_path)
+
+    result = OrderedDict([
+        ("label", label),
+        ("time", time.strftime("%Y-%m-%d %H:%M:%S")),
+        ("git_revision", git_revision()),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("n_worker", n_worker),
+        ("site", site.config()),
+        ("levels", OrderedDict()),
+    ])
+
+    if own_mongod:
+        mongod.start()
+    try:
+        with site:
+            connection_manager.reconnect(mongod.host, mongod.port)
+            connection_manager.client.drop_database(connection_manager.db_name)
+            address_col_mapper.refresh()
+            ensure_indexes()
+
+            stats = CrawlStats(db.__getattr__("crawl_stats"))
+            level_table = make_levels(site.base_url, stats=stats)
+            for name in levels:
+                metrics.reset()
+                with PeakRSS() as peak_rss:
+                    st = perf_counter()
+                    if name == "house_detail":
+                        crawl_house_detail(site.base_url, n_worker=n_worker,
+                                           stats=stats)
+                    else:
+                        LevelCrawler(
+                            level_table[name],
+                            spider_factory=Spider,
+                            n_worker=n_worker,
+                            logger=NullLogger(),
+                            wait_for_ready=False,
+                            captcha_handler=None,
+                            max_captcha_retry=3,
+                            lease_seconds=600,
+                        ).run()
+                    seconds = perf_counter() - st
+                if name == "state":
+                    # address collections are named by state
+                    address_col_mapper.refresh()
+                    ensure_indexes()
+                result["levels"][name] = summarize_level(
+                    metrics, seconds, peak_rss.peak)
+    finally:
+        if own_mongod:
+            mongod.stop()
+
+    if results_path is not None:
+        with open(results_path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    return result
+
+
+def load_results(path):
+    results = list()
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                results.append(json.loads(line, object_pairs_hook=OrderedDict))
+    return results
+
+
+def print_results(path, last=5):
+    """Print the ``last`` runs in the results file side by side, per level.
+    """
+    import prettytable
+
+    results = load_results(path)[-last:]
+    for level in LEVELS:
+        rows = [(result, result["levels"][level])
+                for result in results if level in result["levels"]]
+        if not rows:
+            continue
+        t = prettytable.PrettyTable()
+        t.field_names = ["run", "revision", "label", "workers"] + \
+            RESULT_COLUMNS
+        for result, row in rows:
+            t.add_row([result["time"], result["git_revision"],
+                       result["label"], result["n_worker"]] +
+                      [row.get(column) for column in RESULT_COLUMNS])
+        print("Level: %s" % level)
+        print(t)
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    from zillowdb.packages.sfm.metrics import Registry, Histogram
+
+    def test_percentile_ms():
+        fast, slow = Histogram(), Histogram()
+        for ms in range(1, 51):
+            fast.record(ms / 1000.0)
+        for ms in range(51, 101):
+            slow.record(ms / 1000.0)
+        # merged, 1 ~ 100 ms, bucket error is a few percent
+        assert abs(_percentile_ms([fast, slow], 50) - 50) < 3
+        assert abs(_percentile_ms([fast, slow], 99) - 99) < 5
+        assert _percentile_ms([fast, slow], 100) == 100.0
+        assert _percentile_ms([], 50) is None
+
+    test_percentile_ms()
+
+    def test_summarize_level():
+        registry = Registry()
+        for ms in range(1, 101):
+            registry.histogram("http_seconds", domain="a").record(ms / 1000.0)
+        registry.histogram("parse_seconds", page="list").record(0.002)
+        registry.counter("http_errors", domain="a").inc(2)
+        registry.counter("stage_errors", stage="parse", level="state").inc()
+        registry.counter("captcha", level="state", domain="a").inc(3)
+
+        row = summarize_level(registry, 4.0, 100 * 1024 ** 2)
+        assert list(row) == ["pages", "seconds"] + \
+            [column for column in RESULT_COLUMNS if column != "pages"]
+        assert row["pages"] == 100
+        assert row["pages_per_sec"] == 25.0
+        assert row["parse_p50_ms"] == 2.0
+        assert row["peak_rss_mb"] == 100.0
+        assert row["captcha"] == 3
+        assert row["errors"] == 3
+
+        row = summarize_level(Registry(), 0.0, 0)
+        assert row["pages"] == 0 and row["pages_per_sec"] is None
+        assert row["p50_ms"] is None
+
+    test_summarize_level()
+
+#     run_benchmark(
+#         n_worker=8, latency=0.05, jitter=0.05, captcha_rate=0.01,
+#         padding=100 * 1024, results_path="benchmark.jsonl",
+#     )
+#     print_results("benchmark.jsonl")
@@ -7,10 +7,23 @@ MSSQLDB_SERVER = "QA-MSSQL-EDW1.qa.awscorp.com"
 MSSQLDB_DATABASE = "wbh"
 MSSQLDB_USERNAME = "wbh"
 MSSQLDB_PASSWORD = "wbh"
+MSSQLDB_POOL_SIZE = 5
+MSSQLDB_MAX_OVERFLOW = 10
+
+MONGODB_HOST = "localhost"
+MONGODB_PORT = 27017
+MONGODB_MAX_POOL_SIZE = 100
+MONGODB_MIN_POOL_SIZE = 0
 
 PROJECT_DIR = Path(r"C:\Users\shu\Documents\PythonWorkSpace\py3\py33_projects\zillowdb-project").abspath
 LOG_DIR_PATH = Path(PROJECT_DIR, "log").abspath
 CHROMEDRIVER_PATH = Path(PROJECT_DIR, "chromedriver.exe").abspath
+HTML_CACHE_DIR = Path(PROJECT_DIR, "html_cache").abspath
+HTML_CACHE_MAX_SIZE = 20 * 1024 ** 3 # 20GB
+HTML_CACHE_TTL = 30 * 24 * 3600 # seconds, pages change, crawl them again
+API_CACHE_PATH = Path(PROJECT_DIR, "api_cache.sqlite3").abspath
+METRICS_PATH = Path(PROJECT_DIR, "crawler.prom").abspath # prometheus textfile
+METRICS_INTERVAL = 30 # seconds
 
 ZWSID = [
 	"X1-ZWz1dyb91hllhn_6msnx",
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crawl progress counters, readable without scanning any collection.
+
+The ``crawl_stats`` collection has one document per level per state::
+
+    {
+        "_id": "street:md",
+        "level": "street",
+        "state": "md",
+        "count": {"0": 1200, "1": 3, "2": 10, "3": 48000},  # by StatusCode
+    }
+
+Counters are updated with ``$inc`` along with the status writes of the
+crawlers: inserted children are counted as todo, and a status change moves
+one from the old status to the new one. Increments are merged and written in
+the same bulk write as the status updates, when a
+:class:`~zillowdb.packages.sfm.pymongo_mate.WriteBehindBuffer` is used.
+
+Counters can drift, e.g. a lease is lost after its status change is counted,
+:meth:`CrawlStats.reconcile` recounts everything with aggregation, run it
+periodically with :meth:`CrawlStats.start_reconcile`. Counters start from
+an empty collection, documents crawled before are only counted after a
+reconciliation, :meth:`CrawlStats.ensure_reconciled` does it once, and
+:meth:`CrawlStats.reconciling` does both around a crawl.
+
+**中文文档**
+
+爬虫进度计数器。每个层级每个州一个文档, 按状态计数。在写入状态时用 ``$inc``
+同步更新计数, 读取进度不需要扫描任何表。计数可能有少量偏差, 定期用聚合重新统计
+进行校正。
+"""
+
+import sys
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from zillowdb.model import StatusCode
+from zillowdb.packages.sfm.exception_mate import get_last_exc_info
+
+#: level name of house detail crawled from zillow, it counts
+#: ``status_zillow`` of address
+ZILLOW_DETAIL = "zillow_detail"
+
+STATUS_LIST = [
+    StatusCode.todo,
+    StatusCode.failed_to_crawl,
+    StatusCode.crawled_but_has_error,
+    StatusCode.finished,
+]
+
+
+def state_of(doc):
+    """State of a projected document, a state document is its own state.
+    """
+    state = doc.get("state")
+    if state is None:
+        state = doc.get("key")
+    return state
+
+
+class CrawlStats(object):
+
+    """
+    :param col: the ``crawl_stats`` collection.
+    """
+
+    def __init__(self, col):
+        self.col = col
+        self._reconcile_thread = None
+        self._reconcile_stop = threading.Event()
+
+    @staticmethod
+    def id_of(level, state):
+        return "%s:%s" % (level, state)
+
+    def _inc(self, level, state, inc_doc, buffer=None):
+        _id = self.id_of(level, state)
+        if buffer is not None:
+            buffer.inc(self.col, _id, inc_doc)
+        else:
+            self.col.update_one({"_id": _id}, {"$inc": inc_doc}, upsert=True)
+
+    def on_insert(self, level, state, n, status=StatusCode.todo, buffer=None):
+        """Count ``n`` new documents of a level. A new address is a todo
+        of :data:`ZILLOW_DETAIL` as well.
+        """
+        if n:
+            self._inc(level, state, {"count.%s" % status: n}, buffer)
+            if level == "address":
+                self._inc(ZILLOW_DETAIL, state,
+                          {"count.%s" % StatusCode.todo: n}, buffer)
+
+    def on_status(self, level, state, old_status, new_status, n=1,
+                  buffer=None):
+        """Count ``n`` documents changed from ``old_status`` to
+        ``new_status``. ``old_status`` is None if not known, then only the
+        new status is counted, reconciliation fixes the old one.
+        """
+        if old_status == new_status:
+            return
+        inc_doc = {"count.%s" % new_status: n}
+        if old_status is not None:
+            inc_doc["count.%s" % old_status] = -n
+        self._inc(level, state, inc_doc, buffer)
+
+    #--- Read ---
+    def progress(self, level=None, state=None):
+        """Return ``{(level, state): {status: count}}``.
+        """
+        filters = dict()
+        if level is not None:
+            filters["_id"] = {"$regex": "^%s:" % level}
+        result = dict()
+        for doc in self.col.find(filters):
+            level_, state_ = doc["_id"].split(":", 1)
+            if state is not None and state_ != state:
+                continue
+            result[(level_, state_)] = {
+                int(status): n for status, n in doc.get("count", dict()).items()
+            }
+        return result
+
+    def count(self, level, state=None, status=None):
+        """Total count of a level, of a state (all states if None), of a
+        status (all status if None).
+        """
+        total = 0
+        for counter in self.progress(level, state).values():
+            for status_, n in counter.items():
+                if status is None or status_ == status:
+                    total += n
+        return total
+
+    def count_todo(self, level, state=None):
+        """Number of documents not finished.
+        """
+        return self.count(level, state) - \
+            self.count(level, state, StatusCode.finished)
+
+    #--- Reconcile ---
+    def _count_collection(self, col, status_field="status",
+                          state_field="state"):
+        """Return ``{state: {status: n}}`` of a collection by aggregation.
+        """
+        pipeline = [{"$group": {
+            "_id": {"state": "$" + state_field, "status": "$" + status_field},
+            "n": {"$sum": 1},
+        }}]
+        result = dict()
+        for doc in col.aggregate(pipeline, allowDiskUse=True):
+            state, status = doc["_id"].get("state"), doc["_id"].get("status")
+            if state is None:
+                continue
+            if status is None:
+                status = StatusCode.todo
+            counter = result.setdefault(state, dict())
+            counter[status] = counter.get(status, 0) + doc["n"]
+        return result
+
+    def _replace(self, level, state, counter):
+        self.col.replace_one(
+            {"_id": self.id_of(level, state)},
+            {
+                "level": level,
+                "state": state,
+                "count": {str(status): n for status, n in counter.items()},
+                "reconciled_at": datetime.utcnow(),
+            },
+            upsert=True,
+        )
+
+    def reconcile(self, level_cols=None, address_cols=None):
+        """Recount all counters from source collections.
+
+        Increments happening while a collection is being counted may be lost
+        or counted twice, run it when the crawler is idle, or run it again.
+
+        :param level_cols: ``{level: collection}``, default are state,
+          county, zipcode and street collections.
+        :param address_cols: ``{state: address collection}``, default is
+          :data:`~zillowdb.mongodb.address_col_mapper`.
+        """
+        from zillowdb.model import State, County, Zipcode, Street
+
+        if level_cols is None:
+            level_cols = {
+                document_class.__name__.lower(): document_class._get_collection()
+                for document_class in [State, County, Zipcode, Street]
+            }
+        if address_cols is None:
+            from zillowdb.mongodb import address_col_mapper
+            address_cols = address_col_mapper
+
+        for level, col in level_cols.items():
+            state_field = "key" if level == "state" else "state"
+            for state, counter in self._count_collection(
+                    col, state_field=state_field).items():
+                self._replace(level, state, counter)
+
+        for state, col in address_cols.items():
+            for count_level, status_field in [
+                    ("address", "status"), (ZILLOW_DETAIL, "status_zillow")]:
+                counter = dict()
+                for counter_ in self._count_collection(
+                        col, status_field=status_field).values():
+                    for status, n in counter_.items():
+                        counter[status] = counter.get(status, 0) + n
+                if counter:
+                    self._replace(count_level, state, counter)
+
+    def ensure_reconciled(self, **kwargs):
+        """Reconcile now if there is no counter at all, e.g. the first run
+        on an existing database, otherwise progress of documents crawled
+        before would be 0.
+
+        :returns: True if reconciled.
+        """
+        if self.col.find_one() is not None:
+            return False
+        self.reconcile(**kwargs)
+        return True
+
+    def start_reconcile(self, interval=3600, **kwargs):
+        """Reconcile every ``interval`` seconds in a daemon thread.
+        """
+        if self._reconcile_thread is not None and \
+                self._reconcile_thread.is_alive():
+            return
+        self._reconcile_stop.clear()
+
+        def run():
+            while not self._reconcile_stop.wait(interval):
+                try:
+                    self.reconcile(**kwargs)
+                except Exception:
+                    sys.stderr.write("\n%s" % get_last_exc_info())
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._reconcile_thread = thread
+
+    def stop_reconcile(self):
+        self._reconcile_stop.set()
+        if self._reconcile_thread is not None:
+            self._reconcile_thread.join()
+            self._reconcile_thread = None
+
+    @contextmanager
+    def reconciling(self, interval=3600, **kwargs):
+        """Reconcile if there is no counter yet, and every ``interval``
+        seconds until exit::
+
+            >>> with crawl_stats.reconciling():
+            ...     crawler.run()
+        """
+        self.ensure_reconciled(**kwargs)
+        self.start_reconcile(interval=interval, **kwargs)
+        try:
+            yield self
+        finally:
+            self.stop_reconcile()
+
+
+_crawl_stats = None
+_crawl_stats_lock = threading.Lock()
+
+
+def get_crawl_stats():
+    """The :class:`CrawlStats` of ``crawl_stats`` collection, created on
+    first call, shared by all callers.
+    """
+    global _crawl_stats
+    if _crawl_stats is None:
+        with _crawl_stats_lock:
+            if _crawl_stats is None:
+                from zillowdb.mongodb import db
+                _crawl_stats = CrawlStats(db.__getattr__("crawl_stats"))
+    return _crawl_stats
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import pymongo
+    from zillowdb.packages.sfm.pymongo_mate import WriteBehindBuffer
+
+    client = pymongo.MongoClient()
+    test_db = client.get_database("test")
+    col = test_db.get_collection("crawl_stats")
+
+    def new_stats():
+        col.delete_many({})
+        return CrawlStats(col)
+
+    def test_on_insert():
+        stats = new_stats()
+        stats.on_insert("county", "md", 5)
+        stats.on_insert("county", "md", 2)
+        stats.on_insert("county", "va", 0)
+        assert stats.progress() == {("county", "md"): {StatusCode.todo: 7}}
+
+        # a new address is a todo of zillow detail as well
+        stats.on_insert("address", "md", 3)
+        assert stats.progress("address") == \
+            {("address", "md"): {StatusCode.todo: 3}}
+        assert stats.progress(ZILLOW_DETAIL) == \
+            {(ZILLOW_DETAIL, "md"): {StatusCode.todo: 3}}
+
+    test_on_insert()
+
+    def test_on_status():
+        stats = new_stats()
+        stats.on_insert("street", "md", 3)
+        stats.on_status("street", "md", StatusCode.todo, StatusCode.finished)
+        stats.on_status("street", "md", StatusCode.finished,
+                        StatusCode.finished)
+        assert stats.progress("street", "md")[("street", "md")] == \
+            {StatusCode.todo: 2, StatusCode.finished: 1}
+
+        # old status unknown, only the new one is counted
+        stats.on_status("street", "md", None, StatusCode.failed_to_crawl)
+        assert stats.progress("street", "md")[("street", "md")] == {
+            StatusCode.todo: 2, StatusCode.finished: 1,
+            StatusCode.failed_to_crawl: 1,
+        }
+
+        # buffered increments are merged into one upsert
+        with WriteBehindBuffer(max_size=100, max_age=60) as buffer:
+            for _ in range(2):
+                stats.on_status("street", "md", StatusCode.todo,
+                                StatusCode.finished, buffer=buffer)
+            assert buffer.stats()["n_write"] == 0
+        assert buffer.n_write == 1
+        assert stats.progress("street", "md")[("street", "md")] == {
+            StatusCode.todo: 0, StatusCode.finished: 3,
+            StatusCode.failed_to_crawl: 1,
+        }
+
+    test_on_status()
+
+    def test_progress_and_count_todo():
+        stats = new_stats()
+        stats.on_insert("state", "md", 1)
+        stats.on_insert("county", "md", 4)
+        stats.on_insert("county", "va", 2)
+        stats.on_status("county", "md", StatusCode.todo, StatusCode.finished,
+                        n=3)
+
+        assert set(stats.progress()) == \
+            set([("state", "md"), ("county", "md"), ("county", "va")])
+        assert set(stats.progress(state="va")) == set([("county", "va")])
+        assert stats.count("county") == 6
+        assert stats.count("county", "md", StatusCode.finished) == 3
+        assert stats.count_todo("county") == 3
+        assert stats.count_todo("county", "md") == 1
+        assert stats.count_todo("street") == 0
+
+    test_progress_and_count_todo()
+
+    def test_reconcile():
+        stats = new_stats()
+        county_col = test_db.get_collection("crawl_stats_county")
+        address_col = test_db.get_collection("crawl_stats_md")
+        county_col.delete_many({})
+        address_col.delete_many({})
+        county_col.insert_many([
+            {"_id": 1, "state": "md", "status": StatusCode.finished},
+            {"_id": 2, "state": "md"},
+        ])
+        address_col.insert_many([
+            {"_id": 1, "state": "md", "status": StatusCode.todo,
+             "status_zillow": StatusCode.finished},
+        ])
+        stats.on_insert("county", "md", 10)  # drifted
+
+        assert stats.ensure_reconciled(
+            level_cols={"county": county_col},
+            address_cols={"md": address_col}) is False
+        stats.reconcile(level_cols={"county": county_col},
+                        address_cols={"md": address_col})
+        assert stats.progress("county")[("county", "md")] == \
+            {StatusCode.todo: 1, StatusCode.finished: 1}
+        assert stats.count_todo(ZILLOW_DETAIL, "md") == 0
+        assert stats.count_todo("address", "md") == 1
+
+        county_col.drop()
+        address_col.drop()
+        col.drop()
+
+    test_reconcile()
+
+#     get_crawl_stats().reconcile()
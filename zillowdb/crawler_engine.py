@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Level-agnostic crawl engine.
+
+Every level of the hierarchy ``State -> County -> Zipcode -> Street -> Address``
+is crawled the same way: take a todo parent, fetch its list page, parse
+``(link, name)`` items, store them as children (copy some fields from the
+parent), then mark the parent. :class:`Level` describes the difference between
+levels, :class:`LevelCrawler` runs N concurrent fetch/parse/store workers.
+
+**中文文档**
+
+所有层级的爬虫逻辑都是一样的: 取出一个未完成的父节点, 抓取列表页, 解析出子节点,
+将父节点的部分字段复制给子节点, 存入数据库, 最后更新父节点的状态。:class:`Level`
+用于描述各层级之间的区别, :class:`LevelCrawler` 则用多个线程并发地执行抓取,
+解析, 储存。
+"""
+
+try:
+    input = raw_input
+except:
+    pass
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import threading
+
+try:
+    from urlparse import urlparse
+except:
+    from urllib.parse import urlparse
+
+from crawl_zillow import zilo_urlencoder as urlencoder
+from zillowdb.htmlparser import htmlparser
+
+from zillowdb import config
+from zillowdb.model import StatusCode
+from zillowdb.crawl_stats import state_of
+from zillowdb.logger import create_zillow_crawler_logger
+from zillowdb.work_queue import LeaseQueue
+from zillowdb.packages.selenium_spider import ChromeSpider
+from zillowdb.packages.crawlib import exc
+from zillowdb.packages.sfm import pymongo_mate
+from zillowdb.packages.sfm.pymongo_mate import WriteBehindBuffer
+from zillowdb.packages.sfm.metrics import metrics
+
+CAPTCHA_MARK = "http://www.google.com/recaptcha/api.js"
+
+_STOP = object()
+
+
+def create_webdriver():
+    driver = ChromeSpider(executable_path=config.CHROMEDRIVER_PATH)
+    return driver
+
+
+class Level(object):
+
+    """Describe how to crawl one level.
+
+    :param child_model: the document class of items found on the list page.
+    :param parent_model: the document class whose list page is crawled,
+      ``None`` means the root list page (all states).
+    :param propagate: list of ``(child_field, parent_field)`` pairs, value of
+      ``parent.parent_field`` is copied to ``child.child_field``.
+    :param filters: extra pymongo query to select todo parents, will be merged
+      with ``{"status": {"$ne": StatusCode.finished}}``.
+    :param child_collection: optional callable, ``parent -> pymongo Collection``,
+      parent is a projected dict. If given, children are inserted as dict
+      into that collection with ``pymongo_mate.bulk_insert``, otherwise
+      ``child_model.bulk_insert_raw`` is used.
+    :param stats: optional :class:`~zillowdb.crawl_stats.CrawlStats`, if
+      given, inserted children and status changes of parents are counted.
+      It can also be a callable returning one, called on first use, e.g.
+      :func:`~zillowdb.crawl_stats.get_crawl_stats`.
+
+    **中文文档**
+
+    描述一个层级的爬虫配置: 父节点, 子节点的类, 以及哪些字段需要从父节点复制到
+    子节点。
+    """
+
+    def __init__(self,
+                 child_model,
+                 parent_model=None,
+                 propagate=None,
+                 filters=None,
+                 child_collection=None,
+                 stats=None):
+        self.child_model = child_model
+        self.parent_model = parent_model
+        if propagate is None:
+            propagate = list()
+        self.propagate = list(propagate)
+        if filters is None:
+            filters = dict()
+        self.filters = filters
+        self.child_collection = child_collection
+        self._stats = stats
+
+    @property
+    def stats(self):
+        if callable(self._stats):
+            self._stats = self._stats()
+        return self._stats
+
+    @property
+    def name(self):
+        return self.child_model.__name__.lower()
+
+    @property
+    def parent_name(self):
+        if self.parent_model is None:
+            return None
+        return self.parent_model.__name__.lower()
+
+    def todo_filters(self):
+        filters = {"status": {"$ne": StatusCode.finished}}
+        filters.update(self.filters)
+        return filters
+
+    def parent_fields(self):
+        """Fields of parent needed to crawl: ``_id``, status, and fields
+        copied to children.
+        """
+        fields = ["_id", "status"]
+        for _, parent_field in self.propagate:
+            if parent_field not in fields:
+                fields.append(parent_field)
+        return fields
+
+    def parent_collection(self):
+        return self.parent_model._get_collection()
+
+    def iter_todo(self, batch_size=1000):
+        """Stream parents that need to crawl, as projected dict. Memory usage
+        is flat no matter how big the level is.
+        """
+        if self.parent_model is None:
+            return iter([None, ])
+        return self.parent_model.iter_by_filter(
+            self.todo_filters(),
+            fields=self.parent_fields(),
+            batch_size=batch_size,
+            raw=True,
+        )
+
+    def count_todo(self):
+        """Number of parents left. Read from crawl stats if filters is by
+        state only, otherwise counted on server side.
+        """
+        if self.parent_model is None:
+            return 1
+        if self.stats is not None and set(self.filters) <= set(["state"]):
+            return self.stats.count_todo(
+                self.parent_name, self.filters.get("state"))
+        return self.parent_model.count_by_filter(self.todo_filters())
+
+    def todo_queue(self, **kwargs):
+        """Lease queue over todo parents, see
+        :class:`~zillowdb.work_queue.LeaseQueue` for kwargs.
+        """
+        return LeaseQueue(
+            self.parent_collection(), self.todo_filters(), **kwargs)
+
+    def iter_claim(self, lease_queue, batch_size=100):
+        """Iterate parents claimed from a lease queue, as projected dict.
+        """
+        projection = {field: True for field in self.parent_fields()}
+        return lease_queue.iter_claim(batch_size, projection=projection)
+
+    def url_of(self, parent):
+        if parent is None:
+            return urlencoder.browse_home_listpage_url()
+        return urlencoder.browse_home_listpage_url_by_href(parent["_id"])
+
+    def make_child(self, parent, link, name):
+        """Create a child document from a ``(link, name)`` item, as a raw
+        dict, constructing a mongoengine object for every child is expensive.
+        """
+        child = {
+            "_id": link,
+            "key": self.child_model.key_of(link),
+            "name": name,
+            "status": StatusCode.todo,
+        }
+        for child_field, parent_field in self.propagate:
+            child[child_field] = parent[parent_field]
+        return child
+
+    def store_children(self, parent, children, upsert_fields=None,
+                       buffer=None):
+        """Insert children made by :meth:`Level.make_child`, existing ones
+        are skipped, or ``upsert_fields`` of them are updated.
+
+        :param buffer: if given, increments of crawl stats are buffered.
+        """
+        if self.child_collection is None:
+            report = self.child_model.bulk_insert_raw(
+                children, upsert_fields=upsert_fields)
+        else:
+            col = self.child_collection(parent)
+            report = pymongo_mate.bulk_insert(
+                col, self.child_model.validate_raw(children),
+                upsert_fields=upsert_fields)
+
+        if self.stats is not None and report["inserted"]:
+            if parent is not None:
+                # children of a parent are in the same state
+                self.stats.on_insert(self.name, state_of(children[0]),
+                                     report["inserted"], buffer=buffer)
+            elif report["inserted"] == len(children):
+                for child in children:
+                    self.stats.on_insert(
+                        self.name, state_of(child), 1, buffer=buffer)
+            # otherwise which are new is unknown, left to reconciliation
+        return report
+
+    def mark_parent(self, parent, status, n_children=None,
+                    lease_queue=None, buffer=None):
+        """Write status and number of children of parent. If ``buffer`` is
+        given, the update is buffered and written in bulk later.
+        """
+        if parent is None:
+            return
+        set_doc = {"status": status}
+        if n_children is not None:
+            set_doc["n_children"] = n_children
+        if self.stats is not None:
+            self.stats.on_status(self.parent_name, state_of(parent),
+                                 parent.get("status"), status, buffer=buffer)
+        if lease_queue is not None:
+            lease_queue.release(parent["_id"], set_doc, buffer=buffer)
+        elif buffer is not None:
+            buffer.update_one(self.parent_collection(),
+                              {"_id": parent["_id"]}, {"$set": set_doc})
+        else:
+            self.parent_collection().update_one(
+                {"_id": parent["_id"]}, {"$set": set_doc})
+
+
+def solve_captcha_manually(url):
+    input("Please Solve the Captcha! Then Press Enter ...")
+
+
+class LevelCrawler(object):
+
+    """Run ``n_worker`` concurrent fetch/parse/store workers over one level.
+
+    Each worker owns one spider created by ``spider_factory``, because a
+    selenium driver can't be shared between threads.
+
+    :param level: :class:`Level` instance.
+    :param spider_factory: callable returns an object has ``get_html(url)``.
+    :param spider_pool: optional
+      :class:`~zillowdb.packages.selenium_spider.ChromeSpiderPool`, if given,
+      ``spider_factory`` is not used, workers check out a spider from the
+      pool for every page.
+    :param n_worker: number of concurrent workers.
+    :param wait_for_ready: if True, prompt once after all spiders are created.
+    :param captcha_handler: callable ``url -> None``, called (serialized
+      between workers) when a captcha page is met, the page is fetched again
+      afterwards. If None, just wait for the limiter backoff and retry.
+    :param limiter: optional :class:`~zillowdb.packages.crawlib.ratelimit.RateLimiter`
+      shared by all spiders. Captcha and parse errors are reported to it, so
+      the domain and the browser are slowed down and backed off. Success is
+      reported by :meth:`LevelCrawler.fetch` after the captcha check, spiders
+      of ``spider_pool`` should be created with ``report_success=False``.
+    :param max_captcha_retry: give up the page after this many captcha,
+      None means retry forever.
+    :param lease_seconds: if given, todo parents are claimed from a
+      :class:`~zillowdb.work_queue.LeaseQueue` with this lease time, so many
+      processes / machines can crawl the same level together.
+    :param claim_size: number of parents claimed at a time.
+    :param flush_size: parent status updates are buffered, and written in
+      bulk when this many are buffered.
+    :param flush_age: or when the oldest buffered update is this old, in
+      seconds. Updates still in buffer are lost if the process is killed,
+      those parents are just crawled again next time.
+    """
+
+    def __init__(self,
+                 level,
+                 spider_factory=create_webdriver,
+                 spider_pool=None,
+                 n_worker=1,
+                 logger=None,
+                 wait_for_ready=True,
+                 captcha_handler=solve_captcha_manually,
+                 limiter=None,
+                 max_captcha_retry=None,
+                 lease_seconds=None,
+                 claim_size=None,
+                 flush_size=500,
+                 flush_age=5.0):
+        self.level = level
+        self.spider_factory = spider_factory
+        self.spider_pool = spider_pool
+        self.n_worker = n_worker
+        if logger is None:
+            logger = create_zillow_crawler_logger()
+        self.logger = logger
+        self.wait_for_ready = wait_for_ready
+        self.captcha_handler = captcha_handler
+        self.limiter = limiter
+        self.max_captcha_retry = max_captcha_retry
+        self.lease_seconds = lease_seconds
+        if claim_size is None:
+            claim_size = n_worker * 2
+        self.claim_size = claim_size
+        self.lease_queue = None
+        self.flush_size = flush_size
+        self.flush_age = flush_age
+        self.status_buffer = None
+        self._captcha_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self.n_done = 0
+
+    def _limiter_keys(self, spider, url):
+        return urlparse(url).netloc, getattr(spider, "identity", None)
+
+    @staticmethod
+    def _get_html(spider, url, refresh=False):
+        if refresh:
+            return spider.get_html(url, refresh=True)
+        return spider.get_html(url)
+
+    def fetch(self, spider, url, refresh=False):
+        """Get html of a list page, retry on captcha.
+
+        :param refresh: if True, don't use the cached page, e.g. the parent
+          failed last time, the cached page may be the reason.
+        """
+        labels = {"level": self.level.name, "domain": urlparse(url).netloc}
+        html = self._get_html(spider, url, refresh)
+        metrics.counter("pages", **labels).inc()
+        n_captcha = 0
+        while CAPTCHA_MARK in html:
+            self.logger.info("Captcha Warning!", 1)
+            metrics.counter("captcha", **labels).inc()
+            n_captcha += 1
+            if self.limiter is not None:
+                self.limiter.on_captcha(*self._limiter_keys(spider, url))
+            if self.max_captcha_retry is not None \
+                    and n_captcha > self.max_captcha_retry:
+                raise exc.CaptchaError(url)
+            if self.captcha_handler is not None:
+                with self._captcha_lock:
+                    self.captcha_handler(url)
+            html = self._get_html(spider, url, refresh)
+            metrics.counter("pages", **labels).inc()
+        # a captcha page is http 200 as well, only a real page is a success,
+        # otherwise the failure streak (and the backoff) never grows
+        if self.limiter is not None:
+            self.limiter.on_success(*self._limiter_keys(spider, url))
+        return html
+
+    def crawl_one(self, spider, parent):
+        """Crawl the list page of one parent, store children, mark parent.
+        """
+        level = self.level
+        url = level.url_of(parent)
+        with self._counter_lock:
+            self.n_done += 1
+            n_done = self.n_done
+        self.logger.info("Crawl %s, %s done ..." % (url, n_done), 1)
+
+        n_children = None
+        # crawled before but failed, don't replay the same cached page
+        refresh = parent is not None and parent.get("status") in (
+            StatusCode.failed_to_crawl, StatusCode.crawled_but_has_error)
+        try:
+            # get html
+            with metrics.timer("stage", stage="fetch", level=level.name):
+                html = self.fetch(spider, url, refresh=refresh)
+
+            # parse data
+            try:
+                with metrics.timer("stage", stage="parse", level=level.name):
+                    children = [
+                        level.make_child(parent, link, name)
+                        for link, name in htmlparser.get_items(html, url)
+                    ]
+
+                # page has many items
+                if len(children):
+                    with metrics.timer(
+                            "stage", stage="store", level=level.name):
+                        level.store_children(
+                            parent, children, buffer=self.status_buffer)
+                    n_children = len(children)
+                    status = StatusCode.finished
+                    self.logger.info("Success", 2)
+                # most likely this listpage has no items, there's no error
+                else:
+                    status = StatusCode.crawled_but_has_error
+                    self.logger.info("No data", 2)
+
+            # HtmlParseError or CaptchaError, most like zillow blocks me
+            except Exception as e1:
+                status = StatusCode.crawled_but_has_error
+                self.logger.error("%r" % e1, 2)
+                if self.limiter is not None:
+                    self.limiter.on_error(*self._limiter_keys(spider, url))
+
+        # HttpError
+        except Exception as e2:
+            status = StatusCode.failed_to_crawl
+            self.logger.error("Http error: %s" % e2, 2)
+
+        with metrics.timer("stage", stage="mark", level=level.name):
+            level.mark_parent(
+                parent, status, n_children,
+                lease_queue=self.lease_queue, buffer=self.status_buffer)
+        metrics.counter("crawled", level=level.name, status=status).inc()
+        return status
+
+    def _crawl_task(self, spider, parent):
+        try:
+            if spider is None:
+                with self.spider_pool.spider() as spider:
+                    self.crawl_one(spider, parent)
+            else:
+                self.crawl_one(spider, parent)
+        except Exception as e:
+            self.logger.error("Unexpected error: %r" % e, 1)
+
+    def _work(self, spider, task_queue):
+        while True:
+            parent = task_queue.get()
+            try:
+                if parent is _STOP:
+                    break
+                self._crawl_task(spider, parent)
+            finally:
+                task_queue.task_done()
+
+    def run(self):
+        """Crawl all todo parents of this level.
+        """
+        self.logger.info("Crawl %s from %s parents with %s workers ..." % (
+            self.level.name, self.level.count_todo(), self.n_worker))
+
+        # with a pool, worker check out a spider for every page
+        if self.spider_pool is None:
+            spiders = [self.spider_factory() for _ in range(self.n_worker)]
+            if self.limiter is not None:
+                for spider in spiders:
+                    spider.limiter = self.limiter
+                    spider.report_success = False
+        else:
+            spiders = [None, ] * self.n_worker
+        if self.wait_for_ready:
+            input("Press Enter when your browser is ready... ")
+
+        task_queue = queue.Queue(maxsize=self.n_worker * 2)
+        threads = list()
+        for spider in spiders:
+            thread = threading.Thread(
+                target=self._work, args=(spider, task_queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        self.status_buffer = WriteBehindBuffer(
+            max_size=self.flush_size, max_age=self.flush_age)
+        self.status_buffer.start()
+
+        heartbeat = None
+        if self.lease_seconds is not None and self.level.parent_model is not None:
+            self.lease_queue = self.level.todo_queue(
+                lease_seconds=self.lease_seconds)
+            todo = self.level.iter_claim(self.lease_queue, self.claim_size)
+            heartbeat = self.lease_queue.heartbeat()
+            heartbeat.start()
+        else:
+            todo = self.level.iter_todo()
+
+        try:
+            for parent in todo:
+                task_queue.put(parent)
+        finally:
+            for _ in threads:
+                task_queue.put(_STOP)
+            for thread in threads:
+                thread.join()
+            # must be written before leases are given up
+            self.status_buffer.close()
+            self.logger.info(
+                "Status write stats: %s" % self.status_buffer.stats())
+            self.status_buffer = None
+            if heartbeat is not None:
+                heartbeat.stop()
+                # claimed but not crawled, let others take them now
+                self.lease_queue.release_all()
+                self.lease_queue = None
+            for spider in spiders:
+                close = getattr(spider, "close", None)
+                if close is not None:
+                    close()
+
+        self.logger.info("Complete! %s pages crawled." % self.n_done)
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from zillowdb.fixture_site import FixtureSite
+    from zillowdb.packages.crawlib.spider import Spider
+    from zillowdb.packages.crawlib.cache import HtmlCache
+    from zillowdb.packages.crawlib.ratelimit import RateLimiter
+
+    class FakeLevel(object):
+        name = "state"
+
+    def test_captcha_backoff():
+        class RecordLimiter(RateLimiter):
+            def __init__(self, **kwargs):
+                super(RecordLimiter, self).__init__(**kwargs)
+                self.events = list()
+
+            def on_success(self, *keys):
+                super(RecordLimiter, self).on_success(*keys)
+                self.events.append(("success", None))
+
+            def on_error(self, *keys, **kwargs):
+                super(RecordLimiter, self).on_error(*keys, **kwargs)
+                n_failure = self.key_table[keys[0]].n_failure
+                self.events.append(("error", self.backoff(n_failure)))
+
+        limiter = RecordLimiter(rate=1000.0, backoff_base=0.001,
+                                jitter=0.0, captcha_penalty=1)
+        with FixtureSite(fanout=(2, 2, 2, 2, 2), captcha_rate=1.0) as site:
+            def captcha_handler(url):
+                # solved after 4 captcha pages
+                if len(limiter.events) == 4:
+                    site.captcha_rate = 0.0
+
+            crawler = LevelCrawler(
+                FakeLevel(), spider_factory=None, limiter=limiter,
+                captcha_handler=captcha_handler,
+            )
+            spider = Spider(limiter=limiter, report_success=False)
+            html = crawler.fetch(spider, site.base_url + "/browse/homes/")
+            spider.close()
+
+        assert CAPTCHA_MARK not in html
+        assert [event for event, _ in limiter.events] == \
+            ["error"] * 4 + ["success"]
+        backoffs = [backoff for _, backoff in limiter.events[:4]]
+        assert backoffs == sorted(set(backoffs))
+
+    test_captcha_backoff()
+
+    def test_bad_page_not_replayed():
+        root = tempfile.mkdtemp()
+        try:
+            cache = HtmlCache(root)
+            with FixtureSite(fanout=(2, 2, 2, 2, 2)) as site:
+                spider = Spider(cache=cache)
+                url = site.base_url + "/browse/homes/s9/"
+                try:
+                    spider.get_html(url)
+                    assert False
+                except exc.HttpError as e:
+                    assert e.status_code == 404
+                assert cache.get(url) is None
+
+                # a parent failed last time gets its page again
+                url = site.base_url + "/browse/homes/"
+                cache.set(url, "<html>blocked</html>")
+                crawler = LevelCrawler(FakeLevel(), spider_factory=None)
+                assert "blocked" in crawler.fetch(spider, url)
+                html = crawler.fetch(spider, url, refresh=True)
+                assert "blocked" not in html
+                assert cache.get(url) == html
+                spider.close()
+        finally:
+            shutil.rmtree(root)
+
+    test_bad_page_not_replayed()
+
+    def test_crawl_one():
+        from zillowdb import mongodb  # register connection of models
+        from zillowdb.model import State, County
+        from zillowdb.benchmark import make_levels, NullLogger
+
+        State.objects.delete()
+        County.objects.delete()
+        with FixtureSite(fanout=(2, 2, 2, 2, 2)) as site:
+            levels = make_levels(site.base_url)
+            spider = Spider()
+
+            # root page, children are inserted, no parent to mark
+            crawler = LevelCrawler(levels["state"], spider_factory=None,
+                                   logger=NullLogger())
+            assert crawler.crawl_one(spider, None) == StatusCode.finished
+            assert State.objects.count() == 2
+            # crawl again, existing children are skipped
+            assert crawler.crawl_one(spider, None) == StatusCode.finished
+            assert State.objects.count() == 2
+
+            # children get fields of parent, parent is marked
+            level = levels["county"]
+            crawler = LevelCrawler(level, spider_factory=None,
+                                   logger=NullLogger())
+            parent = list(level.iter_todo())[0]
+            assert crawler.crawl_one(spider, parent) == StatusCode.finished
+            assert County.objects.count() == 2
+            assert set(county.state for county in County.objects) == \
+                set([parent["key"], ])
+            state = State.by_id(parent["_id"])
+            assert state.status == StatusCode.finished
+            assert state.n_children == 2
+            assert level.count_todo() == 1
+
+            # page not found
+            parent = {"_id": "/browse/homes/s9/", "key": "s9",
+                      "status": StatusCode.todo}
+            State(_id=parent["_id"], key="s9").save()
+            assert crawler.crawl_one(spider, parent) == \
+                StatusCode.failed_to_crawl
+            state = State.by_id(parent["_id"])
+            assert state.status == StatusCode.failed_to_crawl
+            assert County.objects.count() == 2
+            spider.close()
+
+        State.objects.delete()
+        County.objects.delete()
+
+    test_crawl_one()
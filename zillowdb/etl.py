@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming ETL from MongoDB address collections to SQL address tables.
+
+Each state runs a three stage pipeline: a reader iterates a projected,
+``_id`` ordered cursor in batches, a transformer converts a batch of documents
+to a batch of rows, a writer bulk upserts rows. Stages run in their own
+threads, connected by bounded queues, so reading, transforming and writing
+overlap, and memory usage is bounded. After a batch is written, the last
+``_id`` of it is saved as the checkpoint of the state, an interrupted copy
+resumes from there.
+
+Usage::
+
+    >>> from zillowdb.etl import copy_all
+    >>> copy_all(n_parallel=4)
+
+**中文文档**
+
+将 MongoDB 中的地址数据流式地导入 SQL 数据库。每个州是一个三段式流水线: 读取,
+转换, 写入, 各自在独立的线程中运行, 之间用有界队列连接, 所以读写可以同时进行,
+内存占用也是有限的。每写完一批数据, 就把这批数据最后的 ``_id`` 作为断点保存,
+中断后可以从断点继续。多个州可以并行导入。
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from queue import Queue, Full
+except:
+    from Queue import Queue, Full
+
+from zillowdb.mongodb import db, address_col_mapper
+from zillowdb.mssqldb import get_engine, address_table_mapper
+from zillowdb.packages.sfm import sqlalchemy_mate
+from zillowdb.packages.loggerFactory import StreamOnlyLogger
+
+checkpoint_col = db.__getattr__("etl_checkpoint")
+
+logger = StreamOnlyLogger()
+
+_STOP = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipeline(object):
+
+    """Run reader, transformer and writer concurrently.
+
+    :param reader: iterable of batch.
+    :param transformer: callable, ``batch -> batch``.
+    :param writer: callable, ``batch -> number of rows written``.
+    :param queue_size: max number of batches waiting between two stages.
+
+    If any stage raises, the others stop and :meth:`Pipeline.run` re-raises
+    the first error.
+    """
+
+    def __init__(self, reader, transformer, writer, queue_size=4):
+        self.reader = reader
+        self.transformer = transformer
+        self.writer = writer
+        self.queue_size = queue_size
+        self.n_read = 0
+        self.n_write = 0
+        self.elapsed = 0.0
+        self.error = None
+        self._abort = threading.Event()
+
+    def _put(self, queue, item):
+        # don't block forever if downstream is dead
+        while not self._abort.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+        raise PipelineAborted
+
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        self._abort.set()
+
+    def _read(self, out_queue):
+        try:
+            for batch in self.reader:
+                self.n_read += len(batch)
+                self._put(out_queue, batch)
+            self._put(out_queue, _STOP)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+
+    def _transform(self, in_queue, out_queue):
+        try:
+            while not self._abort.is_set():
+                batch = in_queue.get()
+                if batch is _STOP:
+                    self._put(out_queue, _STOP)
+                    break
+                self._put(out_queue, self.transformer(batch))
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+
+    def _write(self, in_queue):
+        try:
+            while not self._abort.is_set():
+                batch = in_queue.get()
+                if batch is _STOP:
+                    break
+                self.n_write += self.writer(batch)
+        except Exception as e:
+            self._fail(e)
+
+    def run(self):
+        """Run until all batches are written, return self.
+        """
+        q1 = Queue(maxsize=self.queue_size)
+        q2 = Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._read, args=(q1,)),
+            threading.Thread(target=self._transform, args=(q1, q2)),
+            threading.Thread(target=self._write, args=(q2,)),
+        ]
+        st = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # a stage blocked on get() of a dead upstream is released by _STOP
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+                if self._abort.is_set():
+                    for queue in (q1, q2):
+                        try:
+                            queue.put_nowait(_STOP)
+                        except Full:
+                            pass
+        self.elapsed = time.time() - st
+
+        if self.error is not None:
+            raise self.error
+        return self
+
+    @property
+    def rows_per_sec(self):
+        if self.elapsed:
+            return self.n_write / self.elapsed
+        return 0.0
+
+
+#--- Checkpoint ---
+def get_checkpoint(name):
+    doc = checkpoint_col.find_one({"_id": name})
+    if doc is None:
+        return None
+    return doc["last_id"]
+
+
+def set_checkpoint(name, last_id):
+    checkpoint_col.update_one(
+        {"_id": name}, {"$set": {"last_id": last_id}}, upsert=True)
+
+
+def clear_checkpoint(name):
+    checkpoint_col.delete_one({"_id": name})
+
+
+#--- Address ---
+ADDRESS_PROJECTION = {"_id": True, "key": True, "name": True,
+                      "state": True, "zipcode": True}
+
+
+def read_address(col, last_id=None, batch_size=1000):
+    """Yield batches of projected address documents having a zillow id, in
+    ``_id`` order, after ``last_id``.
+    """
+    filters = {"key": {"$regex": "_zpid$"}}
+    if last_id is not None:
+        filters["_id"] = {"$gt": last_id}
+    cursor = col.find(
+        filters, dict(ADDRESS_PROJECTION), no_cursor_timeout=True)
+    cursor = cursor.sort("_id", 1).batch_size(batch_size)
+    try:
+        batch = list()
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+    finally:
+        cursor.close()
+
+
+def transform_address(docs):
+    """Convert a batch of address documents to ``(last_id, rows)``.
+
+    name looks like ``"123 Main St  Baltimore, MD 21201"``, address and city
+    are parsed from it.
+    """
+    rows = list()
+    append = rows.append
+    for doc in docs:
+        address, city = None, None
+        chunks = doc["name"].split("  ")
+        if len(chunks) == 2:
+            address, other = chunks
+            chunks = other.split(",")
+            if len(chunks) == 2:
+                city = chunks[0]
+        append({
+            "zid": int(doc["key"][:-5]),
+            "address": address,
+            "city": city,
+            "state": doc.get("state"),
+            "zipcode": doc.get("zipcode"),
+            "status": 0,  # Todo
+        })
+    return docs[-1]["_id"], rows
+
+
+def copy_address(state, batch_size=1000, resume=True, queue_size=4):
+    """Copy address of one state from MongoDB to SQL.
+
+    :param resume: if True, start after the checkpoint of this state.
+    :returns: the finished :class:`Pipeline`.
+    """
+    col = address_col_mapper[state]
+    table = address_table_mapper[state]
+    name = "copy_address:%s" % state
+    last_id = get_checkpoint(name) if resume else None
+
+    def write(batch):
+        last_id, rows = batch
+        sqlalchemy_mate.bulk_upsert(
+            get_engine(), table, rows, batch_size=batch_size)
+        set_checkpoint(name, last_id)
+        return len(rows)
+
+    pipeline = Pipeline(
+        reader=read_address(col, last_id=last_id, batch_size=batch_size),
+        transformer=transform_address,
+        writer=write,
+        queue_size=queue_size,
+    )
+    return pipeline.run()
+
+
+def copy_all(states=None, n_parallel=4, batch_size=1000, resume=True):
+    """Copy address of all states having a SQL table, ``n_parallel`` states
+    at a time. Log rows/sec of each state and in total.
+    """
+    if states is None:
+        states = [state for state in address_col_mapper
+                  if state in address_table_mapper]
+
+    def copy(state):
+        pipeline = copy_address(state, batch_size=batch_size, resume=resume)
+        logger.info("%s: %s rows in %.2f sec, %.1f rows/sec" % (
+            state, pipeline.n_write, pipeline.elapsed,
+            pipeline.rows_per_sec), 1)
+        return pipeline.n_write
+
+    logger.info("Copy address of %s states ..." % len(states))
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+        n_write = sum(executor.map(copy, states))
+    elapsed = time.time() - st
+    logger.info("Complete %s rows in %.2f sec, %.1f rows/sec" % (
+        n_write, elapsed, n_write / elapsed if elapsed else 0.0))
+    return n_write
+
+
+#--- Unittest ---
+def test_read_address():
+    col = db.__getattr__("etl_test_address")
+    col.delete_many({})
+    col.insert_many([
+        {"_id": i, "key": "%s_zpid" % i, "name": "addr", "href": "x"}
+        for i in range(1, 1 + 7)
+    ] + [{"_id": 100, "key": "bad", "name": "addr"}])
+
+    batches = list(read_address(col, batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [doc["_id"] for doc in batches[-1]] == [7, ]
+    assert "href" not in batches[0][0]
+
+    batches = list(read_address(col, last_id=5, batch_size=3))
+    assert [[doc["_id"] for doc in batch] for batch in batches] == [[6, 7]]
+    col.drop()
+
+
+def make_docs(n):
+    return [{"_id": i, "key": "%s_zpid" % i,
+             "name": "%s Main St  Baltimore, MD 21201" % i,
+             "state": "md", "zipcode": "21201"}
+            for i in range(1, 1 + n)]
+
+
+def test_transform_address():
+    last_id, rows = transform_address(make_docs(2) + [
+        {"_id": 3, "key": "3_zpid", "name": "no city"}])
+    assert last_id == 3
+    assert rows[0] == {"zid": 1, "address": "1 Main St", "city": "Baltimore",
+                       "state": "md", "zipcode": "21201", "status": 0}
+    assert rows[2]["address"] is None
+    assert rows[2]["city"] is None
+    assert rows[2]["state"] is None
+
+
+def make_sqlite_engine():
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+    from zillowdb.mssqldb import metadata
+
+    # the writer runs in its own thread, share one in-memory database
+    engine = create_engine("sqlite://", poolclass=StaticPool,
+                           connect_args={"check_same_thread": False})
+    metadata.create_all(engine)
+    return engine
+
+
+def test_pipeline():
+    engine = make_sqlite_engine()
+    table = address_table_mapper["md"]
+    docs = make_docs(7)
+    checkpoints = list()
+
+    def write(batch):
+        last_id, rows = batch
+        sqlalchemy_mate.bulk_upsert(engine, table, rows)
+        checkpoints.append(last_id)
+        return len(rows)
+
+    batches = [docs[0:3], docs[3:6], docs[6:7]]
+    pipeline = Pipeline(iter(batches), transform_address, write,
+                        queue_size=1).run()
+    assert pipeline.n_read == 7
+    assert pipeline.n_write == 7
+    assert checkpoints == [3, 6, 7]
+    assert sqlalchemy_mate.count_row(engine, table) == 7
+
+    # re-run is idempotent
+    pipeline = Pipeline(iter(batches), transform_address, write).run()
+    assert pipeline.n_write == 7
+    assert sqlalchemy_mate.count_row(engine, table) == 7
+
+
+def test_pipeline_error():
+    docs = make_docs(10)
+    batches = [docs[i:i + 2] for i in range(0, 10, 2)]
+
+    def bad_reader():
+        yield batches[0]
+        raise IOError("cursor lost")
+
+    def bad_transformer(batch):
+        if batch[0]["_id"] == 3:
+            raise KeyError("name")
+        return transform_address(batch)
+
+    def bad_writer(batch):
+        raise ValueError("disk full")
+
+    def write(batch):
+        written.append(batch[0])
+        return len(batch[1])
+
+    for reader, transformer, writer, error in [
+        (bad_reader(), transform_address, write, IOError),
+        (iter(batches), bad_transformer, write, KeyError),
+        (iter(batches), transform_address, bad_writer, ValueError),
+    ]:
+        written = list()
+        pipeline = Pipeline(reader, transformer, writer, queue_size=1)
+        try:
+            pipeline.run()
+            assert False
+        except error:
+            pass
+        # only batches before the failed one may be written
+        assert set(written) <= set([2, ])
+        assert pipeline.n_write <= 2
+
+
+if __name__ == "__main__":
+    test_read_address()
+    test_transform_address()
+    test_pipeline()
+    test_pipeline_error()
+
+#     copy_all()
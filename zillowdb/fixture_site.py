@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A synthetic, zillow shaped site served from a local http server, for
+benchmark and test of the crawlers. Nothing is sent to zillow.
+
+The hierarchy is generated from ``fanout``, the number of children of each
+level, e.g. ``(2, 3, 3, 4, 5)`` means 2 states, 3 counties per state, ...,
+5 addresses per street::
+
+    /browse/homes/                                  all states
+    /browse/homes/s0/                               counties of a state
+    /browse/homes/s0/c0-county/                     zipcodes of a county
+    /browse/homes/s0/c0-county/20000/               streets of a zipcode
+    /browse/homes/s0/c0-county/20000/street-0_0/    addresses of a street
+    /homedetails/0-Street-0-S0-20000/1000000_zpid/  house detail
+
+Pages use the same markup as zillow, so they are parsed by
+:data:`zillowdb.htmlparser.htmlparser`. Every response is delayed by
+``latency`` plus up to ``jitter`` seconds, and is a captcha page with
+probability ``captcha_rate``.
+
+Usage::
+
+    >>> with FixtureSite(latency=0.05, captcha_rate=0.02) as site:
+    ...     html = spider.get_html(site.base_url + "/browse/homes/")
+
+**中文文档**
+
+在本地启动一个结构与 zillow 相同的虚拟网站, 用于爬虫的性能测试。可以设置每个层级
+的子节点数量, 响应延迟, 以及返回验证码页面的概率。
+"""
+
+import time
+import random
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from zillowdb.crawler_engine import CAPTCHA_MARK
+from zillowdb.htmlparser import LISTPAGE_DIV_CLASS
+
+#: number of states, counties per state, zipcodes per county, streets per
+#: zipcode, addresses per street
+DEFAULT_FANOUT = (2, 3, 3, 4, 5)
+
+LEVEL_NAMES = ["state", "county", "zipcode", "street", "address"]
+
+BROWSE_PREFIX = "/browse/homes/"
+DETAIL_PREFIX = "/homedetails/"
+
+CAPTCHA_HTML = (
+    '<html><head><script src="%s"></script></head>'
+    '<body>Please verify you are a human</body></html>' % CAPTCHA_MARK
+)
+
+LIST_HTML = (
+    '<html><head><title>%(title)s</title></head><body>'
+    '<div class="%(div_class)s"><ul>%(items)s</ul></div>%(padding)s'
+    '</body></html>'
+)
+
+DETAIL_HTML = (
+    '<html><head><title>%(title)s</title></head><body>'
+    '<header class="zsg-content-header addr"><h1>%(title)s</h1><h3>'
+    '<span class="addr_bbs">%(bedroom)s beds</span>'
+    '<span class="addr_bbs">%(bathroom)s baths</span>'
+    '<span class="addr_bbs">%(sqft)s sqft</span>'
+    '</h3></header>'
+    '<div class="fact-group-container zsg-content-component"><h3>Facts</h3>'
+    '<ul><li>Single Family</li><li>Built in %(year)s</li></ul></div>'
+    '<div class="fact-group-container zsg-content-component">'
+    '<h3>Construction</h3><ul><li>Stories: %(stories)s</li></ul></div>'
+    '%(padding)s</body></html>'
+)
+
+
+class FixtureSite(object):
+
+    """
+    :param fanout: number of children of each level, see
+      :data:`DEFAULT_FANOUT`.
+    :param latency: seconds every response is delayed.
+    :param jitter: extra random delay, up to this many seconds.
+    :param captcha_rate: probability a response is a captcha page.
+    :param padding: bytes of filler appended to every page, real zillow pages
+      are a few hundred KB.
+    :param seed: random seed of delay and captcha, same seed same sequence.
+    :param port: 0 means any free port.
+    """
+
+    def __init__(self, fanout=DEFAULT_FANOUT, latency=0.0, jitter=0.0,
+                 captcha_rate=0.0, padding=0, seed=0,
+                 host="127.0.0.1", port=0):
+        if len(fanout) != len(LEVEL_NAMES):
+            raise ValueError("fanout has to have %s numbers" % len(LEVEL_NAMES))
+        self.fanout = tuple(fanout)
+        self.latency = latency
+        self.jitter = jitter
+        self.captcha_rate = captcha_rate
+        self.padding = padding
+        self.seed = seed
+        self.host = host
+        self.port = port
+
+        self.n_request = 0
+        self.n_captcha = 0
+        self.n_not_found = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def config(self):
+        """Parameters of the site, saved with benchmark results.
+        """
+        return {
+            "fanout": list(self.fanout),
+            "latency": self.latency,
+            "jitter": self.jitter,
+            "captcha_rate": self.captcha_rate,
+            "padding": self.padding,
+            "seed": self.seed,
+        }
+
+    @property
+    def base_url(self):
+        return "http://%s:%s" % (self.host, self.port)
+
+    def n_item(self, level):
+        """Total number of items of a level, e.g. number of all counties.
+        """
+        n = 1
+        for fanout in self.fanout[:LEVEL_NAMES.index(level) + 1]:
+            n *= fanout
+        return n
+
+    #--- Pages ---
+    @staticmethod
+    def key_of(depth, index):
+        """Key of the ``index`` th child at ``depth`` (0 is state).
+        """
+        if depth == 0:
+            return "s%s" % index
+        elif depth == 1:
+            return "c%s-county" % index
+        elif depth == 2:
+            return "%05d" % (20000 + index)
+        else:
+            return "street-%s_%s" % (index, index)
+
+    def _indexes_of(self, parts):
+        """Path parts to child index of every depth, None if not exists.
+        """
+        indexes = list()
+        for depth, part in enumerate(parts):
+            if depth >= len(LEVEL_NAMES) - 1:
+                return None
+            for index in range(self.fanout[depth]):
+                if self.key_of(depth, index) == part:
+                    indexes.append(index)
+                    break
+            else:
+                return None
+        return indexes
+
+    def zpid_of(self, indexes):
+        """Unique zpid of an address, from index of every depth.
+        """
+        zpid = 0
+        for fanout, index in zip(self.fanout, indexes):
+            zpid = zpid * fanout + index
+        return 1000000 + zpid
+
+    def _padding(self):
+        if not self.padding:
+            return ""
+        return '<div class="filler">%s</div>' % ("x" * self.padding)
+
+    def render_list(self, parts):
+        indexes = self._indexes_of(parts)
+        if indexes is None:
+            return None
+        depth = len(parts)
+        items = list()
+        for index in range(self.fanout[depth]):
+            if depth == len(LEVEL_NAMES) - 1:
+                state, zipcode = parts[0], parts[2]
+                zpid = self.zpid_of(indexes + [index, ])
+                href = "%s%s-Street-%s-%s-%s/%s_zpid/" % (
+                    DETAIL_PREFIX, index, indexes[-1],
+                    state.upper(), zipcode, zpid)
+                name = "%s Street %s" % (index, indexes[-1])
+            else:
+                key = self.key_of(depth, index)
+                href = BROWSE_PREFIX + "".join(
+                    ["%s/" % part for part in parts + [key, ]])
+                name = key
+            items.append('<li><a href="%s">%s</a></li>' % (href, name))
+        return LIST_HTML % {
+            "title": "/".join(parts) or "homes",
+            "div_class": LISTPAGE_DIV_CLASS,
+            "items": "".join(items),
+            "padding": self._padding(),
+        }
+
+    def render_detail(self, slug, zpid):
+        try:
+            zpid = int(zpid.replace("_zpid", ""))
+        except ValueError:
+            return None
+        return DETAIL_HTML % {
+            "title": slug,
+            "bedroom": 1 + zpid % 5,
+            "bathroom": 1 + zpid % 3 / 2.0,
+            "sqft": "{:,}".format(800 + zpid % 3000),
+            "year": 1950 + zpid % 60,
+            "stories": 1 + zpid % 3,
+            "padding": self._padding(),
+        }
+
+    def render(self, path):
+        """Return html of a path, None if not found.
+        """
+        path = path.split("?")[0]
+        if path.startswith(BROWSE_PREFIX):
+            parts = [part for part in path[len(BROWSE_PREFIX):].split("/")
+                     if part]
+            return self.render_list(parts)
+        elif path.startswith(DETAIL_PREFIX):
+            parts = [part for part in path[len(DETAIL_PREFIX):].split("/")
+                     if part]
+            if len(parts) == 2:
+                return self.render_detail(*parts)
+        return None
+
+    #--- Server ---
+    def _delay_and_captcha(self):
+        with self._lock:
+            self.n_request += 1
+            delay = self.latency + self._random.random() * self.jitter
+            captcha = self._random.random() < self.captcha_rate
+            if captcha:
+                self.n_captcha += 1
+        return delay, captcha
+
+    def respond(self, path):
+        """Return ``(status code, html)`` of a request.
+        """
+        delay, captcha = self._delay_and_captcha()
+        if delay:
+            time.sleep(delay)
+        if captcha:
+            return 200, CAPTCHA_HTML
+        html = self.render(path)
+        if html is None:
+            with self._lock:
+                self.n_not_found += 1
+            return 404, "<html><body>Not Found</body></html>"
+        return 200, html
+
+    def start(self):
+        site = self
+
+        class Handler(_Handler):
+            pass
+
+        Handler.site = site
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # many crawler workers connect at the same time
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    site = None
+    # keep-alive, the crawler reuses connections
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't wait for delayed ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, html = self.site.respond(self.path)
+        body = html.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    from zillowdb.htmlparser import htmlparser
+    from zillowdb.packages.crawlib.spider import Spider
+
+    def test_fixture_site():
+        site = FixtureSite(fanout=(2, 2, 2, 2, 3))
+        assert site.n_item("street") == 16
+        assert site.n_item("address") == 48
+
+        items = htmlparser.get_items(site.render("/browse/homes/"))
+        assert items == [("s0/", "s0"), ("s1/", "s1")]
+        items = htmlparser.get_items(
+            site.render("/browse/homes/s1/c0-county/20001/street-1_1/"))
+        assert len(items) == 3
+        link = items[2][0]
+        assert link.startswith(DETAIL_PREFIX) and link.endswith("_zpid/")
+        assert site.render("/browse/homes/s2/") is None
+
+        detail = htmlparser.get_house_detail(site.render(link))
+        assert detail["bedroom"] >= 1 and detail["sqft"] >= 800
+        assert len(detail["facts"]) == 2
+
+    test_fixture_site()
+
+    def test_server():
+        with FixtureSite(captcha_rate=0.5, latency=0.01, seed=1) as site:
+            spider = Spider()
+            html_list = [
+                spider.get_html(site.base_url + "/browse/homes/s0/")
+                for _ in range(20)
+            ]
+            n_captcha = len([html for html in html_list
+                             if CAPTCHA_MARK in html])
+            assert n_captcha == site.n_captcha
+            assert 0 < n_captcha < 20
+            assert site.n_request == 20
+            spider.close()
+
+    test_server()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Zillow html parser, a faster drop-in replacement of
+``crawl_zillow.zilo_htmlparser``.
+
+List page parsing only builds the ``div`` holding the items (a
+``SoupStrainer``), or uses the raw lxml tree in fast mode. House detail
+parsing is delegated to ``crawl_zillow``.
+
+**中文文档**
+
+``crawl_zillow.zilo_htmlparser`` 的快速版本。列表页只解析包含条目的 ``div``,
+或者在快速模式下直接使用 lxml, 不构造 soup。结果与原版一致。
+"""
+
+from crawl_zillow import zilo_htmlparser
+
+from zillowdb.packages.crawlib import exc
+from zillowdb.packages.sfm.metrics import metrics
+from zillowdb.packages.crawlib.htmlparser import (
+    BaseHtmlParser, SoupStrainer, has_lxml, benchmark,
+    BACKEND_LXML, BACKEND_HTML_PARSER, BACKEND_ETREE,
+)
+
+ROBOT_MARK = "I'm not a robot"
+LISTPAGE_DIV_CLASS = "zsg-lg-1-2 zsg-sm-1-1"
+LISTPAGE_DIV_XPATH = "//div[@class='%s']" % LISTPAGE_DIV_CLASS
+
+
+class ZillowHtmlParser(BaseHtmlParser):
+
+    parse_only = SoupStrainer("div", class_=LISTPAGE_DIV_CLASS)
+
+    def get_items(self, html, url="unknown url"):
+        """Get state, county, zipcode, address ``(link, name)`` from list
+        page.
+
+        Example: http://www.zillow.com/browse/homes/md/
+        """
+        with metrics.timer("parse", page="list"):
+            return self._get_items(html, url)
+
+    def _get_items(self, html, url):
+        if ROBOT_MARK in html:
+            raise exc.CaptchaError(url)
+
+        data = list()
+        try:
+            if self.is_fast_mode:
+                div = self.get_tree(html).xpath(LISTPAGE_DIV_XPATH)[0]
+                for li in div.iter("li"):
+                    a = li.xpath(".//a")[0]
+                    link = a.get("href").replace("/browse/homes/", "")
+                    data.append((link, a.text_content().strip()))
+            else:
+                soup = self.get_soup(html)
+                div = soup.find("div", class_=LISTPAGE_DIV_CLASS)
+                for li in div.find_all("li"):
+                    a = li.find_all("a")[0]
+                    link = a["href"].replace("/browse/homes/", "")
+                    data.append((link, a.text.strip()))
+            return data
+        except Exception as e:
+            raise exc.ParseError("%s: %s" % (url, e))
+
+    def get_house_detail(self, html):
+        with metrics.timer("parse", page="house_detail"):
+            return zilo_htmlparser.get_house_detail(html)
+
+
+htmlparser = ZillowHtmlParser(BACKEND_ETREE if has_lxml else None)
+
+
+#--- Benchmark ---
+def benchmark_list_page(html_list):
+    """Compare per page time of ``get_items`` of ``crawl_zillow`` and every
+    backend, on saved list pages. Return ``{name: stats}``.
+    """
+    candidates = [("crawl_zillow", zilo_htmlparser)]
+    for backend in [BACKEND_HTML_PARSER, BACKEND_LXML, BACKEND_ETREE]:
+        if backend != BACKEND_HTML_PARSER and not has_lxml:
+            continue
+        candidates.append((backend, ZillowHtmlParser(backend)))
+
+    result = dict()
+    for name, parser in candidates:
+        result[name] = benchmark(parser.get_items, html_list)
+    return result
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    from zillowdb.fixture_site import FixtureSite
+
+    site = FixtureSite(fanout=(3, 3, 3, 3, 3), padding=20000)
+    paths = [
+        "/browse/homes/",
+        "/browse/homes/s1/",
+        "/browse/homes/s1/c2-county/",
+        "/browse/homes/s1/c2-county/20000/",
+        "/browse/homes/s1/c2-county/20000/street-1_1/",
+    ]
+    html_list = [site.render(path) for path in paths]
+
+    def test_same_items():
+        """Every backend gets the same items as ``crawl_zillow``.
+        """
+        for html in html_list:
+            expected = zilo_htmlparser.get_items(html)
+            assert len(expected) == 3
+            for backend in [BACKEND_HTML_PARSER, BACKEND_LXML, BACKEND_ETREE]:
+                if backend != BACKEND_HTML_PARSER and not has_lxml:
+                    continue
+                parser = ZillowHtmlParser(backend)
+                assert parser.get_items(html) == expected
+            assert htmlparser.get_items(html) == expected
+
+    test_same_items()
+
+    def test_benchmark_list_page():
+        result = benchmark_list_page(html_list)
+        assert "crawl_zillow" in result
+        assert BACKEND_HTML_PARSER in result
+        for stats in result.values():
+            assert stats["n"] == len(html_list)
+
+    test_benchmark_list_page()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Build indexes for crawler queries, and check that crawler queries use them.
+
+Indexes are declared in ``meta["indexes"]`` of documents in
+:mod:`zillowdb.model`. Address of each state lives in its own collection, so
+indexes declared on :class:`~zillowdb.model.Address` are built on every
+collection of :data:`~zillowdb.mongodb.address_col_mapper`. Work queue
+lease fields are not declared in documents, their index is added here.
+
+Usage::
+
+    >>> from zillowdb.indexes import ensure_indexes, explain_report
+    >>> ensure_indexes()
+    >>> for row in explain_report():
+    ...     print(row)
+
+**中文文档**
+
+为爬虫的查询建立索引, 并用 explain 检查爬虫的查询是否还存在全表扫描。索引在
+:mod:`zillowdb.model` 中定义, 地址按州分表, 所以 Address 的索引会在每个州的表上
+建立。所有索引都在后台建立, 不阻塞读写。
+"""
+
+from datetime import datetime
+
+from zillowdb.model import StatusCode, State, County, Zipcode, Street, Address
+from zillowdb.mongodb import address_col_mapper
+from zillowdb.work_queue import LEASE_TOKEN, LEASE_EXPIRE
+from zillowdb.packages.loggerFactory import StreamOnlyLogger
+
+logger = StreamOnlyLogger()
+
+LEVEL_MODELS = [State, County, Zipcode, Street]
+
+#: indexes of fields not declared in documents, ``(keys, options)``
+EXTRA_INDEXES = [
+    # LeaseQueue.claim finds its documents by token
+    ([(LEASE_TOKEN, 1)], {"sparse": True}),
+    ([(LEASE_EXPIRE, 1)], {"sparse": True}),
+]
+
+COLLSCAN = "COLLSCAN"
+
+
+def index_specs(document_class):
+    """Return list of ``(keys, options)`` declared in ``meta["indexes"]``.
+    """
+    specs = list()
+    for spec in document_class._meta.get("index_specs", list()):
+        spec = dict(spec)
+        keys = spec.pop("fields")
+        specs.append((keys, spec))
+    return specs
+
+
+def create_indexes(col, specs, background=True):
+    """Create indexes on a pymongo collection, return list of index name.
+    Existing index is skipped by server.
+    """
+    names = list()
+    for keys, options in specs:
+        options = dict(options)
+        options.setdefault("background", background)
+        names.append(col.create_index(keys, **options))
+    return names
+
+
+def ensure_indexes(background=True, states=None):
+    """Build indexes of all level collections, and of address collection of
+    every state.
+
+    :param background: build index without blocking read and write.
+    :param states: only build address indexes of these states, default is
+      all states.
+    :returns: ``{collection name: [index name, ...]}``.
+    """
+    result = dict()
+    for document_class in LEVEL_MODELS:
+        col = document_class._get_collection()
+        logger.info("Ensure indexes of %s ..." % col.name)
+        result[col.name] = create_indexes(
+            col, index_specs(document_class) + EXTRA_INDEXES, background)
+
+    address_specs = index_specs(Address) + EXTRA_INDEXES
+    if states is None:
+        states = list(address_col_mapper)
+    for state in states:
+        col = address_col_mapper[state]
+        logger.info("Ensure indexes of %s ..." % col.name)
+        result[col.name] = create_indexes(col, address_specs, background)
+    logger.info("Complete!")
+    return result
+
+
+#--- Explain ---
+def _iter_stages(plan):
+    """Yield stage names of a query plan tree.
+    """
+    if not plan:
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    if "inputStage" in plan:
+        for stage in _iter_stages(plan["inputStage"]):
+            yield stage
+    for child in plan.get("inputStages", list()):
+        for stage in _iter_stages(child):
+            yield stage
+    # sharded cluster
+    for shard in plan.get("shards", list()):
+        for stage in _iter_stages(shard.get("winningPlan")):
+            yield stage
+
+
+def explain_query(col, filters, sort=None):
+    """Explain a find query, return a dict:
+
+    - stages: stage names of the winning plan.
+    - collscan: True if the winning plan scans the whole collection.
+    - n_examined / n_returned: documents examined and returned, None if
+      server doesn't report execution stats.
+    """
+    cursor = col.find(filters)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    explain = cursor.explain()
+    stages = list(_iter_stages(explain.get("queryPlanner", dict())
+                               .get("winningPlan")))
+    stats = explain.get("executionStats", dict())
+    return {
+        "stages": stages,
+        "collscan": COLLSCAN in stages,
+        "n_examined": stats.get("totalDocsExamined"),
+        "n_returned": stats.get("nReturned"),
+    }
+
+
+def crawler_queries(levels=None, states=None):
+    """List queries the crawlers run, as ``(name, col, filters, sort)``.
+    """
+    from zillowdb import crawler_mongo
+    from zillowdb.work_queue import LeaseQueue
+
+    if levels is None:
+        levels = [
+            crawler_mongo.county_level,
+            crawler_mongo.zipcode_level,
+            crawler_mongo.street_level,
+            crawler_mongo.address_level,
+        ]
+    queries = list()
+    for level in levels:
+        if level.parent_model is None:
+            continue
+        col = level.parent_collection()
+        filters = level.todo_filters()
+        queries.append(("%s todo" % level.name, col, filters, None))
+        queue = LeaseQueue(col, filters)
+        queries.append((
+            "%s claim" % level.name, col,
+            queue._claimable(datetime.utcnow()), [("_id", 1)],
+        ))
+        queries.append((
+            "%s lease" % level.name, col, {LEASE_TOKEN: "token"}, None,
+        ))
+
+    if states is None:
+        states = list(address_col_mapper)
+    for state in states:
+        col = address_col_mapper[state]
+        queries.append((
+            "house detail todo %s" % state, col,
+            {"status_zillow": StatusCode.todo, "county": "montgomery-county"},
+            None,
+        ))
+        queries.append((
+            "zillow api %s" % state, col, {"key": "0_zpid"}, None,
+        ))
+    return queries
+
+
+def explain_report(queries=None):
+    """Explain every crawler query, log and return list of dict, queries
+    still doing collection scan are flagged.
+    """
+    if queries is None:
+        queries = crawler_queries()
+    report = list()
+    for name, col, filters, sort in queries:
+        row = {"name": name, "collection": col.name}
+        row.update(explain_query(col, filters, sort))
+        report.append(row)
+        flag = "COLLSCAN!" if row["collscan"] else "ok"
+        logger.info("%-28s %-10s %-9s %s" % (
+            name, col.name, flag, " <- ".join(row["stages"])))
+    return report
+
+
+if __name__ == "__main__":
+    pass
+#     ensure_indexes()
+#     explain_report()
@@ -13,8 +13,12 @@ class StatusCode(object):
 
 class AddressMetaDocument(ExtendedDocument):
 
+    @staticmethod
+    def key_of(_id):
+        return _id.split("/")[-2]
+
     def get_key(self):
-        return self._id.split("/")[-2]
+        return self.key_of(self._id)
     
     @property
     def url(self):
@@ -22,6 +26,12 @@ class AddressMetaDocument(ExtendedDocument):
         
     meta = {
         "abstract": True,
+        # documents may carry work queue lease fields
+        "strict": False,
+        # indexes are built in background by zillowdb.indexes.ensure_indexes,
+        # not on first access
+        "auto_create_index": False,
+        "index_background": True,
     }
 
 
@@ -35,6 +45,9 @@ class State(AddressMetaDocument):
     meta = {
         "db_alias": "default",
         "collection": "state",
+        "indexes": [
+            "status",
+        ],
     }
 
 
@@ -50,6 +63,9 @@ class County(AddressMetaDocument):
     meta = {
         "db_alias": "default",
         "collection": "county",
+        "indexes": [
+            ("state", "status"),
+        ],
     }
 
 
@@ -66,6 +82,10 @@ class Zipcode(AddressMetaDocument):
     meta = {
         "db_alias": "default",
         "collection": "zipcode",
+        "indexes": [
+            ("state", "status"),
+            ("county", "status"),
+        ],
     }
 
 
@@ -84,6 +104,11 @@ class Street(AddressMetaDocument):
     meta = {
         "db_alias": "default",
         "collection": "street",
+        "indexes": [
+            ("state", "status"),
+            ("zipcode", "status"),
+            ("status_zillow", "county"),
+        ],
     }
 
 
@@ -97,14 +122,22 @@ class Address(AddressMetaDocument):
     key = mongoengine.StringField()
     name = mongoengine.StringField()
     status = mongoengine.IntField()
+    status_zillow = mongoengine.IntField()
     
     trulia_detail = mongoengine.DictField()
     zillow_detail = mongoengine.DictField()
-    zillow_api
+    zillow_api = mongoengine.DictField()
     
+    # address of each state is in its own collection, see 
+    # zillowdb.mongodb.address_col_mapper
     meta = {
         "db_alias": "default",
         "collection": "address",
+        "indexes": [
+            ("state", "status"),
+            ("status_zillow", "county"),
+            "key",
+        ],
     }
     
     @property
@@ -18,21 +18,199 @@ For saving space, I use abbreviation as field key:
 
 from zillowdb.mongodb import (state_col, county_col, zipcode_col, street_col, 
     address_col, address_col_mapper)
+
+Importing this module doesn't connect, connection is created lazily in each
+process, see :class:`ConnectionManager`.
 """
 
+import os
+import threading
 from collections import OrderedDict
 
-import pymongo
+try:
+    from collections.abc import Mapping
+except:
+    from collections import Mapping
+
 import mongoengine
 
+from zillowdb import config
+
 DBNAME = "zillowdb2"
+ALIAS = "default"
+
+
+class ConnectionManager(object):
+
+    """Lazy, fork safe MongoDB connection.
+
+    Nothing is connected until the first query. pymongo and mongoengine share
+    one ``MongoClient`` (one connection pool), it's registered as the
+    mongoengine connection of ``alias``. A forked child process disconnects
+    the client inherited from its parent, and creates its own on first use,
+    pymongo clients are not fork safe.
+
+    :param kwargs: passed to ``MongoClient``, e.g. ``maxPoolSize``.
+
+    **中文文档**
+
+    延迟创建 MongoDB 连接, 直到第一次查询才连接。pymongo 和 mongoengine 共用同一个
+    连接池。fork 出的子进程会丢弃父进程的连接, 在第一次使用时创建自己的连接。
+    """
+
+    def __init__(self, db_name, alias=ALIAS, host="localhost", port=27017,
+                 **kwargs):
+        self.db_name = db_name
+        self.alias = alias
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._register()
+        if hasattr(os, "register_at_fork"):  # python3.7+
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _register(self):
+        # no I/O here, MongoClient is created by mongoengine on first use
+        mongoengine.register_connection(
+            alias=self.alias, db=self.db_name,
+            host=self.host, port=self.port, connect=False, **self.kwargs
+        )
+
+    def _after_fork(self):
+        """Drop connection of parent process, and cached collections of
+        documents. pymongo discards sockets opened by another process, the
+        parent's connections are not touched.
+        """
+        self._lock = threading.Lock()
+        mongoengine.disconnect(self.alias)
+        self._register()
+        self._pid = os.getpid()
+
+    def reconnect(self, host=None, port=None):
+        """Close current connection, connect to another server (lazily),
+        e.g. a throwaway ``mongod`` of benchmark.
+        """
+        with self._lock:
+            mongoengine.disconnect(self.alias)
+            if host is not None:
+                self.host = host
+            if port is not None:
+                self.port = port
+            self._register()
+
+    def _check_pid(self):
+        # for python without os.register_at_fork
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    @property
+    def client(self):
+        self._check_pid()
+        with self._lock:
+            return mongoengine.get_connection(self.alias)
+
+    @property
+    def db(self):
+        self._check_pid()
+        with self._lock:
+            return mongoengine.get_db(self.alias)
+
+    def get_collection(self, name):
+        return self.db[name]
+
+
+class LazyCollection(object):
+
+    """Proxy of a collection, the real collection is resolved on every
+    access, from the client of current process.
+    """
+
+    def __init__(self, manager, name):
+        self._manager = manager
+        self.name = name
+
+    @property
+    def collection(self):
+        return self._manager.get_collection(self.name)
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.collection, attr)
+
+    def __getitem__(self, name):
+        return self.collection[name]
+
+    def __repr__(self):
+        return "LazyCollection(%r)" % self.name
+
+
+class LazyDatabase(object):
+
+    """Proxy of the database, ``db.state`` is a :class:`LazyCollection`.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return LazyCollection(self._manager, name)
+
+    def __getitem__(self, name):
+        return LazyCollection(self._manager, name)
+
+
+class AddressCollectionMapper(Mapping):
+
+    """Ordered ``{state: address collection}`` mapping, states are read from
+    ``state_col`` on first access. Call :meth:`refresh` to read again.
+    """
+
+    def __init__(self, db, state_col):
+        self._db = db
+        self._state_col = state_col
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    data = OrderedDict()
+                    for doc in self._state_col.find({}, {"key": True}):
+                        state = doc["key"]
+                        data[state] = self._db[state]
+                    self._data = data
+        return self._data
+
+    def refresh(self):
+        self._data = None
+
+    def __getitem__(self, state):
+        return self._load()[state]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+connection_manager = ConnectionManager(
+    DBNAME,
+    host=config.MONGODB_HOST,
+    port=config.MONGODB_PORT,
+    maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+    minPoolSize=config.MONGODB_MIN_POOL_SIZE,
+)
 
-# Client
-client = pymongo.MongoClient()
- 
 # Database
-db = client.__getattr__(DBNAME)
- 
+db = LazyDatabase(connection_manager)
+
 # Address list collection
 state_col = db.__getattr__("state")
 county_col = db.__getattr__("county")
@@ -40,17 +218,8 @@ zipcode_col = db.__getattr__("zipcode")
 street_col = db.__getattr__("street")
 
 # Address detail collection
-address_col_mapper = OrderedDict()
-for doc in state_col.find():
-    state = doc["key"]
-    address_col_mapper[state] = db.__getattr__(state)
-
-# MongoEngine
-conn_zillowdb = mongoengine.connect(
-    db = DBNAME,
-    alias = "default",
-    username=None, password=None, host="localhost", port=27017,
-)
+address_col_mapper = AddressCollectionMapper(db, state_col)
+
 
 def read_all_state():
     all_state = [doc["key"] for doc in state_col.find()]
@@ -65,6 +234,46 @@ if __name__ == "__main__":
     
     logger = create_zillow_crawler_logger()
     
+    def test_lazy_collection():
+        col = db.__getattr__("test_lazy")
+        assert isinstance(db["test_lazy"], LazyCollection)
+        assert repr(col) == "LazyCollection('test_lazy')"
+        assert not hasattr(col, "__len__")
+
+        col.delete_many({})
+        col.insert_one({"_id": 1})
+        assert col.collection.name == "test_lazy"
+        assert col.find_one({"_id": 1}) == {"_id": 1}
+
+        # resolved from the current client, survives a reconnect
+        client = connection_manager.client
+        connection_manager.reconnect()
+        assert connection_manager.client is not client
+        assert col.collection.database.client is connection_manager.client
+        col.drop()
+
+    test_lazy_collection()
+
+    def test_address_collection_mapper():
+        col = db.__getattr__("test_state")
+        col.delete_many({})
+        col.insert_one({"_id": "md/", "key": "md"})
+
+        mapper = AddressCollectionMapper(db, col)
+        assert list(mapper) == ["md", ]
+        assert mapper["md"].name == "md"
+
+        # states are cached until refresh
+        col.insert_one({"_id": "va/", "key": "va"})
+        assert len(mapper) == 1
+        assert "va" not in mapper
+        mapper.refresh()
+        assert len(mapper) == 2
+        assert mapper["va"].name == "va"
+        col.drop()
+
+    test_address_collection_mapper()
+
     def fix_dc():
         """
         1. find dc state in state_col, change _id, key to "dc", status to 0, 
@@ -77,13 +286,18 @@ if __name__ == "__main__":
 #     fix_dc()
     
     def browse_status():
+        """Print crawl progress from crawl stats, no collection is scanned.
+        """
         import prettytable
+        from zillowdb.crawl_stats import get_crawl_stats, STATUS_LIST
         
         t = prettytable.PrettyTable()
-        t.field_names = ["State", "Address Count"]
-        for state, col in address_col_mapper.items():
-            total = col.find().count()
-            t.add_row([state, total])
+        t.field_names = ["Level", "State", "Total"] + \
+            ["Status %s" % status for status in STATUS_LIST]
+        progress = get_crawl_stats().progress()
+        for (level, state), counter in sorted(progress.items()):
+            t.add_row([level, state, sum(counter.values())] + 
+                      [counter.get(status, 0) for status in STATUS_LIST])
         print(t)
             
 #     browse_status()
\ No newline at end of file
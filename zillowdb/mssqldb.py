@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 """
-
+Importing this module doesn't connect. The engine is created on first
+:func:`get_engine` call in each process, tables are created at the same time.
 """
 
+import os
+import threading
 from collections import OrderedDict
 
 import sqlalchemy
@@ -17,16 +20,11 @@ from sqlalchemy.sql import and_, or_, func
 from zillowdb import config
 from zillowdb.mongodb import address_col_mapper, read_all_state
 
-engine = create_engine("mssql+pymssql://%s:%s@%s/%s?charset=utf8" % (
-    config.MSSQLDB_USERNAME, config.MSSQLDB_PASSWORD, 
-    config.MSSQLDB_SERVER, config.MSSQLDB_DATABASE
-))
-
 metadata = MetaData()
 
 address_table_mapper = OrderedDict()
 
-# Create tables
+# Define tables
 # for state in read_all_state():
 for state in ["md", ]:
     t_name = "zillow_%s" % state
@@ -44,14 +42,58 @@ for state in ["md", ]:
     )
     address_table_mapper[state] = table
 
-metadata.create_all(engine)
+_engine = None
+_engine_pid = None
+_tables_created = False
+_engine_lock = threading.Lock()
+
+
+def get_engine(create_tables=True):
+    """Get the engine of current process, create it on first call. A forked
+    child process creates its own engine, connections of the parent are not
+    shared.
+
+    :param create_tables: create tables (only once) if they don't exist.
+    """
+    global _engine, _engine_pid, _tables_created
+    pid = os.getpid()
+    if _engine is None or _engine_pid != pid:
+        with _engine_lock:
+            if _engine is None or _engine_pid != pid:
+                _engine = create_engine(
+                    "mssql+pymssql://%s:%s@%s/%s?charset=utf8" % (
+                        config.MSSQLDB_USERNAME, config.MSSQLDB_PASSWORD,
+                        config.MSSQLDB_SERVER, config.MSSQLDB_DATABASE,
+                    ),
+                    pool_size=config.MSSQLDB_POOL_SIZE,
+                    max_overflow=config.MSSQLDB_MAX_OVERFLOW,
+                )
+                _engine_pid = pid
+    if create_tables and not _tables_created:
+        create_all(_engine)
+    return _engine
+
+
+def create_all(engine=None):
+    """Create all tables if they don't exist.
+    """
+    global _tables_created
+    if engine is None:
+        engine = get_engine(create_tables=False)
+    metadata.create_all(engine)
+    _tables_created = True
+
 
 if __name__ == "__main__":
     from zillowdb.packages.sfm import sqlalchemy_mate
     from zillowdb.packages.loggerFactory import StreamOnlyLogger
     
     def copy_data_from_mongodb_to_mssqldb():
+        """Single threaded copy of one state, :func:`zillowdb.etl.copy_all`
+        is the streaming, resumable version.
+        """
         logger = StreamOnlyLogger()
+        engine = get_engine()
         
         max_size = 1000
         
@@ -4,6 +4,14 @@
 """
 API Manager is a tools to help you manage multiple API Key. Choose the usable
 api key, and automatically archive the expired api key.
+
+Keys are handed out round-robin, skipping keys with too many requests in 
+flight, in O(1) time no matter how many keys are archived or busy. A key running out of daily quota is archived until the quota reset,
+a key with high error rate is archived for a cool down period, then they come 
+back automatically. All methods are thread safe.
+
+Keys are health checked concurrently, results are cached (optionally in a 
+json file) for a while, and can be re-checked periodically in background.
 """
 
 #- nameddict -
@@ -179,10 +187,14 @@ class ExceptionHavingDefaultMessage(Exception):
 
 
 #- API Manager -
+import os
 import sys
-import random
+import time
 import pprint
-from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 
 class NoAvailableAPIError(ExceptionHavingDefaultMessage):
@@ -197,6 +209,12 @@ class BaseApiKeyNotWorkingError(ExceptionHavingDefaultMessage):
     default_message = "This api key is not working!"
 
 
+class QuotaExceededError(ExceptionHavingDefaultMessage):
+    """Raised when API Key runs out of quota.
+    """
+    default_message = "This api key runs out of quota!"
+
+
 class BaseApiKey(Base):
 
     """An api key may have: access key, secret key, ... and arbitrary many
@@ -207,11 +225,14 @@ class BaseApiKey(Base):
     :params _api_manager: is bind to the :class:`APIManager` instance.
     :params _client: a variable bind to the client actually using this api key.
       self._client is the object doing real api call.
+    :params _daily_quota: number of calls allowed per quota period, None 
+      means use the default of :class:`APIManager`.
     """
     _primary_key = None
     _api_manager = None
     _client = None
-    __excludes__ = ["_primary_key", "_api_manager", "_client"]
+    _daily_quota = None
+    __excludes__ = ["_primary_key", "_api_manager", "_client", "_daily_quota"]
 
     def setup_client(self, *args, **kwargs):
         """A method that create an api client.
@@ -239,19 +260,98 @@ class BaseApiKey(Base):
         """
         return getattr(self, self._primary_key)
 
+    def cached_call(self, endpoint, key, func, **kwargs):
+        """Call ``func()`` through the response cache of the 
+        :class:`APIManager`, if it has one. ``kwargs`` are passed to 
+        ``get_or_call`` of the cache.
+
+        Usage::
+
+            >>> apikey.cached_call("geocode", address, 
+            ...                    lambda: apikey._client.geocode(address))
+        """
+        api_manager = self._api_manager
+        if api_manager is None or api_manager.response_cache is None:
+            return func()
+        return api_manager.response_cache.get_or_call(
+            endpoint, key, func, **kwargs)
+
 
 class APIManager(object):
 
     """API manager holds collection of :class:`BaseApiKey`. And 
 
     :param apikey_pool: list of :class:`BaseApiKey`
-    :param key_chain: ordered ``{apikey.primary_key: apikey}`` mapping
-    :param used_counter:
+    :param key_chain: ordered ``{apikey.primary_key: apikey}`` mapping of 
+      usable keys.
+    :param archived_key_chain: ordered ``{apikey.primary_key: apikey}`` 
+      mapping of archived keys.
+    :param used_counter: ``{apikey.primary_key: number of calls}`` in current
+      quota period.
+    :param daily_quota: default number of calls allowed per key per quota 
+      period, None means unlimited.
+    :param max_in_flight: max number of concurrent calls per key, None means
+      unlimited.
+    :param max_error_rate: a key is archived for ``error_cooldown`` seconds 
+      if its error rate (exponential moving average) exceeds this.
+    :param min_sample: error rate is not checked before this many calls.
+    :param reset_interval: seconds of a quota period.
+    :param reset_offset: quota resets at ``reset_offset`` seconds after every
+      ``reset_interval`` boundary of unix time, default is UTC midnight.
+    :param response_cache: optional response cache shared by keys, see 
+      :meth:`BaseApiKey.cached_call`, and 
+      :class:`zillowdb.packages.response_cache.ResponseCache`.
+    
+    Usage::
+    
+        >>> with api_manager.use() as apikey:
+        ...     ... # call api, raise QuotaExceededError if quota runs out
+    
+    **中文文档**
+    
+    线程安全的 API Key 调度器。按照轮询的方式分配 Key, 跳过正在进行的请求过多的
+    Key。额度用完的 Key 被归档, 到额度重置时自动恢复; 错误率过高的 Key 被归档一段
+    时间后自动恢复。
     """
-    def __init__(self, apikey_pool):
+    def __init__(self, apikey_pool,
+                 daily_quota=None,
+                 max_in_flight=None,
+                 max_error_rate=0.5,
+                 min_sample=10,
+                 error_cooldown=600,
+                 reset_interval=24 * 3600,
+                 reset_offset=0,
+                 response_cache=None):
         self.key_chain = OrderedDict()
         self.archived_key_chain = OrderedDict()
         self.used_counter = dict()
+        self.in_flight_counter = dict()
+        self.call_counter = dict()
+        self.error_rate = dict()
+        self.archived_until = dict()  # None means forever
+
+        self.daily_quota = daily_quota
+        self.max_in_flight = max_in_flight
+        self.max_error_rate = max_error_rate
+        self.min_sample = min_sample
+        self.error_cooldown = error_cooldown
+        self.reset_interval = reset_interval
+        self.reset_offset = reset_offset
+        self.response_cache = response_cache
+
+        # usable keys not at max_in_flight, in round-robin order. Archived
+        # keys are dropped lazily when they come to the front.
+        self._ring = deque()
+        self._in_ring = set()
+        self._lock = threading.RLock()
+        self.next_reset = self._next_reset(time.time())
+        self._next_restore = None
+
+        # health check
+        self.probe_cache = dict()  # {key: (is_working, checked_at)}
+        self._probe_failed = set()
+        self._health_check_thread = None
+        self._health_check_stop = threading.Event()
 
         for api_key in apikey_pool:
             api_key._api_manager = self
@@ -260,29 +360,304 @@ class APIManager(object):
 
             self.key_chain[key] = api_key
             self.used_counter[key] = 0
+            self.in_flight_counter[key] = 0
+            self.call_counter[key] = 0
+            self.error_rate[key] = 0.0
+            self._push(key)
+
+    def _next_reset(self, now):
+        n = (now - self.reset_offset) // self.reset_interval + 1
+        return n * self.reset_interval + self.reset_offset
+
+    def _key_of(self, apikey):
+        if isinstance(apikey, BaseApiKey):
+            return apikey.get_primary_key()
+        return apikey
+
+    def quota_of(self, key):
+        quota = self.key_chain.get(key, self.archived_key_chain.get(key))._daily_quota
+        if quota is None:
+            quota = self.daily_quota
+        return quota
+
+    def _push(self, key):
+        """Put a key back to the ring, unless it's there or it's busy.
+        """
+        if key in self._in_ring:
+            return
+        if self.max_in_flight is not None and \
+                self.in_flight_counter[key] >= self.max_in_flight:
+            return
+        self._in_ring.add(key)
+        self._ring.append(key)
+
+    def _archive(self, key, until):
+        if key in self.key_chain:
+            self.archived_key_chain[key] = self.key_chain.pop(key)
+        self.archived_until[key] = until
+        if until is not None and \
+                (self._next_restore is None or until < self._next_restore):
+            self._next_restore = until
+
+    def _restore(self, key):
+        self.key_chain[key] = self.archived_key_chain.pop(key)
+        self.archived_until.pop(key, None)
+        self.call_counter[key] = 0
+        self.error_rate[key] = 0.0
+        self._push(key)
+
+    def _maintain(self, now):
+        """Reset quota, restore archived keys in time.
+        """
+        if now >= self.next_reset:
+            for key in self.used_counter:
+                self.used_counter[key] = 0
+            self.next_reset = self._next_reset(now)
+        if self._next_restore is not None and now >= self._next_restore:
+            self._next_restore = None
+            for key, until in list(self.archived_until.items()):
+                if until is None:
+                    continue
+                if until <= now:
+                    self._restore(key)
+                elif self._next_restore is None or until < self._next_restore:
+                    self._next_restore = until
 
     def fetch_one(self):
-        try:
-            return self.key_chain[random.choice(list(self.key_chain))]
-        except IndexError:
+        """Take the next usable key round-robin, count one call on it. Call
+        :meth:`APIManager.release` after the api call is done.
+        """
+        with self._lock:
+            self._maintain(time.time())
+            while self._ring:
+                key = self._ring.popleft()
+                self._in_ring.discard(key)
+                if key not in self.key_chain:
+                    continue
+                quota = self.quota_of(key)
+                if quota is not None and self.used_counter[key] >= quota:
+                    self._archive(key, self.next_reset)
+                    continue
+                self.used_counter[key] += 1
+                self.in_flight_counter[key] += 1
+                # to the end of the ring, or out of it until released
+                self._push(key)
+                return self.key_chain[key]
             raise NoAvailableAPIError
 
-    def remove_one(self, key):
-        self.archived_key_chain[key] = self.key_chain.pop(key)
+    def release(self, apikey, success=True, quota_exceeded=False):
+        """Report the result of a call made with a key from 
+        :meth:`APIManager.fetch_one`.
+        """
+        key = self._key_of(apikey)
+        with self._lock:
+            self.in_flight_counter[key] = max(0, self.in_flight_counter[key] - 1)
+            if key in self.key_chain:
+                self._push(key)
+            if quota_exceeded:
+                self._archive(key, self.next_reset)
+                return
+
+            self.call_counter[key] += 1
+            alpha = 1.0 / min(self.call_counter[key], self.min_sample)
+            self.error_rate[key] += alpha * ((0.0 if success else 1.0) - self.error_rate[key])
+            if self.call_counter[key] >= self.min_sample and \
+                    self.error_rate[key] > self.max_error_rate and \
+                    key in self.key_chain:
+                self._archive(key, time.time() + self.error_cooldown)
+
+    @contextmanager
+    def use(self):
+        """Fetch a key, and release it with the result of the with block.
+        :class:`QuotaExceededError` archives the key until quota reset.
+        """
+        apikey = self.fetch_one()
+        try:
+            yield apikey
+        except QuotaExceededError:
+            self.release(apikey, success=False, quota_exceeded=True)
+            raise
+        except Exception:
+            self.release(apikey, success=False)
+            raise
+        else:
+            self.release(apikey, success=True)
+
+    def remove_one(self, key, until=None):
+        """Archive a key, until the ``until`` timestamp, None means forever.
+        """
+        with self._lock:
+            self._archive(self._key_of(key), until)
+
+    def stats(self):
+        with self._lock:
+            return {
+                key: {
+                    "used": self.used_counter[key],
+                    "in_flight": self.in_flight_counter[key],
+                    "error_rate": self.error_rate[key],
+                    "archived": key in self.archived_key_chain,
+                }
+                for key in self.used_counter
+            }
+
+    def load_probe_cache(self, path):
+        """Load health check results saved by :meth:`APIManager.check_usable`.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (EnvironmentError, ValueError):
+            return
+        with self._lock:
+            for key, (is_working, checked_at) in data.items():
+                if key in self.used_counter:
+                    self.probe_cache[key] = (is_working, checked_at)
+
+    def dump_probe_cache(self, path):
+        with self._lock:
+            data = dict(self.probe_cache)
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        try:
+            os.replace(tmp_path, path)
+        except AttributeError:  # python2
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+
+    def _probe_all(self, apikey_list, n_worker, timeout):
+        """Call ``is_working()`` of keys in a thread pool, a probe not 
+        finished in ``timeout`` seconds is failed. Return ``{key: bool}``.
+        """
+        result = dict()
+        started_at = dict()
 
-    def check_usable(self):
-        for key, apikey in self.key_chain.items():
-            if not apikey.is_working():
-                self.remove_one(key)
+        def probe(key, apikey):
+            started_at[key] = time.time()
+            try:
+                return bool(apikey.is_working())
+            except Exception:
+                return False
 
-        if len(self.key_chain) == 0:
-            sys.stderr.write("\nThere's no API Key usable!")
-        elif len(self.archived_key_chain) == 0:
-            sys.stderr.write("\nAll API Key are usable.")
-        else:
-            sys.stderr.write("\nThese keys are not usable:")
-            for key in self.archived_key_chain:
-                sys.stderr.write("\n    %s" % key)
+        executor = ThreadPoolExecutor(max_workers=n_worker)
+        try:
+            pending = dict()
+            for key, apikey in apikey_list:
+                pending[executor.submit(probe, key, apikey)] = key
+            while pending:
+                done, _ = wait(
+                    list(pending), timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result[pending.pop(future)] = future.result()
+                now = time.time()
+                for future, key in list(pending.items()):
+                    st = started_at.get(key)
+                    if st is not None and now - st > timeout:
+                        result[pending.pop(future)] = False
+        finally:
+            # don't wait for a hung probe
+            executor.shutdown(wait=False)
+        return result
+
+    def check_usable(self, n_worker=8, timeout=30, ttl=3600, cache_path=None,
+                     verbose=True):
+        """Check all keys concurrently, archive keys not working, restore 
+        keys working again.
+
+        :param n_worker: max number of concurrent probes.
+        :param timeout: seconds, a probe taking longer is failed.
+        :param ttl: seconds a result is trusted without probing again.
+        :param cache_path: if given, results are loaded from and saved to 
+          this json file, so a restart within ``ttl`` skips probing.
+        :returns: ``{key: is_working}`` of checked keys.
+
+        **中文文档**
+
+        使用线程池并发地检测所有 Key, 每个检测有超时时间。检测结果在 ``ttl`` 秒内
+        有效, 可以保存在文件中, 在此时间内重启不需要重新检测。
+        """
+        if cache_path is not None:
+            self.load_probe_cache(cache_path)
+
+        now = time.time()
+        result = dict()
+        todo = list()
+        with self._lock:
+            # probe a snapshot, key_chain may change meanwhile
+            candidates = list(self.key_chain.items()) + [
+                (key, self.archived_key_chain[key])
+                for key in self._probe_failed if key in self.archived_key_chain
+            ]
+            for key, apikey in candidates:
+                cached = self.probe_cache.get(key)
+                if cached is not None and now - cached[1] <= ttl:
+                    result[key] = cached[0]
+                else:
+                    todo.append((key, apikey))
+
+        if todo:
+            probed = self._probe_all(todo, n_worker, timeout)
+            now = time.time()
+            with self._lock:
+                for key, is_working in probed.items():
+                    self.probe_cache[key] = (is_working, now)
+            result.update(probed)
+            if cache_path is not None:
+                self.dump_probe_cache(cache_path)
+
+        with self._lock:
+            for key, is_working in result.items():
+                if is_working:
+                    if key in self._probe_failed:
+                        self._probe_failed.discard(key)
+                        if key in self.archived_key_chain and \
+                                self.archived_until.get(key) is None:
+                            self._restore(key)
+                elif key in self.key_chain:
+                    self._probe_failed.add(key)
+                    self._archive(key, None)
+
+        if verbose:
+            if len(self.key_chain) == 0:
+                sys.stderr.write("\nThere's no API Key usable!")
+            elif len(self.archived_key_chain) == 0:
+                sys.stderr.write("\nAll API Key are usable.")
+            else:
+                sys.stderr.write("\nThese keys are not usable:")
+                for key in list(self.archived_key_chain):
+                    sys.stderr.write("\n    %s" % key)
+        return result
+
+    def start_health_check(self, interval=3600, **kwargs):
+        """Re-check keys every ``interval`` seconds in a daemon thread. 
+        ``kwargs`` are passed to :meth:`APIManager.check_usable`.
+        """
+        if self._health_check_thread is not None and \
+                self._health_check_thread.is_alive():
+            return
+        kwargs.setdefault("ttl", interval)
+        kwargs.setdefault("verbose", False)
+        self._health_check_stop.clear()
+
+        def run():
+            while not self._health_check_stop.wait(interval):
+                try:
+                    self.check_usable(**kwargs)
+                except Exception:
+                    sys.stderr.write("\n%s" % get_last_exc_info())
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._health_check_thread = thread
+
+    def stop_health_check(self):
+        self._health_check_stop.set()
+        if self._health_check_thread is not None:
+            self._health_check_thread.join()
+            self._health_check_thread = None
 
     def __repr__(self):
         return pprint.pformat(list(self.key_chain.items()))
@@ -292,6 +667,10 @@ class APIManager(object):
 if __name__ == "__main__":
     from geopy.geocoders import GoogleV3
     from geopy.exc import GeocoderQuotaExceeded
+    try:
+        from .response_cache import ResponseCache
+    except:
+        from response_cache import ResponseCache
     
     def test_APIManager():
         class MyApiKey(BaseApiKey):
@@ -306,6 +685,125 @@ if __name__ == "__main__":
         
     test_APIManager()
     
+    def test_scheduler():
+        class MyApiKey(BaseApiKey):
+            _primary_key = "key"
+        
+        api_manager = APIManager(apikey_pool=[
+            MyApiKey(key="a"), MyApiKey(key="b"),
+        ], daily_quota=2, max_in_flight=1)
+        
+        # round robin, in flight limit
+        k1, k2 = api_manager.fetch_one(), api_manager.fetch_one()
+        assert {k1.key, k2.key} == {"a", "b"}
+        try:
+            api_manager.fetch_one()
+            assert False
+        except NoAvailableAPIError:
+            pass
+        api_manager.release(k1)
+        api_manager.release(k2)
+        
+        # quota exceeded, restored at quota reset
+        with api_manager.use() as apikey:
+            pass
+        try:
+            with api_manager.use() as apikey:
+                raise QuotaExceededError
+        except QuotaExceededError:
+            pass
+        try:
+            api_manager.fetch_one()
+            assert False
+        except NoAvailableAPIError:
+            pass
+        assert len(api_manager.archived_key_chain) == 2
+        
+        # time goes to quota reset
+        api_manager._maintain(api_manager.next_reset)
+        assert len(api_manager.key_chain) == 2
+        with api_manager.use() as apikey:
+            pass
+        
+    test_scheduler()
+    
+    def test_ring():
+        class MyApiKey(BaseApiKey):
+            _primary_key = "key"
+        
+        api_manager = APIManager(apikey_pool=[
+            MyApiKey(key=key) for key in "abcd"
+        ], max_in_flight=1)
+        
+        # busy key is out of the ring, back after release
+        a = api_manager.fetch_one()
+        assert a.key == "a"
+        assert list(api_manager._ring) == ["b", "c", "d"]
+        api_manager.release(a)
+        assert list(api_manager._ring) == ["b", "c", "d", "a"]
+        
+        # archived key is dropped when it comes to the front
+        api_manager.remove_one("b")
+        c = api_manager.fetch_one()
+        assert c.key == "c"
+        assert list(api_manager._ring) == ["d", "a"]
+        
+        # restored key is not duplicated, busy key is not put back to ring
+        api_manager.remove_one("d", until=1)
+        api_manager.remove_one("c", until=1)
+        api_manager._maintain(time.time())
+        assert sorted(api_manager.key_chain) == ["a", "c", "d"]
+        assert sorted(api_manager._ring) == ["a", "d"]
+        assert [api_manager.fetch_one().key for _ in range(2)] == ["d", "a"]
+        try:
+            api_manager.fetch_one()
+            assert False
+        except NoAvailableAPIError:
+            pass
+        api_manager.release(c)
+        assert api_manager.fetch_one().key == "c"
+        
+    test_ring()
+    
+    def test_check_usable():
+        import tempfile
+        
+        class MyApiKey(BaseApiKey):
+            _primary_key = "key"
+            n_probe = 0
+            
+            def is_working(self):
+                MyApiKey.n_probe += 1
+                time.sleep(0.2)
+                return self.key != "b"
+        
+        cache_path = os.path.join(tempfile.mkdtemp(), "probe.json")
+        api_manager = APIManager(apikey_pool=[
+            MyApiKey(key=key) for key in "abcdefgh"
+        ])
+        st = time.time()
+        api_manager.check_usable(n_worker=8, cache_path=cache_path, verbose=False)
+        assert time.time() - st < 1.0 # concurrent
+        assert list(api_manager.archived_key_chain) == ["b"]
+        
+        # restart, results are cached
+        api_manager = APIManager(apikey_pool=[
+            MyApiKey(key=key) for key in "abcdefgh"
+        ])
+        api_manager.check_usable(cache_path=cache_path, verbose=False)
+        assert MyApiKey.n_probe == 8
+        assert list(api_manager.archived_key_chain) == ["b"]
+        
+        # probe timeout
+        api_manager.check_usable(timeout=0.05, ttl=0, verbose=False)
+        assert len(api_manager.key_chain) == 0
+        
+        # come back when working again
+        api_manager.check_usable(ttl=0, verbose=False)
+        assert list(api_manager.archived_key_chain) == ["b"]
+        
+    test_check_usable()
+    
 
     class GoogleBaseApiKey(BaseApiKey):
         _primary_key = "key"
@@ -347,7 +845,11 @@ if __name__ == "__main__":
             apikey.setup_client()
             apikey_pool.append(apikey)
         
-        api_manager = APIManager(apikey_pool=apikey_pool)
+        api_manager = APIManager(
+            apikey_pool=apikey_pool,
+            response_cache=ResponseCache(
+                "geocode_cache.sqlite3", ttl={"geocode": 30 * 24 * 3600}),
+        )
         api_manager.check_usable()
         
         # Put many address here
@@ -360,15 +862,23 @@ if __name__ == "__main__":
             # Fetch one key, if no key is usable an exception will be raised
             apikey = api_manager.fetch_one()
             try:
-                # do geocoding
-                location = apikey.client.geocode(task, exactly_one=True)
-                if location:
-                    pprint.pprint(location.raw)
+                # do geocoding, repeated address doesn't cost quota
+                def geocode():
+                    location = apikey.client.geocode(todo, exactly_one=True)
+                    if location:
+                        return location.raw
+                
+                raw = apikey.cached_call(
+                    "geocode", todo, geocode, 
+                    is_negative=lambda raw: raw is None,
+                )
+                if raw:
+                    pprint.pprint(raw)
                 else:
                     pass
             except GeocoderQuotaExceeded:
-                # this key is no longer usable
-                api_manager.remove_one(apikey.key)
+                # this key is no longer usable until quota reset
+                api_manager.release(apikey, quota_exceeded=True)
             except Exception as e:
                 print(repr(e))
     
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio version of :class:`crawlib.spider.Spider`, built on ``aiohttp``.
+Requires Python3.5+.
+
+**中文文档**
+
+基于 asyncio 和 aiohttp 的异步爬虫。一个进程可以同时维持大量的请求, 而不需要
+为每个连接开一个线程。解码逻辑和 :class:`~crawlib.spider.Spider` 一致, 同一个
+域名的编码只检测一次。
+"""
+
+import os
+import asyncio
+import aiohttp
+
+try:
+    from .spider import (
+        BROWSER_HEADERS, BLOCKED_STATUS_CODE, NotDownloadError,
+        get_domain_name, decode_html,
+    )
+    from .decoder import EncodingCache
+except:
+    from crawlib.spider import (
+        BROWSER_HEADERS, BLOCKED_STATUS_CODE, NotDownloadError,
+        get_domain_name, decode_html,
+    )
+    from crawlib.decoder import EncodingCache
+
+
+class AsyncSpider(object):
+
+    """An asyncio spider. Methods are coroutines:
+
+    - :meth:`AsyncSpider.get_binary`
+    - :meth:`AsyncSpider.get_html`
+    - :meth:`AsyncSpider.download`
+
+    All requests share one ``aiohttp.ClientSession`` (one connection pool),
+    and requests to the same domain are bounded by a per-domain semaphore.
+
+    :param default_timeout: in any method making http request, if timeout
+      keyword is not explicitly given, then use default value.
+    :param default_sleeptime: in any method making http request, sleep for
+      short period of time before making request.
+    :param limit: max number of open connections in total.
+    :param limit_per_domain: max number of requests in flight per domain.
+    :param limiter: optional :class:`~crawlib.ratelimit.RateLimiter`, if
+      given, it replaces ``default_sleeptime``.
+    :param identity: second key of the limiter.
+    :param report_success: if False, a good http response is not reported to
+      the limiter, the caller reports it after checking the content.
+    """
+
+    def __init__(self, default_headers=None, default_timeout=None, default_sleeptime=0.0,
+                 limit=1000, limit_per_domain=100, limiter=None, identity=None,
+                 report_success=True):
+        self.default_headers = default_headers
+        self.default_timeout = default_timeout
+        self.default_sleeptime = default_sleeptime
+        self.limit = limit
+        self.limit_per_domain = limit_per_domain
+        self.limiter = limiter
+        self.identity = identity
+        self.report_success = report_success
+        self.domain_encoding_table = EncodingCache()
+        self.domain_semaphore_table = dict()
+        self._session = None
+
+    def i_am_browser(self):
+        self.default_headers = dict(BROWSER_HEADERS)
+
+    def get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def get_semaphore(self, url):
+        domain_name = get_domain_name(url)
+        try:
+            return self.domain_semaphore_table[domain_name]
+        except KeyError:
+            semaphore = asyncio.Semaphore(self.limit_per_domain)
+            self.domain_semaphore_table[domain_name] = semaphore
+            return semaphore
+
+    def _request_kwargs(self, headers, timeout):
+        if headers is None:
+            headers = self.default_headers
+        if headers is not None:
+            # aiohttp doesn't accept None as header value
+            headers = {
+                key: value for key, value in headers.items()
+                if value is not None
+            }
+        if timeout is None:
+            timeout = self.default_timeout
+        return {
+            "headers": headers,
+            "timeout": aiohttp.ClientTimeout(total=timeout),
+        }
+
+    async def _throttle(self, url):
+        if self.limiter is None:
+            await asyncio.sleep(self.default_sleeptime)
+        else:
+            await asyncio.sleep(
+                self.limiter.reserve(get_domain_name(url), self.identity))
+
+    def _report(self, url, status_code):
+        if self.limiter is None:
+            return
+        keys = (get_domain_name(url), self.identity)
+        if status_code is None \
+                or status_code in BLOCKED_STATUS_CODE or status_code >= 500:
+            self.limiter.on_error(*keys)
+        elif self.report_success:
+            self.limiter.on_success(*keys)
+
+    async def close(self):
+        """Close the connection pool.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _get(self, url, headers=None, timeout=None):
+        """Return binary data and Content-Type header of an url.
+        """
+        kwargs = self._request_kwargs(headers, timeout)
+        async with self.get_semaphore(url):
+            await self._throttle(url)
+
+            # Exception may raises
+            try:
+                async with self.get_session().get(url, **kwargs) as response:
+                    binary = await response.read()
+                    content_type = response.headers.get("Content-Type")
+            except Exception:
+                self._report(url, None)
+                raise
+            self._report(url, response.status)
+        return binary, content_type
+
+    async def get_binary(self, url, headers=None, timeout=None):
+        """Get binary data of an url.
+        """
+        binary, _ = await self._get(url, headers=headers, timeout=timeout)
+        return binary
+
+    def decode(self, url, binary, encoding=None, errors="strict",
+               content_type=None):
+        """Decode binary content of an url, if encoding is not given, use
+        the charset in ``content_type``, or the cached encoding of this
+        domain, or detect it.
+        """
+        return decode_html(url, binary, self.domain_encoding_table,
+                           encoding=encoding, errors=errors,
+                           content_type=content_type)
+
+    async def get_html(self, url, headers=None, timeout=None, encoding=None, errors="strict"):
+        """Get html source in text.
+
+        :param url: url you want to crawl
+        :param timeout: time out time in second
+        :param encoding: if not given, the encoding will be auto-detected
+        :param strict: options "ignore", "strict"; encoding error parameter
+        """
+        binary, content_type = await self._get(
+            url, headers=headers, timeout=timeout)
+        return self.decode(url, binary, encoding=encoding, errors=errors,
+                           content_type=content_type)
+
+    async def download(self, url, dst, timeout=None,
+                       minimal_size=-1, maximum_size=1024**3):
+        """Download binary content to destination.
+
+        :param url: binary content url
+        :param dst: path to the 'save_as' file
+        :param timeout: time out time in second
+        :param minimal_size: default -1, if response content smaller than
+          minimal_size, then delete what just download.
+        :param maximum_size: default 1GB, if response content greater than
+          maximum_size, then delete what just download.
+        """
+        kwargs = self._request_kwargs(None, timeout)
+        chunk_size = 1024
+        downloaded = 0
+        async with self.get_semaphore(url):
+            await self._throttle(url)
+
+            # Exception may raises
+            try:
+                async with self.get_session().get(url, **kwargs) as response:
+                    with open(dst, "wb") as f:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                            downloaded += len(chunk)
+            except Exception:
+                self._report(url, None)
+                raise
+            self._report(url, response.status)
+
+        if downloaded < minimal_size or downloaded > maximum_size:
+            try:
+                os.remove(dst)
+            except:
+                pass
+            raise NotDownloadError(url)
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import tempfile
+    from zillowdb.fixture_site import FixtureSite
+
+    try:
+        from .ratelimit import RateLimiter
+    except:
+        from crawlib.ratelimit import RateLimiter
+
+    class RecordLimiter(RateLimiter):
+        def __init__(self, **kwargs):
+            super(RecordLimiter, self).__init__(**kwargs)
+            self.events = list()
+
+        def on_success(self, *keys):
+            super(RecordLimiter, self).on_success(*keys)
+            self.events.append("success")
+
+        def on_error(self, *keys, **kwargs):
+            super(RecordLimiter, self).on_error(*keys, **kwargs)
+            self.events.append("error")
+
+    def run(coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_get_html():
+        async def main(site):
+            async with AsyncSpider() as spider:
+                urls = [site.base_url + "/browse/homes/",
+                        site.base_url + "/browse/homes/s1/"]
+                htmls = await asyncio.gather(*[spider.get_html(url) for url in urls])
+                assert '"/browse/homes/s0/"' in htmls[0]
+                assert '"/browse/homes/s1/c0-county/"' in htmls[1]
+
+        with FixtureSite(fanout=(2, 2, 2, 2, 2)) as site:
+            run(main(site))
+
+    test_get_html()
+
+    def test_download():
+        class HeaderSpider(AsyncSpider):
+            sent_headers = list()
+
+            def get_session(self):
+                session = super(HeaderSpider, self).get_session()
+                sent_headers = self.sent_headers
+
+                class Session(object):
+                    def get(self, url, **kwargs):
+                        sent_headers.append(kwargs["headers"])
+                        return session.get(url, **kwargs)
+
+                return Session()
+
+        async def main(site, dst):
+            async with HeaderSpider() as spider:
+                spider.i_am_browser()
+                url = site.base_url + "/browse/homes/s0/"
+                await spider.download(url, dst)
+                assert os.path.getsize(dst) > 0
+                assert spider.sent_headers[-1]["User-Agent"] == \
+                    BROWSER_HEADERS["User-Agent"]
+
+                try:
+                    await spider.download(url, dst, minimal_size=1024**2)
+                    assert False
+                except NotDownloadError:
+                    pass
+                assert not os.path.exists(dst)
+
+        dst = os.path.join(tempfile.mkdtemp(), "s0.html")
+        with FixtureSite(fanout=(2, 2, 2, 2, 2)) as site:
+            run(main(site, dst))
+        os.rmdir(os.path.dirname(dst))
+
+    test_download()
+
+    def test_report():
+        async def main(site, dst):
+            limiter = RecordLimiter(rate=1000.0, backoff_base=0.001)
+            async with AsyncSpider(limiter=limiter) as spider:
+                await spider.download(site.base_url + "/browse/homes/", dst)
+                assert limiter.events == ["success"]
+
+                # connection refused
+                try:
+                    await spider.download("http://127.0.0.1:1/", dst)
+                    assert False
+                except aiohttp.ClientError:
+                    pass
+                assert limiter.events == ["success", "error"]
+
+            limiter = RecordLimiter(rate=1000.0, backoff_base=0.001)
+            async with AsyncSpider(limiter=limiter,
+                                   report_success=False) as spider:
+                await spider.get_html(site.base_url + "/browse/homes/")
+                await spider.download(site.base_url + "/browse/homes/", dst)
+                assert limiter.events == list()
+
+        dst = os.path.join(tempfile.mkdtemp(), "homes.html")
+        with FixtureSite(fanout=(2, 2, 2, 2, 2)) as site:
+            run(main(site, dst))
+        os.remove(dst)
+        os.rmdir(os.path.dirname(dst))
+
+    test_report()
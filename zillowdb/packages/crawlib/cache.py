@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+On-disk html cache.
+
+A page is stored in a file named by the fingerprint of its normalized url,
+under sharded directories (``root/ab/cd/abcd....z``), so no directory holds
+too many files. The file is the zlib compressed ``url + "\\n" + html``, the
+url is kept so cached pages can be re-parsed without knowing the url.
+
+Entries older than ``ttl`` are expired, and when the total size exceeds
+``max_size``, least recently used entries are evicted.
+
+**中文文档**
+
+将抓取到的 html 压缩后保存在本地。当解析代码有 bug 或者数据结构发生变化时, 可以
+直接从缓存中重新解析, 而不需要再次访问网站。文件名是标准化后的 url 的指纹, 按照
+指纹的前几位分目录存放。支持过期时间, 以及按最近使用时间淘汰, 控制总大小。
+"""
+
+import os
+import mmap
+import time
+import threading
+
+try:
+    from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+except:
+    from urlparse import urlparse, urlunparse, parse_qsl
+    from urllib import urlencode
+
+try:
+    from ..sfm.fingerprint import fingerprint
+    from ..dataIO.compress import compress_bytes, decompress_bytes
+except:
+    from sfm.fingerprint import fingerprint
+    from dataIO.compress import compress_bytes, decompress_bytes
+
+
+DEFAULT_PORT = {"http": "80", "https": "443"}
+
+
+class CacheMiss(Exception):
+
+    """Page is not in cache, and spider is in ``cache_only`` mode.
+    """
+
+
+def normalize_url(url):
+    """Normalize an url, so the same page always has the same cache key:
+    lower case scheme and host, remove default port and fragment, sort
+    query parameters.
+
+    For example: ``HTTP://www.Zillow.com:80/browse?b=2&a=1#top`` =>
+    ``http://www.zillow.com/browse?a=1&b=2``
+    """
+    result = urlparse(url.strip())
+    scheme = result.scheme.lower()
+    netloc = result.netloc.lower()
+    if ":" in netloc:
+        host, port = netloc.rsplit(":", 1)
+        if DEFAULT_PORT.get(scheme) == port:
+            netloc = host
+    path = result.path or "/"
+    query = urlencode(sorted(parse_qsl(result.query, keep_blank_values=True)))
+    return urlunparse((scheme, netloc, path, result.params, query, ""))
+
+
+class HtmlCache(object):
+
+    """Compressed html cache on local disk. Thread safe, and can be shared by
+    processes, a file is written to a temp file then renamed.
+
+    Usage::
+
+        >>> cache = HtmlCache("/tmp/html_cache", ttl=30 * 24 * 3600)
+        >>> html = cache.fetch(url, spider.get_html)
+
+    :param root: cache directory, created on first :meth:`HtmlCache.set`.
+    :param ttl: seconds an entry is valid, None means forever.
+    :param max_size: max total bytes of cache files, None means unlimited.
+      When exceeded, least recently used entries are removed until total size
+      is under ``max_size * low_watermark``.
+    :param shard_depth: number of levels of sub directories.
+    :param level: zlib compress level.
+    :param reject: optional callable, ``html -> bool``, pages it returns True
+      are not cached, e.g. captcha page.
+    """
+
+    def __init__(self, root, ttl=None, max_size=None, shard_depth=2,
+                 level=6, low_watermark=0.9, reject=None):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.shard_depth = shard_depth
+        self.level = level
+        self.low_watermark = low_watermark
+        self.reject = reject
+        self.n_hit = 0
+        self.n_miss = 0
+        self._size = None
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def key_of(self, url):
+        return fingerprint.of_text(normalize_url(url))
+
+    def path_of(self, url):
+        key = self.key_of(url)
+        parts = [key[i * 2: i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.root, *(parts + [key + ".z"]))
+
+    def _is_expired(self, stat, now):
+        return self.ttl is not None and now - stat.st_mtime > self.ttl
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def read_file(path):
+        """Read a cache file, return ``(url, html)``. The file is memory
+        mapped, so it's not copied to a python bytes before decompress.
+        """
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):  # empty file
+                data = decompress_bytes(f.read())
+            else:
+                try:
+                    data = decompress_bytes(mm)
+                finally:
+                    mm.close()
+        url, html = data.split(b"\n", 1)
+        return url.decode("utf-8"), html.decode("utf-8")
+
+    def get(self, url):
+        """Return cached html, or None if not cached or expired.
+        """
+        path = self.path_of(url)
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            if self._is_expired(stat, now):
+                self._remove(path)
+                html = None
+            else:
+                html = self.read_file(path)[1]
+                # access time is the LRU clock, set it explicitly because
+                # file system may be mounted with noatime
+                os.utime(path, (now, stat.st_mtime))
+        except EnvironmentError:
+            html = None
+
+        with self._lock:
+            if html is None:
+                self.n_miss += 1
+            else:
+                self.n_hit += 1
+        return html
+
+    def set(self, url, html):
+        """Cache html of an url, return False if it's rejected.
+        """
+        if self.reject is not None and self.reject(html):
+            return False
+
+        path = self.path_of(url)
+        payload = compress_bytes(
+            url.encode("utf-8") + b"\n" + html.encode("utf-8"), self.level)
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:  # created by other thread or process
+                pass
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        tmp_path = "%s.%s-%s.tmp" % (
+            path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        try:
+            os.replace(tmp_path, path)
+        except AttributeError:  # python2
+            self._remove(path)
+            os.rename(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(payload) - old_size
+            over = self.max_size is not None and \
+                (self._size is None or self._size > self.max_size)
+        if over:
+            self.evict()
+        return True
+
+    def delete(self, url):
+        return self._remove(self.path_of(url))
+
+    def fetch(self, url, fetcher, cache_only=False, refresh=False):
+        """Return cached html of an url, if not cached, get it by
+        ``fetcher(url)`` and cache it. If ``fetcher`` raises, nothing is
+        cached.
+
+        :param cache_only: if True, raise :class:`CacheMiss` instead of
+          calling ``fetcher``.
+        :param refresh: if True, ignore cached html, call ``fetcher`` and
+          replace it, e.g. retry a page failed to parse.
+        """
+        html = None if refresh else self.get(url)
+        if html is None:
+            if cache_only:
+                raise CacheMiss(url)
+            html = fetcher(url)
+            self.set(url, html)
+        return html
+
+    def iter_files(self):
+        """Yield path of all cache files.
+        """
+        for dir_path, _, basename_list in os.walk(self.root):
+            for basename in basename_list:
+                if basename.endswith(".z"):
+                    yield os.path.join(dir_path, basename)
+
+    def iter_items(self):
+        """Yield ``(url, html)`` of all not expired entries.
+        """
+        now = time.time()
+        for path in self.iter_files():
+            try:
+                if self._is_expired(os.stat(path), now):
+                    continue
+                yield self.read_file(path)
+            except EnvironmentError:
+                continue
+
+    def evict(self):
+        """Remove expired entries, then remove least recently used entries
+        if total size exceeds ``max_size``. Return number of removed entries.
+        """
+        with self._evict_lock:
+            now = time.time()
+            n_removed = 0
+            entries = list()
+            total = 0
+            for path in self.iter_files():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if self._is_expired(stat, now):
+                    n_removed += self._remove(path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, path))
+                    total += stat.st_size
+
+            if self.max_size is not None and total > self.max_size:
+                target = self.max_size * self.low_watermark
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    if self._remove(path):
+                        n_removed += 1
+                        total -= size
+
+            with self._lock:
+                self._size = total
+            return n_removed
+
+    def size(self):
+        """Total bytes of cache files.
+        """
+        with self._lock:
+            if self._size is not None:
+                return self._size
+        total = 0
+        for path in self.iter_files():
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total
+        return total
+
+    def hit_rate(self):
+        total = self.n_hit + self.n_miss
+        if total:
+            return self.n_hit / float(total)
+        return 0.0
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import shutil
+    import binascii
+    import tempfile
+
+    def test_normalize_url():
+        assert normalize_url("HTTP://www.Zillow.com:80/browse?b=2&a=1#top") == \
+            "http://www.zillow.com/browse?a=1&b=2"
+        assert normalize_url("https://www.zillow.com") == \
+            "https://www.zillow.com/"
+
+    test_normalize_url()
+
+    def test_html_cache():
+        tmp_dir = tempfile.mkdtemp()
+        root = os.path.join(tmp_dir, "html_cache")
+        try:
+            cache = HtmlCache(root, max_size=20000)
+            url = "https://www.zillow.com/browse/homes/md/"
+            assert cache.get(url) is None
+            assert list(cache.iter_items()) == []
+            assert not os.path.exists(root)
+            assert cache.fetch(url, lambda url: u"<html>中文</html>") == \
+                u"<html>中文</html>"
+            assert cache.get(url + "#top") == u"<html>中文</html>"
+            assert list(cache.iter_items()) == [(url, u"<html>中文</html>")]
+
+            try:
+                cache.fetch(url + "ca/", None, cache_only=True)
+                assert False
+            except CacheMiss:
+                pass
+
+            # LRU eviction, random html doesn't compress
+            for i in range(10):
+                cache.set("%s%s/" % (url, i),
+                          binascii.hexlify(os.urandom(2000)).decode())
+            assert cache.size() <= 20000
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    test_html_cache()
@@ -3,23 +3,236 @@
 
 """
 This module provide extended power to decode HTML you crawled.
+
+Encoding is detected from cheap to expensive:
+
+1. byte order mark.
+2. charset in http ``Content-Type`` header.
+3. ``<meta charset>`` in the first few KB of html.
+4. ``chardet`` on a bounded sample of the body.
+
+**中文文档**
+
+按照从快到慢的顺序检测编码: BOM, http 头中的 charset, html 开头的 meta 标签,
+最后才对一部分内容使用 chardet。
 """
 
+import re
+import codecs
+import threading
+
 import chardet
 
+#: only this many bytes are searched for ``<meta charset>``
+META_SNIFF_SIZE = 4096
+#: only this many bytes are fed to chardet
+CHARDET_SAMPLE_SIZE = 16 * 1024
+
+_content_type_charset = re.compile(r"""charset\s*=\s*["']?([\w.:-]+)""", re.I)
+_meta_charset = re.compile(
+    br"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.I)
+
+_bom_list = [
+    # utf-32 first, BOM_UTF32_LE starts with BOM_UTF16_LE
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def normalize_encoding(encoding):
+    """Return python codec name of an encoding, or None if it's unknown.
+    """
+    if not encoding:
+        return None
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode("ascii", "ignore")
+    try:
+        return codecs.lookup(encoding.strip().lower()).name
+    except LookupError:
+        return None
+
+
+def bom_safe(encoding):
+    """``"utf-8"`` => ``"utf-8-sig"``, it decodes the same, and drops a
+    leading BOM, many servers send one with ``charset=utf-8``.
+    """
+    if encoding == "utf-8":
+        return "utf-8-sig"
+    return encoding
+
+
+def charset_from_bom(binary):
+    for bom, encoding in _bom_list:
+        if binary.startswith(bom):
+            return encoding
+    return None
+
+
+def charset_from_content_type(content_type):
+    """``"text/html; charset=UTF-8"`` => ``"utf-8"``
+    """
+    if not content_type:
+        return None
+    match = _content_type_charset.search(content_type)
+    if match is None:
+        return None
+    return normalize_encoding(match.group(1))
+
+
+def charset_from_meta(binary, sniff_size=META_SNIFF_SIZE):
+    """Find ``<meta charset="...">`` or ``<meta http-equiv="Content-Type"
+    content="...; charset=...">`` in the first ``sniff_size`` bytes.
+    """
+    match = _meta_charset.search(binary[:sniff_size])
+    if match is None:
+        return None
+    return normalize_encoding(match.group(1))
+
+
+def detect_encoding(binary, content_type=None, sample_size=CHARDET_SAMPLE_SIZE):
+    """Detect encoding of html, from cheap to expensive.
+
+    :returns: ``(encoding, confidence)``.
+    """
+    encoding = charset_from_bom(binary)
+    if encoding is not None:
+        return encoding, 1.0
+
+    encoding = charset_from_content_type(content_type)
+    if encoding is not None:
+        return encoding, 0.95
+
+    encoding = charset_from_meta(binary)
+    if encoding is not None:
+        return encoding, 0.9
+
+    d = chardet.detect(binary[:sample_size])
+    encoding = normalize_encoding(d["encoding"]) or "utf-8"
+    return encoding, d["confidence"] or 0.0
+
 
-def smart_decode(binary, errors="strict"):
-    d = chardet.detect(binary)
-    encoding = d["encoding"]
-    confidence = d["confidence"]
-    text = binary.decode(encoding, errors=errors)
+def smart_decode(binary, errors="strict", content_type=None,
+                 sample_size=CHARDET_SAMPLE_SIZE):
+    """Detect encoding and decode. If the cheap guess can't decode, fall back
+    to ``chardet`` on the full body.
+
+    With ``errors="ignore"`` or ``"replace"`` the guess never fails to
+    decode, so there's no fallback, a wrong guess loses characters silently.
+
+    :returns: ``(text, encoding, confidence)``.
+    """
+    encoding, confidence = detect_encoding(
+        binary, content_type=content_type, sample_size=sample_size)
+    try:
+        text = binary.decode(encoding, errors=errors)
+    except UnicodeDecodeError:
+        d = chardet.detect(binary)
+        encoding = normalize_encoding(d["encoding"]) or "utf-8"
+        confidence = d["confidence"] or 0.0
+        text = binary.decode(encoding, errors=errors)
     return text, encoding, confidence
 
 
+class EncodingCache(object):
+
+    """Confidence weighted encoding cache of domains.
+
+    Every detection votes for an encoding with its confidence. The cached
+    encoding of a domain is trusted only when its votes reach
+    ``min_weight``, so one low-confidence chardet guess doesn't decide a
+    domain forever. When a trusted encoding fails to decode a page, call
+    :meth:`EncodingCache.invalidate`, the domain is detected again.
+
+    **中文文档**
+
+    按域名缓存编码。每次检测按照置信度为编码投票, 票数足够时才使用缓存。解码失败
+    时清除该编码的票数, 重新检测。
+    """
+
+    def __init__(self, min_weight=1.5):
+        self.min_weight = min_weight
+        self.vote_table = dict()
+        self._lock = threading.Lock()
+
+    def get(self, domain):
+        """Return trusted encoding of a domain, or None.
+        """
+        with self._lock:
+            votes = self.vote_table.get(domain)
+            if not votes:
+                return None
+            encoding, weight = max(votes.items(), key=lambda x: x[1])
+        if weight >= self.min_weight:
+            return encoding
+        return None
+
+    def update(self, domain, encoding, confidence):
+        with self._lock:
+            votes = self.vote_table.setdefault(domain, dict())
+            votes[encoding] = votes.get(encoding, 0.0) + confidence
+
+    def invalidate(self, domain, encoding):
+        with self._lock:
+            votes = self.vote_table.get(domain)
+            if votes:
+                votes.pop(encoding, None)
+
+    def __contains__(self, domain):
+        return self.get(domain) is not None
+
+    def __getitem__(self, domain):
+        encoding = self.get(domain)
+        if encoding is None:
+            raise KeyError(domain)
+        return encoding
+
+
 #--- Unittest ---
 if __name__ == "__main__":
     def test_handle_errors():
-        utf8_text = "欢迎来到Python-CN。本社区主要讨论Python和Web开发技术。"
+        utf8_text = u"欢迎来到Python-CN。本社区主要讨论Python和Web开发技术。"
         utf8 = utf8_text.encode("utf-8")
+        assert smart_decode(utf8)[0] == utf8_text
 
     test_handle_errors()
+
+    def test_detect_encoding():
+        gbk = u"<html>中文</html>".encode("gbk")
+        assert detect_encoding(gbk, "text/html; charset=GBK") == ("gbk", 0.95)
+
+        html = b'<html><head><meta charset="gb2312"></head></html>'
+        assert detect_encoding(html) == ("gb2312", 0.9)
+
+        html = b'<meta http-equiv="Content-Type" content="text/html; charset=utf-8">'
+        assert detect_encoding(html)[0] == "utf-8"
+
+        assert detect_encoding(codecs.BOM_UTF8 + b"<html>")[0] == "utf-8-sig"
+        assert bom_safe("utf-8") == "utf-8-sig"
+        assert bom_safe("gbk") == "gbk"
+
+        # wrong header, fall back to chardet
+        text, encoding, _ = smart_decode(
+            u"中文".encode("utf-8") * 10, content_type="text/html; charset=ascii")
+        assert encoding == "utf-8"
+
+        # errors="ignore" never fails, no fallback
+        text, encoding, _ = smart_decode(
+            u"中文".encode("utf-8") * 10, errors="ignore",
+            content_type="text/html; charset=ascii")
+        assert encoding == "ascii" and text == ""
+
+    test_detect_encoding()
+
+    def test_encoding_cache():
+        cache = EncodingCache(min_weight=1.5)
+        cache.update("a.com", "utf-8", 0.9)
+        assert cache.get("a.com") is None
+        cache.update("a.com", "utf-8", 0.9)
+        assert cache.get("a.com") == "utf-8"
+        cache.invalidate("a.com", "utf-8")
+        assert "a.com" not in cache
+
+    test_encoding_cache()
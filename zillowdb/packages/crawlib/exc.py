@@ -7,8 +7,10 @@ Exceptions.
 
 from requests import Timeout as TimeoutError
 try:
-    from .spider import NotDownloadError
+    from .spider import NotDownloadError, HttpError
+    from .cache import CacheMiss
     from .htmlparser import SoupError, CaptchaError, WrongHtmlError, ParseError
 except:
-    from crawlib.spider import NotDownloadError
+    from crawlib.spider import NotDownloadError, HttpError
+    from crawlib.cache import CacheMiss
     from crawlib.htmlparser import SoupError, CaptchaError, WrongHtmlError, ParseError
\ No newline at end of file
@@ -1,7 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    from time import perf_counter
+except ImportError:  # python2
+    from time import time as perf_counter
+
+try:
+    import lxml.html
+    has_lxml = True
+except ImportError:
+    has_lxml = False
+
+#: BeautifulSoup with lxml, fast and tolerant.
+BACKEND_LXML = "lxml"
+#: BeautifulSoup with python built-in parser, slowest, no dependency.
+BACKEND_HTML_PARSER = "html.parser"
+#: raw ``lxml.html`` element tree, fastest, no soup API.
+BACKEND_ETREE = "etree"
+
+#: lxml builds a slightly different soup for broken html, it's opt-in.
+DEFAULT_BACKEND = BACKEND_HTML_PARSER
 
 
 class SoupError(Exception):
@@ -47,13 +68,57 @@ class ParseError(Exception):
 class BaseHtmlParser(object):
 
     """Base Html Parser. Able to get useful data from html.
+
+    Subclass can declare ``parse_only``, a ``bs4.SoupStrainer``, then only
+    the matched elements are built into soup, which is much faster when we
+    only need a small part of a big page.
+
+    :param backend: one of ``"lxml"``, ``"html.parser"``, ``"etree"``, default
+      is ``"html.parser"``. lxml is much faster, but it repairs broken html
+      differently, make sure the parsed data is the same before switching.
+      With ``"etree"``, :meth:`BaseHtmlParser.get_soup` uses lxml, subclass
+      methods should use :meth:`BaseHtmlParser.get_tree` for the fast path.
+
+    **中文文档**
+
+    可以选择不同的解析后端。子类可以通过 ``parse_only`` 声明只需要解析的部分,
+    以节约构造整个 soup 的时间。
     """
+    backend = DEFAULT_BACKEND
+    parse_only = None
 
-    def get_soup(self, html):
+    def __init__(self, backend=None):
+        if backend is not None:
+            if backend in (BACKEND_LXML, BACKEND_ETREE) and not has_lxml:
+                raise ValueError("backend %r requires lxml" % backend)
+            self.backend = backend
+
+    @property
+    def is_fast_mode(self):
+        return self.backend == BACKEND_ETREE
+
+    def get_soup(self, html, parse_only=None):
+        """Convert html to soup.
+
+        :param parse_only: a ``SoupStrainer``, default is ``self.parse_only``.
+        """
+        if parse_only is None:
+            parse_only = self.parse_only
+        features = self.backend
+        if features == BACKEND_ETREE:
+            features = BACKEND_LXML
         try:
-            return BeautifulSoup(html, "html.parser")
+            return BeautifulSoup(html, features, parse_only=parse_only)
         except Exception as e:
-            raise SoupError()
+            raise SoupError(str(e))
+
+    def get_tree(self, html):
+        """Convert html to ``lxml.html`` element tree.
+        """
+        try:
+            return lxml.html.fromstring(html)
+        except Exception as e:
+            raise SoupError(str(e))
 
     def get_data(self, html, *args, **kwargs):
         """An example method, takes argument and return parsed data.
@@ -79,6 +144,33 @@ class BaseHtmlParser(object):
             data = None
         return data
 
+
+def benchmark(parse, html_list, repeat=1):
+    """Time ``parse(html)`` over a list of html, return a dict of per page
+    time in milliseconds: ``{"n": int, "avg": ms, "p50": ms, "p99": ms}``.
+
+    **中文文档**
+
+    测量解析函数在每个页面上的耗时, 用于比较不同的解析后端。
+    """
+    elapse_list = list()
+    for html in html_list:
+        for _ in range(repeat):
+            st = perf_counter()
+            parse(html)
+            elapse_list.append((perf_counter() - st) * 1000)
+    elapse_list.sort()
+    n = len(elapse_list)
+    if n == 0:
+        return {"n": 0, "avg": 0.0, "p50": 0.0, "p99": 0.0}
+    return {
+        "n": n,
+        "avg": sum(elapse_list) / n,
+        "p50": elapse_list[n // 2],
+        "p99": elapse_list[min(n - 1, int(n * 0.99))],
+    }
+
+
 if __name__ == "__main__":
     def test_htmlparser():
         htmlparser = BaseHtmlParser()
@@ -86,4 +178,43 @@ if __name__ == "__main__":
         data = htmlparser.get_data(html)
         assert data == {"name": "Python"}
 
+        for backend in [BACKEND_LXML, BACKEND_HTML_PARSER, BACKEND_ETREE]:
+            assert BaseHtmlParser(backend).get_data(html) == {"name": "Python"}
+
     test_htmlparser()
+
+    def test_parse_only():
+        class Parser(BaseHtmlParser):
+            parse_only = SoupStrainer("a", class_="header")
+
+        html = '<div><p>%s</p><a class="header">Python</a></div>' % ("x" * 100)
+        soup = Parser().get_soup(html)
+        assert soup.find("p") is None
+        assert soup.find("a").text == "Python"
+
+        tree = Parser(BACKEND_ETREE).get_tree(html)
+        assert tree.xpath("//a[@class='header']")[0].text == "Python"
+
+    test_parse_only()
+
+    def test_default_backend():
+        assert BaseHtmlParser().backend == BACKEND_HTML_PARSER
+        assert BaseHtmlParser().get_soup("<p>x</p>").find("p").text == "x"
+
+    test_default_backend()
+
+    def test_benchmark():
+        html_list = ["<div>%s</div>" % ("<p>x</p>" * 100), ] * 5
+        parser = BaseHtmlParser()
+        stats = benchmark(parser.get_soup, html_list, repeat=2)
+        assert stats["n"] == 10
+        assert 0 <= stats["p50"] <= stats["p99"]
+
+        calls = list()
+        benchmark(calls.append, html_list)
+        assert calls == html_list
+
+        assert benchmark(parser.get_soup, list()) == \
+            {"n": 0, "avg": 0.0, "p50": 0.0, "p99": 0.0}
+
+    test_benchmark()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive rate limiter shared by spiders and crawlers.
+
+Each key (a domain, or an identity like one browser / one proxy) has its own
+token bucket. The rate of a bucket is adjusted by AIMD: additive increase on
+success, multiplicative decrease on http error or captcha. Consecutive
+failures also put the key into a jittered exponential backoff.
+
+**中文文档**
+
+每个 key (域名, 或者某个身份, 例如一个浏览器, 一个代理) 都有一个令牌桶。桶的速率
+按照 AIMD 规则自动调整: 成功则线性增加, 遇到 http 错误或验证码则成倍减少。连续
+失败时, 该 key 会进入带随机抖动的指数退避, 时间从数秒到数分钟不等。这样就不再
+需要在每次请求前固定地 sleep, 也不需要在被封后一次等待一个小时。
+"""
+
+import time
+import random
+import threading
+
+
+class TokenBucket(object):
+
+    """Token bucket with reservation semantics. Tokens can be borrowed, the
+    borrower is told how long to wait.
+
+    :param rate: tokens refilled per second.
+    :param capacity: max tokens can be saved, i.e. the burst size.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, now, n=1):
+        """Take n tokens, return seconds to wait before using them.
+        """
+        self.refill(now)
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class KeyState(object):
+
+    """Token bucket plus failure and backoff state of one key.
+    """
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.n_failure = 0
+        self.blocked_until = 0.0
+
+
+class RateLimiter(object):
+
+    """Per-key token bucket rate limiter with AIMD rate and jittered backoff.
+
+    Usage::
+
+        >>> limiter = RateLimiter(rate=1.0)
+        >>> limiter.acquire("www.zillow.com", "chrome-1")
+        >>> ... # make request
+        >>> limiter.on_success("www.zillow.com", "chrome-1")
+
+    :param rate: initial requests per second of a key.
+    :param capacity: burst size of a key.
+    :param min_rate: rate will not go below this.
+    :param max_rate: rate will not go above this.
+    :param increase: rate added after each success.
+    :param decrease: rate is multiplied by this after each error.
+    :param backoff_base: backoff seconds after the first consecutive failure,
+      doubled after each further one.
+    :param backoff_max: max backoff seconds.
+    :param jitter: backoff is randomly reduced by up to this ratio.
+    :param captcha_penalty: a captcha counts as this many failures.
+    """
+
+    def __init__(self,
+                 rate=1.0,
+                 capacity=1.0,
+                 min_rate=0.05,
+                 max_rate=10.0,
+                 increase=0.05,
+                 decrease=0.5,
+                 backoff_base=2.0,
+                 backoff_max=600.0,
+                 jitter=0.5,
+                 captcha_penalty=3):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.captcha_penalty = captcha_penalty
+        self.key_table = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            return self.key_table[key]
+        except KeyError:
+            state = KeyState(self.rate, self.capacity)
+            self.key_table[key] = state
+            return state
+
+    def reserve(self, *keys):
+        """Take one token from every key, return seconds to wait. Use this
+        in asyncio code: ``await asyncio.sleep(limiter.reserve(domain))``.
+
+        ``None`` in keys is ignored.
+        """
+        now = time.time()
+        wait = 0.0
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                state = self._get(key)
+                wait = max(
+                    wait,
+                    state.bucket.reserve(now),
+                    state.blocked_until - now,
+                )
+        return wait
+
+    def acquire(self, *keys):
+        """Block until all keys allow one more request.
+        """
+        wait = self.reserve(*keys)
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self, n_failure):
+        """Jittered exponential backoff seconds after n consecutive failures.
+        """
+        seconds = min(self.backoff_max,
+                      self.backoff_base * 2 ** (n_failure - 1))
+        return seconds * (1 - self.jitter * random.random())
+
+    def on_success(self, *keys):
+        """Additive increase.
+        """
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                state = self._get(key)
+                state.n_failure = 0
+                bucket = state.bucket
+                bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+
+    def on_error(self, *keys, **kwargs):
+        """Multiplicative decrease, and backoff.
+
+        :param n: count as n failures, default 1.
+        """
+        n = kwargs.get("n", 1)
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                state = self._get(key)
+                state.n_failure += n
+                bucket = state.bucket
+                bucket.rate = max(
+                    self.min_rate, bucket.rate * self.decrease ** n)
+                state.blocked_until = max(
+                    state.blocked_until, now + self.backoff(state.n_failure))
+
+    def on_captcha(self, *keys):
+        """Captcha means we are almost blocked, stronger than http error.
+        """
+        self.on_error(*keys, n=self.captcha_penalty)
+
+    def get_rate(self, key):
+        with self._lock:
+            return self._get(key).bucket.rate
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    def test_token_bucket():
+        bucket = TokenBucket(rate=2.0, capacity=1.0)
+        now = bucket.last
+        assert bucket.reserve(now) == 0.0
+        assert abs(bucket.reserve(now) - 0.5) < 0.0001
+        assert abs(bucket.reserve(now) - 1.0) < 0.0001
+
+    test_token_bucket()
+
+    def test_aimd():
+        limiter = RateLimiter(rate=1.0, increase=0.5, decrease=0.5,
+                              backoff_base=1.0, jitter=0.0)
+        limiter.on_success("a")
+        assert limiter.get_rate("a") == 1.5
+        limiter.on_error("a")
+        assert limiter.get_rate("a") == 0.75
+        assert 0.9 <= limiter.reserve("a") <= 1.0
+        limiter.on_captcha("a")
+        assert limiter.key_table["a"].n_failure == 4
+
+    test_aimd()
@@ -5,7 +5,10 @@ from __future__ import print_function
 import os
 import sys
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 try:
     from urlparse import urlparse
@@ -13,9 +16,32 @@ except:
     from urllib.parse import urlparse
 
 try:
-    from .decoder import smart_decode
+    from .decoder import (
+        smart_decode, charset_from_content_type, bom_safe, EncodingCache,
+    )
 except:
-    from crawlib.decoder import smart_decode
+    from crawlib.decoder import (
+        smart_decode, charset_from_content_type, bom_safe, EncodingCache,
+    )
+
+try:
+    from ..sfm.metrics import metrics
+except:
+    from sfm.metrics import metrics
+
+
+BROWSER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.118 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Encoding": "gzip, deflate, sdch",
+    "Accept-Language": "en-US,en;q=0.8,zh-CN;q=0.6,zh;q=0.4",
+    "Content-Type": "text/html; charset=UTF-8",
+    "Connection": "keep-alive",
+    "Referer": None,
+}
+
+# too many requests, forbidden, most likely we are blocked
+BLOCKED_STATUS_CODE = set([403, 429])
 
 
 def get_domain_name(url):
@@ -28,41 +54,177 @@ def get_domain_name(url):
     return domain_name
 
 
+def decode_html(url, binary, domain_encoding_table, encoding=None, errors="strict",
+                content_type=None):
+    """Decode binary content of an url. If encoding is not given, use the
+    charset in ``content_type`` header, or the encoding trusted by
+    ``domain_encoding_table`` (a :class:`~crawlib.decoder.EncodingCache`) for
+    this domain, or detect it with :func:`~crawlib.decoder.smart_decode` and
+    vote for it. If the trusted encoding of the domain fails, it's
+    invalidated and detected again. A utf-8 BOM is stripped.
+
+    ``errors`` only applies to the detected encoding, the header and the
+    cached encoding are tried strictly, so a wrong one still falls back to
+    detection.
+
+    **中文文档**
+
+    将url的二进制内容解码。优先使用 http 头中的编码, 其次是该域名的缓存编码,
+    最后才检测编码。缓存编码解码失败时会被清除, 重新检测。utf-8 的 BOM 会被去掉。
+    """
+    if encoding is not None:
+        return binary.decode(encoding, errors=errors)
+
+    encoding = charset_from_content_type(content_type)
+    if encoding is not None:
+        try:
+            return binary.decode(bom_safe(encoding))
+        except UnicodeDecodeError:  # wrong header, detect it
+            pass
+
+    domain_name = get_domain_name(url)
+    encoding = domain_encoding_table.get(domain_name)
+    if encoding is not None:
+        try:
+            return binary.decode(bom_safe(encoding))
+        except UnicodeDecodeError:
+            domain_encoding_table.invalidate(domain_name, encoding)
+
+    html, encoding, confidence = smart_decode(
+        binary, errors=errors, content_type=content_type)
+    domain_encoding_table.update(domain_name, encoding, confidence)
+    return html
+
+
 class NotDownloadError(Exception):
 
     """Error that an content of url are not successfully downloaded.
     """
 
 
+class HttpError(Exception):
+
+    """Http status code of a page is not 2xx, e.g. blocked or server error.
+    """
+
+    def __init__(self, url, status_code):
+        super(HttpError, self).__init__("%s %s" % (status_code, url))
+        self.url = url
+        self.status_code = status_code
+
+
 class Spider(object):
 
-    """A minimal spider class. Two useful method are provided:
+    """A minimal spider class. Three useful method are provided:
 
     - :meth:`Spider.get_html`
+    - :meth:`Spider.get_html_many`
     - :meth:`Spider.download`
 
+    Every domain has its own keep-alive ``requests.Session``, so requests to
+    the same domain reuse the TCP/TLS connection.
+
     :param default_timeout: in any method making http request, if timeout 
       keyword is not explicitly given, then use default value.
     :param default_sleeptime: in any method making http request, sleep for 
       short period of time before making request.
+    :param pool_maxsize: max number of connections kept alive per domain.
+    :param limiter: optional :class:`~crawlib.ratelimit.RateLimiter`, if 
+      given, it replaces ``default_sleeptime``. Requests are throttled by 
+      domain and ``identity``, and http errors slow the domain down.
+    :param identity: who is making request, e.g. a proxy, used as the second
+      key of the limiter.
+    :param report_success: if False, a good http response is not reported to
+      the limiter, the caller reports it after checking the content, e.g. a
+      captcha page is also http 200, it must not reset the backoff.
+    :param cache: optional :class:`~crawlib.cache.HtmlCache`, if given,
+      :meth:`Spider.get_html` returns cached html when available, and caches
+      what it gets.
+    :param cache_only: if True, never make request in :meth:`Spider.get_html`,
+      raise :class:`~crawlib.cache.CacheMiss` if not cached.
     """
 
-    def __init__(self, default_headers=None, default_timeout=None, default_sleeptime=0.0, ):
+    def __init__(self, default_headers=None, default_timeout=None, default_sleeptime=0.0,
+                 pool_maxsize=10, limiter=None, identity=None,
+                 report_success=True, cache=None, cache_only=False):
         self.default_headers = default_headers
         self.default_timeout = default_timeout
         self.default_sleeptime = default_sleeptime
-        self.domain_encoding_table = dict()
+        self.pool_maxsize = pool_maxsize
+        self.limiter = limiter
+        self.identity = identity
+        self.report_success = report_success
+        self.cache = cache
+        self.cache_only = cache_only
+        self.domain_encoding_table = EncodingCache()
+        self.session_table = dict()
+        self._session_lock = threading.Lock()
 
     def i_am_browser(self):
-        self.default_headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.118 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Encoding": "gzip, deflate, sdch",
-            "Accept-Language": "en-US,en;q=0.8,zh-CN;q=0.6,zh;q=0.4",
-            "Content-Type": "text/html; charset=UTF-8",
-            "Connection": "close",
-            "Referer": None,
-        }
+        self.default_headers = dict(BROWSER_HEADERS)
+
+    def get_session(self, url):
+        """Get the pooled ``requests.Session`` of the domain of this url.
+
+        **中文文档**
+
+        每个域名使用一个独立的 Session, 以复用连接。
+        """
+        domain_name = get_domain_name(url)
+        try:
+            return self.session_table[domain_name]
+        except KeyError:
+            with self._session_lock:
+                if domain_name not in self.session_table:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.session_table[domain_name] = session
+                return self.session_table[domain_name]
+
+    def close(self):
+        """Close all pooled connections.
+        """
+        with self._session_lock:
+            for session in self.session_table.values():
+                session.close()
+            self.session_table.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _throttle(self, url):
+        if self.limiter is None:
+            time.sleep(self.default_sleeptime)
+        else:
+            self.limiter.acquire(get_domain_name(url), self.identity)
+
+    def _request(self, url, **kwargs):
+        """Make a throttled GET request, report the result to limiter.
+        """
+        self._throttle(url)
+        domain_name = get_domain_name(url)
+        keys = (domain_name, self.identity)
+        try:
+            with metrics.timer("http", domain=domain_name):
+                response = self.get_session(url).get(url, **kwargs)
+        except Exception:
+            if self.limiter is not None:
+                self.limiter.on_error(*keys)
+            raise
+        if response.status_code in BLOCKED_STATUS_CODE \
+                or response.status_code >= 500:
+            metrics.counter("http_errors", domain=domain_name).inc()
+            if self.limiter is not None:
+                self.limiter.on_error(*keys)
+        elif self.limiter is not None and self.report_success:
+            self.limiter.on_success(*keys)
+        return response
 
     def get_binary(self, url, headers=None, timeout=None):
         """Get binary data of an url.
@@ -71,37 +233,92 @@ class Spider(object):
             headers = self.default_headers
         if timeout is None:
             timeout = self.default_timeout
-        time.sleep(self.default_sleeptime)
 
         # Exception may raises
-        response = requests.get(url, headers=headers, timeout=timeout)
+        response = self._request(url, headers=headers, timeout=timeout)
         binary = response.content
         return binary
 
-    def get_html(self, url, headers=None, timeout=None, encoding=None, errors="strict"):
-        """Get html source in text.
+    def decode(self, url, binary, encoding=None, errors="strict",
+               content_type=None):
+        """Decode binary content of an url, if encoding is not given, use 
+        the charset in ``content_type``, or the cached encoding of this 
+        domain, or detect it.
+        """
+        with metrics.timer("decode", domain=get_domain_name(url)):
+            return decode_html(url, binary, self.domain_encoding_table,
+                               encoding=encoding, errors=errors,
+                               content_type=content_type)
+
+    def get_html(self, url, headers=None, timeout=None, encoding=None, errors="strict",
+                 refresh=False):
+        """Get html source in text. Raise :class:`HttpError` if status code
+        is not 2xx, so an error page is never cached.
 
         :param url: url you want to crawl
         :param timeout: time out time in second
         :param encoding: if not given, the encoding will be auto-detected
         :param strict: options "ignore", "strict"; encoding error parameter
+        :param refresh: if True, don't use cached html, get it again and
+          replace the cached one.
         """
-        binary = self.get_binary(url, headers=headers, timeout=timeout)
-        if encoding is None:
-            domain_name = get_domain_name(url)
-            if domain_name in self.domain_encoding_table:
-                encoding = self.domain_encoding_table[domain_name]
-                html = binary.decode(encoding, errors=errors)
-            else:
-                html, encoding, confidence = smart_decode(
-                    binary, errors=errors)
-                # cache domain name and encoding
-                self.domain_encoding_table[domain_name] = encoding
+        if headers is None:
+            headers = self.default_headers
+        if timeout is None:
+            timeout = self.default_timeout
 
-        else:
-            html = binary.decode(encoding, errors=errors)
+        def fetch(url):
+            response = self._request(url, headers=headers, timeout=timeout)
+            if not 200 <= response.status_code < 300:
+                raise HttpError(url, response.status_code)
+            return self.decode(
+                url, response.content, encoding=encoding, errors=errors,
+                content_type=response.headers.get("Content-Type"))
+
+        if self.cache is None:
+            return fetch(url)
+        return self.cache.fetch(url, fetch, cache_only=self.cache_only,
+                                refresh=refresh)
+
+    def get_html_many(self, urls, concurrency=4, headers=None, timeout=None,
+                      encoding=None, errors="strict"):
+        """Get html of many urls through a bounded thread pool, yield 
+        ``(url, html, error)`` as they complete. If failed, ``html`` is None
+        and ``error`` is the exception, otherwise ``error`` is None.
 
-        return html
+        At most ``concurrency`` requests are in flight, so ``urls`` can be a
+        lazy iterable of any size.
+
+        **中文文档**
+
+        使用线程池并发抓取多个url, 按照完成的顺序返回结果。
+        """
+        def get_html(url):
+            return self.get_html(url, headers=headers, timeout=timeout,
+                                 encoding=encoding, errors=errors)
+
+        urls = iter(urls)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            running = dict()
+            for url in urls:
+                running[executor.submit(get_html, url)] = url
+                if len(running) == concurrency:
+                    break
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        yield url, future.result(), None
+                    else:
+                        yield url, None, error
+
+                for url in urls:
+                    running[executor.submit(get_html, url)] = url
+                    if len(running) == concurrency:
+                        break
 
     def download(self, url, dst, timeout=None,
                  minimal_size=-1, maximum_size=1024**3):
@@ -117,9 +334,8 @@ class Spider(object):
         """
         if not timeout:
             timeout = self.default_timeout
-        time.sleep(self.default_sleeptime)
 
-        response = requests.get(url, timeout=timeout, stream=True)
+        response = self._request(url, timeout=timeout, stream=True)
         chunk_size = 1024
         downloaded = 0
         with open(dst, "wb") as f:
@@ -146,6 +362,20 @@ def test_get_domain_name():
     assert get_domain_name(url) == "www.python.org"
 
 
+def test_decode_html():
+    import codecs
+
+    url = "https://www.python.org/"
+    binary = codecs.BOM_UTF8 + u"<html>中文</html>".encode("utf-8")
+    html = decode_html(url, binary, EncodingCache(),
+                       content_type="text/html; charset=UTF-8")
+    assert html == u"<html>中文</html>"
+
+    table = EncodingCache(min_weight=0.5)
+    table.update("www.python.org", "utf-8", 1.0)
+    assert decode_html(url, binary, table) == u"<html>中文</html>"
+
+
 def test_get_html():
     url = "https://www.python.org/"
     html = spider.get_html(url)
@@ -158,7 +388,15 @@ def test_download():
     spider.download(url, dst)
 
 
+def test_get_html_many():
+    urls = ["https://www.python.org/", "https://www.python.org/about/"]
+    for url, html, error in spider.get_html_many(urls, concurrency=2):
+        assert error is None
+
+
 if __name__ == "__main__":
     test_get_domain_name()
+    test_decode_html()
     test_get_html()
+    test_get_html_many()
     test_download()
@@ -31,6 +31,21 @@ def read_gzip(path):
 
 
 #--- compress/decompress ---
+def compress_bytes(b, level=6):
+    """zlib compress bytes.
+    
+    :param level: 1 is fastest, 9 is smallest.
+    """
+    return zlib.compress(b, level)
+
+
+def decompress_bytes(b):
+    """opposite of :func:`compress_bytes`. ``b`` can be any object supports 
+    buffer protocol, e.g. a ``mmap.mmap``.
+    """
+    return zlib.decompress(b)
+
+
 def compress_str(s):
     """use zip and base64 encoding to compress arbitrary utf-8 string to a 
     shorter utf-8 string. 
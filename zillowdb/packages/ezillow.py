@@ -1,42 +1,469 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import bs4
+"""
+Zillow web service client, for ``GetUpdatedPropertyDetails``.
+
+Many zpid are requested concurrently through one pooled ``requests.Session``,
+every request takes a key from :class:`APIManager`, a key running out of
+quota is archived and the request is retried with another key. Response xml
+is parsed incrementally with ``iterparse`` into a compact dict. Responses are
+cached, a zpid requested again within the TTL doesn't cost quota.
+
+Usage::
+
+    >>> from zillowdb.packages.ezillow import ZillowClient
+    >>> client = ZillowClient()
+    >>> for zpid, detail, code in client.get_property_detail_many(zpids):
+    ...     ...
+
+**中文文档**
+
+Zillow API 客户端。使用同一个连接池并发请求, 每个请求从 :class:`APIManager`
+中取得 Key, 额度用完时自动换 Key 重试。返回的 xml 用 ``iterparse`` 流式解析为
+紧凑的字典。
+"""
+
+import io
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from zillowdb.packages.api_manager import BaseApiKey, APIManager
+from zillowdb.packages.api_manager import (
+    NoAvailableAPIError, BaseApiKeyNotWorkingError, QuotaExceededError,
+)
+from zillowdb.packages.response_cache import ResponseCache
+
+ENDPOINT = "http://www.zillow.com/webservice/GetUpdatedPropertyDetails.htm"
+#: name of endpoint in response cache
+ENDPOINT_NAME = "GetUpdatedPropertyDetails"
+#: seconds a cached property detail is valid
+DETAIL_TTL = 7 * 24 * 3600
 
-from zillowdb.api_manager import BaseApiKey, APIManager
-from zillowdb.api_manager import NoAvailableAPIError, BaseApiKeyNotWorkingError
+#: calls allowed per zws-id per day
+DAILY_QUOTA = 1000
+
+# message code of zillow web service
+CODE_SUCCESS = 0
+CODE_INVALID_KEY = 2
+CODE_QUOTA_EXCEEDED = 7
+# invalid zpid, or no data of this property, don't retry
+CODE_NO_DATA = set([500, 501, 502, 503])
+# client side error, no response or not parsable
+CODE_REQUEST_ERROR = -1
 
 
 class ZillowAPIKey(BaseApiKey):
     _primary_key = "zws_id"
-    
+
     def __init__(self, zws_id):
         self.zws_id = zws_id
 
     def setup_client(self):
         self._client = None
-        
- 
+
+
+def create_api_manager(zws_id_list=None, daily_quota=DAILY_QUOTA,
+                       response_cache=None, **kwargs):
+    """Create :class:`APIManager` of zws-id, default are ``config.ZWSID``,
+    with the response cache at ``config.API_CACHE_PATH``.
+    """
+    if zws_id_list is None:
+        from zillowdb import config
+        zws_id_list = config.ZWSID
+        if response_cache is None:
+            response_cache = ResponseCache(
+                config.API_CACHE_PATH, ttl={ENDPOINT_NAME: DETAIL_TTL})
+    return APIManager(
+        apikey_pool=[ZillowAPIKey(zws_id) for zws_id in zws_id_list],
+        daily_quota=daily_quota, response_cache=response_cache, **kwargs
+    )
+
+
+def _local_name(tag):
+    """``{namespace}tag`` => ``tag``, ``prefix:tag`` => ``tag``.
+    """
+    return tag.rsplit("}", 1)[-1].rsplit(":", 1)[-1]
+
+
+#: leaf elements converted to int, by local name
+INT_FIELDS = set([
+    "code", "currentMonth", "total", "count", "price",
+    "bedrooms", "finishedSqFt", "lotSizeSqFt", "yearBuilt", "yearUpdated",
+    "numFloors", "numRooms",
+])
+#: leaf elements converted to float, by local name
+FLOAT_FIELDS = set(["latitude", "longitude", "bathrooms"])
+
+
+def _convert(name, text):
+    """Convert text of leaf element ``name`` by :data:`INT_FIELDS` and
+    :data:`FLOAT_FIELDS`. Others are kept as string, e.g. zpid, zipcode
+    ``"02134"``, street number.
+    """
+    if text is None:
+        return None
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        if name in INT_FIELDS:
+            return int(text)
+        if name in FLOAT_FIELDS:
+            return float(text)
+    except ValueError:
+        pass
+    return text
+
+
+def parse_property_detail(stream):
+    """Parse ``GetUpdatedPropertyDetails`` response xml incrementally.
+
+    Leaf element becomes number or string (see :func:`_convert`), element
+    having children becomes dict, repeated element becomes list. Attributes
+    are kept as ``"@name"`` keys, the text of an element having attributes
+    is ``"#text"``, e.g. ``{"@currency": "USD", "#text": 1290000}``. Every
+    element is cleared once it's converted, so the tree is never fully
+    built.
+
+    :param stream: file-like object of xml bytes.
+    :returns: ``(code, detail)``, detail is the dict of ``<response>``, or
+      None if code is not success.
+    """
+    code = CODE_REQUEST_ERROR
+    detail = None
+    # each frame is [name, dict of children]
+    stack = [["", dict()]]
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            stack.append([_local_name(elem.tag), dict()])
+            continue
+
+        name, children = stack.pop()
+        if elem.attrib:
+            value = dict(("@" + _local_name(key), attr_value)
+                         for key, attr_value in elem.attrib.items())
+            if children:
+                value.update(children)
+            else:
+                text = _convert(name, elem.text)
+                if text is not None:
+                    value["#text"] = text
+        elif children:
+            value = children
+        else:
+            value = _convert(name, elem.text)
+        elem.clear()
+
+        parent = stack[-1]
+        if parent[0] == "message" and name == "code":
+            code = value
+        if name == "response" and len(stack) == 2:
+            detail = value if isinstance(value, dict) else dict()
+            continue
+        if value is None:
+            continue
+        siblings = parent[1]
+        if name in siblings:
+            if not isinstance(siblings[name], list):
+                siblings[name] = [siblings[name], ]
+            siblings[name].append(value)
+        else:
+            siblings[name] = value
+
+    if code != CODE_SUCCESS:
+        detail = None
+    return code, detail
+
+
 class ZillowClient(object):
-    
-    def __init__(self, zws_id):
-        self.zws_id = zws_id
-        self.endpoint = "http://www.zillow.com/webservice/GetUpdatedPropertyDetails.htm?zws-id={zws_id}&zpid={zpid}"
-        
+
+    """Concurrent ``GetUpdatedPropertyDetails`` client.
+
+    :param api_manager: :class:`APIManager` of :class:`ZillowAPIKey`, default
+      is created from ``config.ZWSID``.
+    :param endpoint: url of ``GetUpdatedPropertyDetails.htm``, point it to a
+      local fixture server for testing.
+    :param n_worker: max number of concurrent requests.
+    :param timeout: seconds of a request.
+    :param max_retry: max number of retry with another key, if a key runs out
+      of quota or is invalid.
+    :param cache: :class:`ResponseCache`, default is the response cache of
+      ``api_manager``.
+    """
+
+    def __init__(self, api_manager=None, endpoint=ENDPOINT, n_worker=8,
+                 timeout=10, max_retry=3, cache=None):
+        if api_manager is None:
+            api_manager = create_api_manager()
+        if cache is None:
+            cache = api_manager.response_cache
+        self.api_manager = api_manager
+        self.cache = cache
+        self.endpoint = endpoint
+        self.n_worker = n_worker
+        self.timeout = timeout
+        self.max_retry = max_retry
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=n_worker)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _call(self, apikey, zpid):
+        response = self.session.get(
+            self.endpoint,
+            params={"zws-id": apikey.zws_id, "zpid": zpid},
+            timeout=self.timeout,
+            stream=True,
+        )
+        try:
+            response.raw.decode_content = True
+            code, detail = parse_property_detail(response.raw)
+        finally:
+            response.close()
+
+        if code == CODE_QUOTA_EXCEEDED:
+            raise QuotaExceededError(apikey.zws_id)
+        if code == CODE_INVALID_KEY:
+            raise BaseApiKeyNotWorkingError(apikey.zws_id)
+        return code, detail
+
     def get_property_detail(self, zpid):
-        res = requests.get(self.endpoint.format(zws_id=self.zws_id, zpid=zpid))
-        print(res.status_code)
-        print(res.text) 
-        if res.status_code == 0:
-            soup = bs4.BeautifulSoup(res.text, "html.parser")
-            print(soup.prettify())
+        """Get updated property detail of one zpid. Success and "no data"
+        response are cached, request error is not.
+
+        :returns: ``(code, detail)``, detail is None if failed.
+        :raises: :class:`NoAvailableAPIError` if all keys are used up.
+        """
+        if self.cache is None:
+            return self._get_property_detail(zpid)
+        code, detail = self.cache.get_or_call(
+            ENDPOINT_NAME, zpid,
+            lambda: self._get_property_detail(zpid),
+            is_negative=lambda result: result[0] in CODE_NO_DATA,
+            is_cacheable=lambda result:
+                result[0] == CODE_SUCCESS or result[0] in CODE_NO_DATA,
+        )
+        return code, detail
+
+    def _get_property_detail(self, zpid):
+        for _ in range(self.max_retry + 1):
+            apikey = self.api_manager.fetch_one()
+            try:
+                code, detail = self._call(apikey, zpid)
+            except QuotaExceededError:
+                self.api_manager.release(apikey, quota_exceeded=True)
+                continue
+            except BaseApiKeyNotWorkingError:
+                self.api_manager.release(apikey, success=False)
+                self.api_manager.remove_one(apikey)
+                continue
+            except Exception:
+                self.api_manager.release(apikey, success=False)
+                return CODE_REQUEST_ERROR, None
+            self.api_manager.release(apikey, success=True)
+            return code, detail
+        return CODE_REQUEST_ERROR, None
+
+    def get_property_detail_many(self, zpids):
+        """Get detail of many zpid, yield ``(zpid, detail, code)`` as they
+        complete. At most ``n_worker`` requests are in flight, so ``zpids``
+        can be a lazy iterable of any size. Stop when all keys are used up.
+        """
+        zpids = iter(zpids)
+        with ThreadPoolExecutor(max_workers=self.n_worker) as executor:
+            running = dict()
+            for zpid in zpids:
+                running[executor.submit(self.get_property_detail, zpid)] = zpid
+                if len(running) == self.n_worker:
+                    break
+
+            exhausted = False
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    zpid = running.pop(future)
+                    try:
+                        code, detail = future.result()
+                    except NoAvailableAPIError:
+                        exhausted = True
+                        continue
+                    yield zpid, detail, code
+
+                if exhausted:
+                    continue
+                for zpid in zpids:
+                    running[executor.submit(self.get_property_detail, zpid)] = zpid
+                    if len(running) == self.n_worker:
+                        break
+
+            if exhausted:
+                raise NoAvailableAPIError
+
+
+def update_zillow_api(zpids, client=None, field="zillow_api", batch_size=500):
+    """Get detail of many zpid, bulk write them to the address collection of
+    their state, matched by ``key``, i.e. ``"<zpid>_zpid"``.
+
+    Detail is written to ``Address.zillow_api`` by default, not
+    ``zillow_detail``, which holds the data parsed from the house detail page.
+
+    :param zpids: iterable of zpid, or of ``(state, zpid)``, if state is not
+      given, it's taken from the address of the response.
+    :returns: dict of counters.
+    """
+    from zillowdb.mongodb import address_col_mapper
+    from zillowdb.packages.sfm.pymongo_mate import WriteBehindBuffer
 
+    if client is None:
+        client = ZillowClient()
 
+    state_table = dict()
+
+    def iter_zpid():
+        for zpid in zpids:
+            if isinstance(zpid, (tuple, list)):
+                state, zpid = zpid
+                state_table[str(zpid)] = state
+            yield zpid
+
+    stats = {"n_success": 0, "n_no_data": 0, "n_error": 0, "n_unknown": 0}
+    buffer = WriteBehindBuffer(max_size=batch_size, max_age=5.0)
+    with buffer:
+        for zpid, detail, code in client.get_property_detail_many(iter_zpid()):
+            if detail is None:
+                if code in CODE_NO_DATA:
+                    stats["n_no_data"] += 1
+                else:
+                    stats["n_error"] += 1
+                continue
+
+            state = state_table.pop(str(zpid), None)
+            if state is None:
+                try:
+                    state = detail["address"]["state"].lower()
+                except (KeyError, TypeError, AttributeError):
+                    pass
+            col = address_col_mapper.get(state)
+            if col is None:
+                stats["n_unknown"] += 1
+                continue
+            buffer.update_one(
+                col, {"key": "%s_zpid" % zpid}, {"$set": {field: detail}})
+            stats["n_success"] += 1
+    return stats
+
+
+#--- Unittest ---
 if __name__ == "__main__":
-    
-    zws_id = "X1-ZWz1dyb91hllhn_6msnx"
-    z_client = ZillowClient(zws_id)
-    
-    zpid = 48749425
-    z_client.get_property_detail(zpid)
\ No newline at end of file
+    import threading
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlparse, parse_qs
+    except:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from urlparse import urlparse, parse_qs
+
+    FIXTURE = """<?xml version="1.0" encoding="utf-8"?>
+<UpdatedPropertyDetails:updatedPropertyDetails xmlns:UpdatedPropertyDetails="http://www.zillow.com/static/xsd/UpdatedPropertyDetails.xsd">
+<request><zpid>{zpid}</zpid></request>
+<message><text>Request successfully processed</text><code>{code}</code></message>
+<response>
+<zpid>{zpid}</zpid>
+<address><street>2114 Bigelow Ave N</street><zipcode>02134</zipcode><city>Seattle</city><state>WA</state><latitude>47.637934</latitude></address>
+<price currency="USD">1290000</price>
+<images><count>2</count><image><url>http://a.jpg</url><url>http://b.jpg</url></image></images>
+<editedFacts><useCode>SingleFamily</useCode><bedrooms>4</bedrooms></editedFacts>
+</response>
+</UpdatedPropertyDetails:updatedPropertyDetails>"""
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        n_request = 0
+
+        def do_GET(self):
+            FixtureHandler.n_request += 1
+            query = parse_qs(urlparse(self.path).query)
+            zws_id, zpid = query["zws-id"][0], query["zpid"][0]
+            if zws_id == "used-up":
+                code = CODE_QUOTA_EXCEEDED
+            elif zpid == "0":
+                code = 500
+            else:
+                code = CODE_SUCCESS
+            body = FIXTURE.format(zpid=zpid, code=code).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class FixtureServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def test_parse_property_detail():
+        code, detail = parse_property_detail(
+            io.BytesIO(FIXTURE.format(zpid=1, code=0).encode("utf-8")))
+        assert code == CODE_SUCCESS
+        assert detail["zpid"] == "1"
+        assert detail["address"]["state"] == "WA"
+        assert detail["address"]["zipcode"] == "02134"
+        assert detail["address"]["latitude"] == 47.637934
+        assert detail["price"] == {"@currency": "USD", "#text": 1290000}
+        assert detail["images"]["count"] == 2
+        assert detail["editedFacts"]["bedrooms"] == 4
+        assert detail["images"]["image"]["url"] == ["http://a.jpg", "http://b.jpg"]
+
+        code, detail = parse_property_detail(
+            io.BytesIO(FIXTURE.format(zpid=1, code=502).encode("utf-8")))
+        assert code == 502 and detail is None
+
+    test_parse_property_detail()
+
+    def test_zillow_client():
+        server = FixtureServer(("127.0.0.1", 0), FixtureHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        endpoint = "http://127.0.0.1:%s/webservice/GetUpdatedPropertyDetails.htm" % \
+            server.server_address[1]
+        try:
+            api_manager = create_api_manager(["used-up", "a", "b"])
+            with ZillowClient(api_manager, endpoint=endpoint) as client:
+                result = {zpid: (detail, code) for zpid, detail, code in
+                          client.get_property_detail_many(range(100))}
+            assert len(result) == 100
+            assert result[0] == (None, 500)
+            assert result[1][0]["zpid"] == "1"
+            assert list(api_manager.archived_key_chain) == ["used-up"]
+
+            # cached, no more request
+            cache = ResponseCache()
+            api_manager = create_api_manager(["a"], response_cache=cache)
+            with ZillowClient(api_manager, endpoint=endpoint) as client:
+                n_request = FixtureHandler.n_request
+                for _ in range(2):
+                    list(client.get_property_detail_many([0, 1, 1, 2]))
+                assert FixtureHandler.n_request - n_request == 3
+                assert cache.n_collapsed + cache.n_memory_hit == 5
+        finally:
+            server.shutdown()
+
+    test_zillow_client()
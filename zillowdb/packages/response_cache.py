@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Two tier TTL cache of api responses, to save api quota.
+
+- tier 1: in process LRU.
+- tier 2: SQLite file, shared across runs.
+
+Every endpoint can have its own TTL. A negative result (e.g. "no data of this
+property") is cached too, with a shorter TTL. Concurrent calls of the same
+key are collapsed into one in-flight call, the others wait for its result.
+
+Usage::
+
+    >>> cache = ResponseCache("api_cache.sqlite3", ttl={"geocode": 30 * 86400})
+    >>> location = cache.get_or_call("geocode", address,
+    ...                              lambda: client.geocode(address))
+    >>> cache.hit_rate()
+
+Value must be json serializable.
+
+**中文文档**
+
+两级 API 响应缓存: 进程内的 LRU, 和 SQLite 文件。每个 API 可以有不同的过期
+时间, 无结果的响应也会被缓存 (过期时间较短)。同一个 key 的并发请求只会真正调用
+一次 API, 其他请求等待结果。用于节约 API 的额度。
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+#: default seconds a response is valid
+DEFAULT_TTL = 24 * 3600
+#: default seconds a negative response is valid
+DEFAULT_NEGATIVE_TTL = 3600
+
+_NOT_FOUND = object()
+
+
+class _InFlight(object):
+
+    """A call of a key in progress, other callers wait for it.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache(object):
+
+    """
+    :param path: SQLite file path, None means memory only.
+    :param maxsize: max number of entries in memory.
+    :param ttl: ``{endpoint: seconds}``, endpoint not in it uses
+      ``default_ttl``.
+    :param negative_ttl: ``{endpoint: seconds}`` of negative response,
+      endpoint not in it uses ``default_negative_ttl``.
+    """
+
+    def __init__(self, path=None, maxsize=10000,
+                 ttl=None, default_ttl=DEFAULT_TTL,
+                 negative_ttl=None, default_negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = dict(ttl or dict())
+        self.default_ttl = default_ttl
+        self.negative_ttl = dict(negative_ttl or dict())
+        self.default_negative_ttl = default_negative_ttl
+
+        self.n_memory_hit = 0
+        self.n_disk_hit = 0
+        self.n_miss = 0
+        self.n_collapsed = 0
+
+        self._lru = OrderedDict()  # (endpoint, key) -> (expire_at, value)
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response ("
+                "endpoint TEXT, key TEXT, value TEXT, expire_at REAL, "
+                "PRIMARY KEY (endpoint, key))"
+            )
+            self._conn.commit()
+
+    def ttl_of(self, endpoint, negative=False):
+        if negative:
+            return self.negative_ttl.get(endpoint, self.default_negative_ttl)
+        return self.ttl.get(endpoint, self.default_ttl)
+
+    #--- Memory ---
+    def _memory_get(self, k, now):
+        with self._lock:
+            item = self._lru.get(k)
+            if item is None:
+                return _NOT_FOUND
+            if item[0] < now:
+                del self._lru[k]
+                return _NOT_FOUND
+            self._lru[k] = self._lru.pop(k)
+            return item[1]
+
+    def _memory_set(self, k, value, expire_at):
+        with self._lock:
+            self._lru.pop(k, None)
+            self._lru[k] = (expire_at, value)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    #--- Disk ---
+    def _disk_get(self, k, now):
+        if self._conn is None:
+            return _NOT_FOUND, None
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT value, expire_at FROM response "
+                "WHERE endpoint = ? AND key = ?", k,
+            ).fetchone()
+        if row is None or row[1] < now:
+            return _NOT_FOUND, None
+        return json.loads(row[0]), row[1]
+
+    def _disk_set(self, k, value, expire_at):
+        if self._conn is None:
+            return
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response "
+                "(endpoint, key, value, expire_at) VALUES (?, ?, ?, ?)",
+                (k[0], k[1], json.dumps(value), expire_at),
+            )
+            self._conn.commit()
+
+    #--- Public ---
+    def get(self, endpoint, key, default=None):
+        """Return cached response, or ``default`` if not cached or expired.
+        """
+        value = self._get((endpoint, str(key)), time.time())
+        if value is _NOT_FOUND:
+            return default
+        return value
+
+    def _get(self, k, now):
+        value = self._memory_get(k, now)
+        if value is not _NOT_FOUND:
+            with self._lock:
+                self.n_memory_hit += 1
+            return value
+        value, expire_at = self._disk_get(k, now)
+        if value is not _NOT_FOUND:
+            self._memory_set(k, value, expire_at)
+            with self._lock:
+                self.n_disk_hit += 1
+            return value
+        with self._lock:
+            self.n_miss += 1
+        return _NOT_FOUND
+
+    def set(self, endpoint, key, value, negative=False):
+        """Cache a response, negative response has a shorter TTL.
+        """
+        k = (endpoint, str(key))
+        expire_at = time.time() + self.ttl_of(endpoint, negative)
+        self._memory_set(k, value, expire_at)
+        self._disk_set(k, value, expire_at)
+
+    def get_or_call(self, endpoint, key, func,
+                    is_negative=None, is_cacheable=None):
+        """Return cached response, if not cached, call ``func()`` and cache
+        its result. If the same key is being called by another thread, wait
+        for that call instead of calling again.
+
+        :param is_negative: callable, ``result -> bool``, negative result
+          uses negative TTL.
+        :param is_cacheable: callable, ``result -> bool``, result it returns
+          False is not cached, e.g. a transient error.
+        """
+        k = (endpoint, str(key))
+        value = self._get(k, time.time())
+        if value is not _NOT_FOUND:
+            return value
+
+        with self._lock:
+            in_flight = self._in_flight.get(k)
+            if in_flight is None:
+                in_flight = _InFlight()
+                self._in_flight[k] = in_flight
+                owner = True
+            else:
+                self.n_collapsed += 1
+                owner = False
+
+        if not owner:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            # the previous call may have just finished
+            result = self._memory_get(k, time.time())
+            if result is _NOT_FOUND:
+                result = func()
+                if is_cacheable is None or is_cacheable(result):
+                    negative = is_negative is not None and is_negative(result)
+                    self.set(endpoint, key, result, negative=negative)
+            in_flight.result = result
+            return result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(k, None)
+            in_flight.event.set()
+
+    def delete(self, endpoint, key):
+        k = (endpoint, str(key))
+        with self._lock:
+            self._lru.pop(k, None)
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.execute(
+                    "DELETE FROM response WHERE endpoint = ? AND key = ?", k)
+                self._conn.commit()
+
+    def purge(self):
+        """Remove expired entries from disk, return number of removed.
+        """
+        if self._conn is None:
+            return 0
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "DELETE FROM response WHERE expire_at < ?", (time.time(),))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+                self._conn = None
+
+    def hit_rate(self):
+        total = self.n_memory_hit + self.n_disk_hit + self.n_miss
+        if total:
+            return (self.n_memory_hit + self.n_disk_hit) / float(total)
+        return 0.0
+
+    def stats(self):
+        return {
+            "n_memory_hit": self.n_memory_hit,
+            "n_disk_hit": self.n_disk_hit,
+            "n_miss": self.n_miss,
+            "n_collapsed": self.n_collapsed,
+            "hit_rate": self.hit_rate(),
+        }
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    def test_response_cache():
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+        cache = ResponseCache(path, maxsize=2, negative_ttl={"detail": -1})
+        assert cache.get_or_call("detail", 1, lambda: {"a": 1}) == {"a": 1}
+        assert cache.get_or_call("detail", 1, lambda: None) == {"a": 1}
+
+        # negative result, expired right away here
+        cache.get_or_call("detail", 2, lambda: None,
+                          is_negative=lambda result: result is None)
+        assert cache.get("detail", 2, "miss") == "miss"
+
+        # not cacheable
+        cache.get_or_call("detail", 3, lambda: "error",
+                          is_cacheable=lambda result: result != "error")
+        assert cache.get("detail", 3) is None
+
+        # evicted from memory, still on disk
+        for key in range(10, 15):
+            cache.set("detail", key, key)
+        assert cache.get("detail", 1) == {"a": 1}
+        assert cache.n_disk_hit >= 1
+
+        # persistent
+        cache.close()
+        cache = ResponseCache(path)
+        assert cache.get("detail", 1) == {"a": 1}
+
+    test_response_cache()
+
+    def test_single_flight():
+        cache = ResponseCache()
+        n_call = [0]
+
+        def call():
+            n_call[0] += 1
+            time.sleep(0.2)
+            return "result"
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda _: cache.get_or_call("geocode", "address", call),
+                range(8)))
+        assert results == ["result"] * 8
+        assert n_call[0] == 1
+
+    test_single_flight()
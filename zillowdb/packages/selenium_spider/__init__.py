@@ -2,19 +2,57 @@
 # -*- coding: utf-8 -*-
 
 """
-
+Selenium based spider, and a pool of headless Chrome spider.
 """
 
 
 import time
+import threading
+from contextlib import contextmanager
 from selenium import webdriver
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from urlparse import urlparse
+except:
+    from urllib.parse import urlparse
+
+try:
+    from ..sfm.metrics import metrics
+except:
+    from sfm.metrics import metrics
+
 
 class BaseSpider(object):
     """
+    :param limiter: optional :class:`crawlib.ratelimit.RateLimiter`, if set,
+      it replaces the fixed ``sleep_interval``. Requests are throttled by
+      domain and ``identity``.
+    :param identity: who is making request, default is one per browser.
+    :param report_success: if False, a loaded page is not reported to the
+      limiter as success, the caller reports it after checking the content
+      (a captcha page loads fine too).
+    :param cache: optional :class:`crawlib.cache.HtmlCache`, if set, 
+      :meth:`BaseSpider.get_html` returns cached html when available.
+    :param cache_only: if True, never load page, raise 
+      :class:`crawlib.cache.CacheMiss` if not cached.
     """
     load_timeout = 0.0
     sleep_interval = 0.0
+    limiter = None
+    identity = None
+    report_success = True
+    cache = None
+    cache_only = False
     
     def set_load_timeout(self, value):
         self.load_timeout = value
@@ -23,13 +61,48 @@ class BaseSpider(object):
     def set_sleep_interval(self, value):
         self.sleep_interval = value
     
-    def _sleep(self):
-        time.sleep(self.sleep_interval)
+    def set_limiter(self, limiter, identity=None, report_success=True):
+        self.limiter = limiter
+        self.report_success = report_success
+        if identity is not None:
+            self.identity = identity
+    
+    def _sleep(self, url=None):
+        if self.limiter is None or url is None:
+            time.sleep(self.sleep_interval)
+        else:
+            self.limiter.acquire(urlparse(url).netloc, self.identity)
         
-    def get_html(self, url):
-        self._sleep()
-        self.driver.get(url)
-        return self.driver.page_source
+    def set_cache(self, cache, cache_only=False):
+        self.cache = cache
+        self.cache_only = cache_only
+    
+    def get_html(self, url, refresh=False):
+        """
+        :param refresh: if True, don't use cached html, load it again.
+        """
+        if self.cache is None:
+            return self._get_html(url)
+        return self.cache.fetch(url, self._get_html, cache_only=self.cache_only,
+                                refresh=refresh)
+    
+    def _get_html(self, url):
+        """Load page in browser, return page source.
+        """
+        self._sleep(url)
+        domain_name = urlparse(url).netloc
+        keys = (domain_name, self.identity)
+        try:
+            with metrics.timer("browser", domain=domain_name):
+                self.driver.get(url)
+                html = self.driver.page_source
+        except Exception:
+            if self.limiter is not None:
+                self.limiter.on_error(*keys)
+            raise
+        if self.limiter is not None and self.report_success:
+            self.limiter.on_success(*keys)
+        return html
     
     def close(self):
         self.driver.close()
@@ -41,9 +114,197 @@ class BaseSpider(object):
         self.close()
 
 
+# url patterns blocked when ``block_assets=True``
+BLOCKED_ASSET_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.css",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+]
+
+
 class ChromeSpider(BaseSpider):
     """
+    :param headless: run chrome without window.
+    :param block_assets: don't load images, css and fonts.
     """
-    def __init__(self, executable_path):
-        self.driver = webdriver.Chrome(executable_path=executable_path)
-        
+    def __init__(self, executable_path, headless=False, block_assets=False):
+        options = webdriver.ChromeOptions()
+        if headless:
+            options.add_argument("--headless")
+            options.add_argument("--disable-gpu")
+        if block_assets:
+            options.add_experimental_option("prefs", {
+                "profile.managed_default_content_settings.images": 2,
+            })
+        self.driver = webdriver.Chrome(
+            executable_path=executable_path, options=options)
+        if block_assets:
+            try:
+                self.driver.execute_cdp_cmd("Network.enable", {})
+                self.driver.execute_cdp_cmd(
+                    "Network.setBlockedURLs", {"urls": BLOCKED_ASSET_URLS})
+            except Exception:  # old selenium / chromedriver without cdp
+                pass
+        self.identity = "chrome-%s" % id(self)
+        self.n_page = 0
+    
+    def _get_html(self, url):
+        self.n_page += 1
+        return super(ChromeSpider, self)._get_html(url)
+    
+    def rss(self):
+        """Total resident memory in bytes of chromedriver and all chrome 
+        processes it started, None if ``psutil`` is not installed.
+        """
+        if psutil is None:
+            return None
+        try:
+            process = psutil.Process(self.driver.service.process.pid)
+            total = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return total
+        except (psutil.Error, AttributeError):
+            return None
+    
+    def quit(self):
+        """Close all windows and stop the browser process.
+        """
+        self.driver.quit()
+
+
+class ChromeSpiderPool(object):
+    """A pool of headless :class:`ChromeSpider`. Worker check out a spider,
+    use it, then check it in. A spider is recycled (quit and replaced by a 
+    new one) after ``max_page`` pages or when its memory exceeds ``max_rss``,
+    because chrome leaks memory in long run.
+    
+    Usage::
+    
+        >>> with ChromeSpiderPool(executable_path, size=4) as pool:
+        ...     with pool.spider() as spider:
+        ...         html = spider.get_html(url)
+    
+    :param size: number of browsers.
+    :param max_page: recycle a browser after this many pages.
+    :param max_rss: recycle a browser if its RSS in bytes exceeds this, 
+      requires ``psutil``.
+    :param limiter: optional rate limiter set to every spider.
+    :param report_success: passed to :meth:`BaseSpider.set_limiter`, set it
+      False if the caller reports success after checking for captcha.
+    :param cache: optional html cache set to every spider.
+    
+    **中文文档**
+    
+    同时启动多个无界面的 Chrome, 并屏蔽图片, css, 字体以节约加载时间和流量。
+    浏览器在访问了一定数量的页面, 或内存超过阈值后, 会被关闭并重新启动。
+    """
+    def __init__(self, executable_path, size=4, 
+                 max_page=500, max_rss=1024 ** 3,
+                 headless=True, block_assets=True, limiter=None, 
+                 report_success=True, cache=None, cache_only=False):
+        self.executable_path = executable_path
+        self.size = size
+        self.max_page = max_page
+        self.max_rss = max_rss
+        self.headless = headless
+        self.block_assets = block_assets
+        self.limiter = limiter
+        self.report_success = report_success
+        self.cache = cache
+        self.cache_only = cache_only
+        self.n_recycled = 0
+        self._idle = queue.Queue()
+        self._all = set()
+        self._lock = threading.Lock()
+        try:
+            for _ in range(size):
+                self._idle.put(self._create())
+        except Exception:
+            # don't leak the browsers already started
+            self.close()
+            raise
+    
+    def _create(self):
+        spider = ChromeSpider(
+            self.executable_path,
+            headless=self.headless, 
+            block_assets=self.block_assets,
+        )
+        if self.limiter is not None:
+            spider.set_limiter(
+                self.limiter, report_success=self.report_success)
+        if self.cache is not None:
+            spider.set_cache(self.cache, cache_only=self.cache_only)
+        with self._lock:
+            self._all.add(spider)
+        return spider
+    
+    def _retire(self, spider):
+        with self._lock:
+            self._all.discard(spider)
+        try:
+            spider.quit()
+        except Exception:
+            pass
+    
+    def need_recycle(self, spider):
+        if spider.n_page >= self.max_page:
+            return True
+        if self.max_rss is not None:
+            rss = spider.rss()
+            if rss is not None and rss > self.max_rss:
+                return True
+        return False
+    
+    def checkout(self, timeout=None):
+        """Take an idle spider, block until one is available. If the slot
+        lost its browser (failed to restart), a new one is created.
+        """
+        spider = self._idle.get(timeout=timeout)
+        if spider is None:
+            try:
+                spider = self._create()
+            except Exception:
+                # keep the slot, next checkout tries again
+                self._idle.put(None)
+                raise
+        return spider
+    
+    def checkin(self, spider):
+        """Give back a spider, recycle it if needed.
+        """
+        if self.need_recycle(spider):
+            self._retire(spider)
+            self.n_recycled += 1
+            try:
+                spider = self._create()
+            except Exception:
+                # placeholder, the browser is created again on checkout
+                spider = None
+        self._idle.put(spider)
+    
+    @contextmanager
+    def spider(self, timeout=None):
+        spider = self.checkout(timeout=timeout)
+        try:
+            yield spider
+        finally:
+            self.checkin(spider)
+    
+    def close(self):
+        """Quit all browsers.
+        """
+        with self._lock:
+            spiders = list(self._all)
+        for spider in spiders:
+            self._retire(spider)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Low overhead in process metrics: counters, and latency histograms with log
+scale buckets (HDR style, bounded relative error, fixed memory).
+
+Every metric has a name and labels, e.g. per stage, per level, per domain::
+
+    >>> from sfm.metrics import metrics
+    >>> with metrics.timer("http", domain="www.zillow.com"):
+    ...     response = session.get(url)
+    >>> metrics.counter("captcha", level="county").inc()
+    >>> metrics.histogram("http_seconds", domain="www.zillow.com").percentile(99)
+
+:meth:`Registry.timer` records elapsed seconds into histogram
+``<name>_seconds``, and counts exception into counter ``<name>_errors``, so
+every timed stage has an error rate ``<name>_error_rate``. Other rates, e.g.
+captcha rate, are declared by :meth:`Registry.define_rate`.
+
+Export a snapshot in Prometheus text format (for node exporter textfile
+collector) or json, periodically by :class:`MetricsExporter`.
+
+**中文文档**
+
+低开销的性能指标统计。计数器, 和按对数分桶的延迟直方图 (类似 HDR Histogram,
+相对误差固定, 内存固定)。每个指标可以按阶段, 层级, 域名等标签区分。计时使用
+``time.perf_counter``。可以定期导出为 Prometheus 文本格式或 json。
+"""
+
+import os
+import sys
+import json
+import math
+import threading
+import functools
+
+try:
+    from time import perf_counter
+except ImportError:  # python2
+    from time import time as perf_counter
+
+#: relative error of histogram, value is recorded as the upper bound of its
+#: bucket, every bucket is 2 ** (1 / 16) (4.4%) wider than the previous one
+BUCKETS_PER_OCTAVE = 16
+#: values smaller than this are recorded in bucket 0
+MIN_VALUE = 1e-6
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter(object):
+
+    """A number only goes up.
+    """
+
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    @property
+    def count(self):
+        return self.value
+
+    def to_dict(self):
+        return {"value": self.value}
+
+
+class Histogram(object):
+
+    """Log scale bucketed histogram. Only non-empty buckets are kept, memory
+    doesn't grow with number of recorded values.
+
+    :param buckets_per_octave: number of buckets between x and 2x, higher
+      is more precise.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, buckets_per_octave=BUCKETS_PER_OCTAVE,
+                 min_value=MIN_VALUE):
+        self.buckets_per_octave = buckets_per_octave
+        self.min_value = min_value
+        self._log_base = math.log(2) / buckets_per_octave
+        self.buckets = dict()  # bucket index -> count
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def _index_of(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.ceil(math.log(value / self.min_value) / self._log_base))
+
+    def _upper_bound(self, index):
+        return self.min_value * math.exp(index * self._log_base)
+
+    def record(self, value):
+        index = self._index_of(value)
+        with self._lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """Value at ``p`` percentile (0 ~ 100), None if empty.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, int(math.ceil(self.count * p / 100.0)))
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    break
+            # the bucket bound may be out of the recorded range
+            return min(max(self._upper_bound(index), self.min), self.max)
+
+    def merge(self, other):
+        """Add values recorded by another histogram of the same buckets.
+        """
+        with self._lock:
+            for index, n in other.buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + n
+            self.count += other.count
+            self.sum += other.sum
+            for value in [other.min, other.max]:
+                if value is None:
+                    continue
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    @property
+    def mean(self):
+        if self.count:
+            return self.sum / self.count
+        return None
+
+    def to_dict(self, quantiles=DEFAULT_QUANTILES):
+        data = {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+        }
+        for q in quantiles:
+            data["p%g" % (q * 100)] = self.percentile(q * 100)
+        return data
+
+
+class _Timer(object):
+
+    """Context manager, record elapsed seconds, count exception.
+    """
+
+    __slots__ = ("registry", "name", "labels", "start", "elapsed")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = perf_counter() - self.start
+        self.registry.histogram(
+            self.name + "_seconds", **self.labels).record(self.elapsed)
+        if exc_type is not None:
+            self.registry.counter(self.name + "_errors", **self.labels).inc()
+
+
+class Registry(object):
+
+    """Collection of metrics, a metric is created the first time it's used.
+
+    :param prefix: prepended to metric name in prometheus export.
+    :param enabled: if False, :meth:`Registry.timer` and
+      :meth:`Registry.timed` do nothing.
+    """
+
+    def __init__(self, prefix="", enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.metrics = dict()  # (name, ((label, value), ...)) -> metric
+        self.rates = dict()  # rate name -> (numerator, denominator)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        if labels:
+            return name, tuple(sorted(labels.items()))
+        return name, ()
+
+    def _get(self, name, labels, factory):
+        key = self._key(name, labels)
+        try:
+            return self.metrics[key]
+        except KeyError:
+            with self._lock:
+                if key not in self.metrics:
+                    self.metrics[key] = factory()
+                return self.metrics[key]
+
+    def _items(self):
+        with self._lock:
+            return sorted(self.metrics.items(), key=_sort_key)
+
+    def select(self, name):
+        """All metrics of a name, of any labels.
+        """
+        return [metric for (name_, _), metric in self._items()
+                if name_ == name]
+
+    def counter(self, name, **labels):
+        return self._get(name, labels, Counter)
+
+    def histogram(self, name, **labels):
+        return self._get(name, labels, Histogram)
+
+    def timer(self, name, **labels):
+        """Time a block, e.g. ``with metrics.timer("parse", level="county")``.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """Decorator, time every call of a function.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def define_rate(self, name, numerator, denominator):
+        """Declare a rate, ``numerator / denominator`` of metrics having the
+        same labels, e.g. ``define_rate("captcha_rate", "captcha", "pages")``.
+        A histogram counts as number of recorded values.
+        """
+        self.rates[name] = (numerator, denominator)
+
+    def compute_rates(self):
+        """Return ``{(rate name, labels): rate}`` of declared rates, and of
+        error rate of every timed block.
+        """
+        rates = dict(self.rates)
+        metrics = dict(self._items())
+        for name, labels in metrics:
+            if name.endswith("_seconds"):
+                stage = name[:-len("_seconds")]
+                rates.setdefault(
+                    stage + "_error_rate", (stage + "_errors", name))
+
+        result = dict()
+        for rate_name, (numerator, denominator) in rates.items():
+            for (name, labels), metric in metrics.items():
+                if name != denominator or not metric.count:
+                    continue
+                other = metrics.get((numerator, labels))
+                n = other.count if other is not None else 0
+                result[(rate_name, labels)] = n / float(metric.count)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self.metrics.clear()
+
+    #--- Export ---
+    def snapshot(self, quantiles=DEFAULT_QUANTILES):
+        """Return a json serializable dict of all metrics.
+        """
+        data = {"counters": list(), "histograms": list(), "rates": list()}
+        for (name, labels), metric in self._items():
+            row = {"name": name, "labels": dict(labels)}
+            if metric.kind == "counter":
+                row.update(metric.to_dict())
+                data["counters"].append(row)
+            else:
+                row.update(metric.to_dict(quantiles))
+                data["histograms"].append(row)
+        for (name, labels), rate in sorted(self.compute_rates().items(), key=_sort_key):
+            data["rates"].append(
+                {"name": name, "labels": dict(labels), "value": rate})
+        return data
+
+    def to_json(self, quantiles=DEFAULT_QUANTILES):
+        return json.dumps(self.snapshot(quantiles), indent=4, sort_keys=True)
+
+    def to_prometheus(self, quantiles=DEFAULT_QUANTILES):
+        """Prometheus text exposition format. Counters have ``_total``
+        suffix, histograms are exported as summary, rates as gauge.
+        """
+        lines = list()
+        typed = set()
+
+        def add(name, kind, labels, value, extra=None):
+            name = self.prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s%s %s" % (
+                name, _format_labels(labels, extra), _format_value(value)))
+
+        for (name, labels), metric in self._items():
+            if metric.kind == "counter":
+                add(name + "_total", "counter", labels, metric.value)
+            else:
+                for q in quantiles:
+                    add(name, "summary", labels,
+                        metric.percentile(q * 100), ("quantile", q))
+                lines.append("%s_sum%s %s" % (
+                    self.prefix + name, _format_labels(labels),
+                    _format_value(metric.sum)))
+                lines.append("%s_count%s %s" % (
+                    self.prefix + name, _format_labels(labels), metric.count))
+        for (name, labels), rate in sorted(self.compute_rates().items(), key=_sort_key):
+            add(name, "gauge", labels, rate)
+        return "\n".join(lines) + "\n"
+
+
+def _sort_key(item):
+    # label value may be None
+    name, labels = item[0]
+    return name, [(key, str(value)) for key, value in labels]
+
+
+class _NullTimer(object):
+
+    elapsed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n")\
+        .replace('"', '\\"')
+
+
+def _format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra is not None:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join([
+        '%s="%s"' % (key, _escape(value)) for key, value in labels])
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value))
+
+
+def write_atomic(path, text):
+    """Write a file, reader never sees a half written file.
+    """
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    try:
+        os.replace(tmp_path, path)
+    except AttributeError:  # python2
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+class MetricsExporter(object):
+
+    """Write snapshot of a registry to a file every ``interval`` seconds,
+    in a daemon thread.
+
+    :param fmt: ``"prometheus"`` or ``"json"``.
+    """
+
+    def __init__(self, registry, path, interval=60, fmt="prometheus"):
+        if fmt not in ("prometheus", "json"):
+            raise ValueError("fmt has to be 'prometheus' or 'json'")
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt
+        self._thread = None
+        self._stop = threading.Event()
+
+    def export(self):
+        if self.fmt == "json":
+            text = self.registry.to_json()
+        else:
+            text = self.registry.to_prometheus()
+        write_atomic(self.path, text)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.export()
+                except Exception as e:
+                    sys.stderr.write("\nFailed to export metrics: %r" % e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._thread = thread
+
+    def stop(self):
+        """Stop the thread, and export one last time.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+#: default registry, used by spiders, parsers and insert helpers
+metrics = Registry(prefix="crawler_")
+metrics.define_rate("captcha_rate", "captcha", "pages")
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    def test_histogram():
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        assert histogram.count == 1000
+        assert histogram.min == 0.001 and histogram.max == 1.0
+        for p, expected in [(50, 0.5), (99, 0.99), (100, 1.0)]:
+            value = histogram.percentile(p)
+            assert abs(value - expected) / expected < 0.05, (p, value)
+        assert len(histogram.buckets) < 200
+        assert Histogram().percentile(50) is None
+
+        merged = Histogram()
+        merged.merge(histogram)
+        merged.merge(histogram)
+        assert merged.count == 2000
+        assert merged.percentile(50) == histogram.percentile(50)
+
+    test_histogram()
+
+    def test_registry():
+        registry = Registry(prefix="test_")
+        registry.define_rate("captcha_rate", "captcha", "pages")
+        for i in range(4):
+            registry.counter("pages", level="county").inc()
+            try:
+                with registry.timer("parse", level="county"):
+                    if i == 0:
+                        raise ValueError
+            except ValueError:
+                pass
+        registry.counter("captcha", level="county").inc()
+
+        assert registry.histogram("parse_seconds", level="county").count == 4
+        assert registry.counter("parse_errors", level="county").value == 1
+        rates = registry.compute_rates()
+        labels = (("level", "county"),)
+        assert rates[("captcha_rate", labels)] == 0.25
+        assert rates[("parse_error_rate", labels)] == 0.25
+
+        text = registry.to_prometheus()
+        assert 'test_pages_total{level="county"} 4.0' in text
+        assert 'test_parse_seconds{level="county",quantile="0.99"}' in text
+        assert 'test_parse_seconds_count{level="county"} 4' in text
+        assert 'test_captcha_rate{level="county"} 0.25' in text
+
+        snapshot = json.loads(registry.to_json())
+        assert snapshot["histograms"][0]["count"] == 4
+
+        @registry.timed("work")
+        def work():
+            time.sleep(0.01)
+
+        work()
+        assert registry.histogram("work_seconds").min >= 0.01
+
+    test_registry()
+
+    def test_exporter():
+        registry = Registry()
+        registry.counter("pages").inc()
+        path = os.path.join(tempfile.mkdtemp(), "metrics.json")
+        with MetricsExporter(registry, path, interval=0.05, fmt="json"):
+            time.sleep(0.2)
+        with open(path) as f:
+            assert json.load(f)["counters"][0]["value"] == 1
+
+    test_exporter()
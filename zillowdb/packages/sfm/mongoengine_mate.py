@@ -7,9 +7,24 @@ This module extend the power of mongoengine.
 
 import math
 import mongoengine
+from datetime import datetime
+from bson import ObjectId
 from collections import OrderedDict
 from copy import deepcopy
 
+try:
+    from .metrics import metrics
+    from .pymongo_mate import bulk_insert
+except:
+    from metrics import metrics
+    from pymongo_mate import bulk_insert
+
+try:
+    string_types = (basestring,)
+    integer_types = (int, long)
+except:
+    string_types = (str,)
+    integer_types = (int,)
 
 def grouper_list(l, n):
     """Evenly divide list into fixed-length piece, no filled value if chunk
@@ -42,8 +57,82 @@ def grouper_list(l, n):
             counter = 0
     if len(chunk) > 0:
         yield chunk
-    
-    
+
+
+def _python_types(field):
+    """Accepted python types of a mongoengine field, None means not checked.
+    """
+    if isinstance(field, mongoengine.StringField):
+        return string_types
+    elif isinstance(field, mongoengine.BooleanField):
+        return (bool,)
+    elif isinstance(field, (mongoengine.IntField, mongoengine.LongField)):
+        return integer_types
+    elif isinstance(field, mongoengine.FloatField):
+        return integer_types + (float,)
+    elif isinstance(field, mongoengine.DateTimeField):
+        return (datetime,)
+    elif isinstance(field, mongoengine.DictField):
+        return (dict,)
+    elif isinstance(field, mongoengine.ListField):
+        return (list, tuple)
+    elif isinstance(field, mongoengine.ObjectIdField):
+        return (ObjectId,)
+    return None
+
+
+def compile_validator(document_class):
+    """Compile a function validates a raw dict against the field schema of
+    ``document_class``, and converts it to a pymongo document (field name to
+    db_field, None value dropped).
+
+    Only the python type and ``required`` are checked, which is enough for
+    data built by our own code.
+
+    **中文文档**
+
+    根据文档类的字段定义, 预先编译一个校验函数。之后对每个字典只需要做简单的类型
+    检查和字段名转换, 省去了构造 mongoengine 对象和 ``to_mongo`` 的开销。
+    """
+    rules = dict()
+    required = list()
+    for name, field in document_class._fields.items():
+        rules[name] = (field.db_field, _python_types(field))
+        if field.required or field.primary_key:
+            required.append(name)
+    strict = document_class._meta.get("strict", True)
+
+    def validate(data):
+        doc = dict()
+        for key, value in data.items():
+            if value is None:
+                continue
+            try:
+                db_field, types = rules[key]
+            except KeyError:
+                if strict:
+                    raise mongoengine.ValidationError(
+                        "%s has no field %r" % (document_class.__name__, key))
+                doc[key] = value
+                continue
+            if types is not None and not isinstance(value, types):
+                raise mongoengine.ValidationError(
+                    "%s.%s expect %s, got %r" % (
+                        document_class.__name__, key,
+                        "/".join([t.__name__ for t in types]), value))
+            doc[db_field] = value
+        for key in required:
+            if data.get(key) is None:
+                raise mongoengine.ValidationError(
+                    "%s.%s is required" % (document_class.__name__, key))
+        return doc
+
+    return validate
+
+
+_validator_table = dict()
+
+
 class ExtendedDocument(mongoengine.Document):
 
     """Provide `mongoengine.Document <http://docs.mongoengine.org/apireference.html#mongoengine.Document>`_
@@ -153,6 +242,7 @@ class ExtendedDocument(mongoengine.Document):
         return cls._get_collection()
             
     @classmethod
+    @metrics.timed("insert", helper="mongoengine_mate.smart_insert")
     def smart_insert(cls, data, minimal_size=5):
         """An optimized Insert strategy.
     
@@ -169,6 +259,13 @@ class ExtendedDocument(mongoengine.Document):
         该Insert策略在内存上需要额外的 sqrt(nbytes) 的开销, 跟原数据相比体积很小。
         但时间上是各种情况下平均最优的。
         """
+        n = len(data) if isinstance(data, list) else 1
+        metrics.counter(
+            "insert_rows", helper="mongoengine_mate.smart_insert").inc(n)
+        cls._smart_insert(data, minimal_size)
+
+    @classmethod
+    def _smart_insert(cls, data, minimal_size):
         if isinstance(data, list):
             # 首先进行尝试bulk insert
             try:
@@ -182,7 +279,7 @@ class ExtendedDocument(mongoengine.Document):
                     # 则进行分包
                     n_chunk = math.floor(math.sqrt(n))
                     for chunk in grouper_list(data, n_chunk):
-                        cls.smart_insert(chunk, minimal_size)
+                        cls._smart_insert(chunk, minimal_size)
                 # 否则则一条条地逐条插入
                 else:
                     for document in data:
@@ -196,6 +293,56 @@ class ExtendedDocument(mongoengine.Document):
             except mongoengine.NotUniqueError:
                 pass
 
+    @classmethod
+    def get_validator(cls):
+        """Get the raw dict validator of this model, compiled only once.
+        """
+        try:
+            return _validator_table[cls]
+        except KeyError:
+            validator = compile_validator(cls)
+            _validator_table[cls] = validator
+            return validator
+
+    @classmethod
+    def validate_raw(cls, data):
+        """Validate list of raw dict, return list of pymongo document. Raise
+        ``mongoengine.ValidationError`` if any of them is invalid.
+        """
+        validate = cls.get_validator()
+        return [validate(d) for d in data]
+
+    @classmethod
+    @metrics.timed("insert", helper="mongoengine_mate.bulk_insert_raw")
+    def bulk_insert_raw(cls, data, upsert_fields=None):
+        """Insert list of raw dict, without constructing document object.
+
+        The whole batch is validated first, nothing is written if any dict is
+        invalid. Then it's written by :func:`pymongo_mate.bulk_insert`, in one
+        unordered ``insert_many``, existing documents are skipped and reported
+        as duplicate.
+
+        :param upsert_fields: optional list of field name, for duplicate
+          documents, ``$set`` these fields with new value.
+        :returns: a report dict, ``{"inserted": int, "duplicate": int,
+          "failed": int, "updated": int, "errors": [error detail, ...]}``.
+
+        **中文文档**
+
+        直接插入字典, 跳过 mongoengine 对象的构造和逐个验证。先用预编译的校验
+        函数检查整批数据, 然后用无序的批量写入一次完成, 已存在的文档会被跳过。
+        """
+        documents = cls.validate_raw(data)
+        if documents:
+            metrics.counter(
+                "insert_rows", helper="mongoengine_mate.bulk_insert_raw",
+            ).inc(len(documents))
+        if upsert_fields:
+            upsert_fields = [
+                cls._fields[field].db_field for field in upsert_fields]
+        return bulk_insert(
+            cls._get_collection(), documents, upsert_fields=upsert_fields)
+
     @classmethod
     def by_id(cls, _id):
         """Get one instance by _id.
@@ -215,6 +362,54 @@ class ExtendedDocument(mongoengine.Document):
         使用pymongo的API进行query。
         """
         return cls.objects(__raw__=filter)
+
+    @classmethod
+    def iter_by_filter(cls, filter, fields=None, batch_size=1000, raw=False):
+        """Stream objects by pymongo dict query, memory usage is flat no 
+        matter how many are matched.
+        
+        :param fields: only load these fields (``_id`` is always loaded).
+        :param batch_size: number of documents fetched per round-trip.
+        :param raw: if True, yield pymongo dict instead of document object,
+          it's much cheaper.
+        
+        **中文文档**
+        
+        以流的方式遍历查询结果, 只读取需要的字段, 并且不缓存已经遍历过的文档。
+        ``raw=True`` 时直接返回字典, 跳过 mongoengine 对象的构造。
+        """
+        if raw:
+            projection = None
+            if fields:
+                projection = {field: True for field in fields}
+            cursor = cls._get_collection().find(
+                filter, projection, no_cursor_timeout=True)
+            cursor.batch_size(batch_size)
+            try:
+                for doc in cursor:
+                    yield doc
+            finally:
+                cursor.close()
+        else:
+            queryset = cls.objects(__raw__=filter).no_cache()
+            if fields:
+                queryset = queryset.only(*fields)
+            for document in queryset.batch_size(batch_size):
+                yield document
+    
+    @classmethod
+    def count_by_filter(cls, filter):
+        """Count matched documents on server side.
+        
+        **中文文档**
+        
+        在服务器端计数, 不需要将文档取回本地。
+        """
+        col = cls._get_collection()
+        try:
+            return col.count_documents(filter)
+        except AttributeError:  # pymongo < 3.7
+            return col.count(filter)
     
     
 #--- Unittest ---
@@ -232,7 +427,6 @@ if __name__ == "__main__":
 
         
 def test_smart_insert():
-    import time
     import random
     
     # Smart Insert
@@ -244,9 +438,7 @@ def test_smart_insert():
     
     users = [User(id=i) for i in range(1, 1 + 10000)]
     
-    st = time.clock()
     User.smart_insert(users)
-    elapse1 = time.clock() - st
     
     assert User.objects.count() == 10000 # after smart insert, we got 10000 doc
 
@@ -259,18 +451,34 @@ def test_smart_insert():
     
     users = [User(id=i) for i in range(1, 1 + 10000)]
     
-    st = time.clock()
     for user in users:
         try:
             user.save()
         except:
             pass
-    elapse2 = time.clock() - st
     
     assert User.objects.count() == 10000 # after regular insert, we got 10000 doc
     
-    assert elapse1 <= elapse2
-    
+
+def test_bulk_insert_raw():
+    User.objects.delete()
+    User.objects.insert([User(id=i) for i in range(1, 1 + 10000, 2)])
+
+    data = [{"id": i, "name": "user%s" % i} for i in range(1, 1 + 10000)]
+    report = User.bulk_insert_raw(data)
+
+    assert report["inserted"] == 5000
+    assert report["duplicate"] == 5000
+    assert User.objects.count() == 10000
+    assert User.by_id(2).name == "user2"
+    assert User.by_id(1).name is None  # existing, not overwritten
+
+    try:
+        User.bulk_insert_raw([{"id": "a"}])
+        assert False
+    except mongoengine.ValidationError:
+        pass
+
 
 def test_query():
     User(id=1, name="Jack").save()
@@ -283,4 +491,5 @@ def test_query():
 if __name__ == "__main__":
     #
     test_smart_insert()
+    test_bulk_insert_raw()
     test_query()
\ No newline at end of file
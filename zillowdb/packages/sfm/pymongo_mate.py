@@ -6,7 +6,16 @@ extend the power of pymongo.
 """
 
 import math
+import time
+import threading
+from collections import deque
 import pymongo
+from pymongo import UpdateOne
+
+try:
+    from .metrics import metrics, perf_counter
+except:
+    from metrics import metrics, perf_counter
 
 
 def grouper_list(l, n):
@@ -42,6 +51,7 @@ def grouper_list(l, n):
         yield chunk
 
 
+@metrics.timed("insert", helper="pymongo_mate.smart_insert")
 def smart_insert(col, data, minimal_size=5):
     """An optimized Insert strategy.
 
@@ -57,7 +67,16 @@ def smart_insert(col, data, minimal_size=5):
 
     该Insert策略在内存上需要额外的 sqrt(nbytes) 的开销, 跟原数据相比体积很小。
     但时间上是各种情况下平均最优的。
+
+    注: 在大部分文档已经存在时, 该策略会退化为大量的逐条插入, 请使用
+    :func:`bulk_insert`。本函数保留作为性能对比的基准。
     """
+    n = len(data) if isinstance(data, list) else 1
+    metrics.counter("insert_rows", helper="pymongo_mate.smart_insert").inc(n)
+    _smart_insert(col, data, minimal_size)
+
+
+def _smart_insert(col, data, minimal_size):
     if isinstance(data, list):
         # 首先进行尝试bulk insert
         try:
@@ -71,7 +90,7 @@ def smart_insert(col, data, minimal_size=5):
                 # 则进行分包
                 n_chunk = math.floor(math.sqrt(n))
                 for chunk in grouper_list(data, n_chunk):
-                    smart_insert(col, chunk, minimal_size)
+                    _smart_insert(col, chunk, minimal_size)
             # 否则则一条条地逐条插入
             else:
                 for doc in data:
@@ -86,6 +105,373 @@ def smart_insert(col, data, minimal_size=5):
             pass
 
 
+DUPLICATE_KEY_ERROR_CODES = set([11000, 11001, 12582])
+
+
+@metrics.timed("insert", helper="pymongo_mate.bulk_insert")
+def bulk_insert(col, data, upsert_fields=None):
+    """Single pass unordered bulk insert. Existing documents (same ``_id``)
+    are skipped by server, and reported as duplicate, nothing is retried.
+
+    :param data: list of dict.
+    :param upsert_fields: optional list of field name, for duplicate 
+      documents, ``$set`` these fields with new value in one extra unordered
+      ``bulk_write``.
+    :returns: a report dict, ``{"inserted": int, "duplicate": int, 
+      "failed": int, "updated": int, "errors": [error detail, ...]}``.
+      ``errors`` only contains non-duplicate errors.
+
+    **中文文档**
+
+    使用 ``insert_many(ordered=False)`` 一次性插入所有文档, 服务器会跳过已经存在的
+    文档并继续插入其他文档, 所以只需要一次网络往返。在重复爬取时大部分文档已存在,
+    这比 :func:`smart_insert` 的递归分包快很多。:func:`smart_insert` 保留作为
+    性能对比的基准。
+    """
+    report = {
+        "inserted": 0, "duplicate": 0, "failed": 0, "updated": 0,
+        "errors": list(),
+    }
+    if not data:
+        return report
+    metrics.counter(
+        "insert_rows", helper="pymongo_mate.bulk_insert").inc(len(data))
+
+    duplicate_index = list()
+    try:
+        result = col.insert_many(data, ordered=False)
+        report["inserted"] = len(result.inserted_ids)
+    except pymongo.errors.BulkWriteError as e:
+        details = e.details
+        report["inserted"] = details.get("nInserted", 0)
+        for error in details.get("writeErrors", list()):
+            if error.get("code") in DUPLICATE_KEY_ERROR_CODES:
+                report["duplicate"] += 1
+                duplicate_index.append(error["index"])
+            else:
+                report["failed"] += 1
+                report["errors"].append(error)
+
+    if upsert_fields and duplicate_index:
+        requests = list()
+        for index in duplicate_index:
+            doc = data[index]
+            set_doc = {
+                field: doc[field] for field in upsert_fields if field in doc
+            }
+            if set_doc:
+                requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": set_doc}))
+        if requests:
+            try:
+                result = col.bulk_write(requests, ordered=False)
+                report["updated"] = result.modified_count
+            except pymongo.errors.BulkWriteError as e:
+                report["updated"] = e.details.get("nModified", 0)
+                report["errors"].extend(e.details.get("writeErrors", list()))
+
+    return report
+
+
+def iter_docs(col, filters=None, projection=None, batch_size=1000,
+              no_cursor_timeout=True):
+    """Stream documents, only ``batch_size`` documents are in memory at a
+    time, no matter how many are matched.
+
+    :param projection: pymongo projection, only fetch fields you need.
+    :param no_cursor_timeout: a long running consumer may not ask for next 
+      batch within 10 minutes, keep the cursor alive on server, it's closed
+      when the iteration ends.
+
+    **中文文档**
+
+    以流的方式遍历文档, 内存中最多只有一个 batch 的文档。配合 projection 只取需要
+    的字段, 可以极大的减少内存和网络开销。
+    """
+    if filters is None:
+        filters = dict()
+    cursor = col.find(filters, projection, no_cursor_timeout=no_cursor_timeout)
+    cursor.batch_size(batch_size)
+    try:
+        for doc in cursor:
+            yield doc
+    finally:
+        cursor.close()
+
+
+def count_docs(col, filters=None):
+    """Count matched documents on server side, nothing is fetched.
+
+    **中文文档**
+
+    在服务器端计数, 不需要将文档取回本地。
+    """
+    if filters is None:
+        filters = dict()
+    try:
+        return col.count_documents(filters)
+    except AttributeError:  # pymongo < 3.7
+        return col.count(filters)
+
+
+class WriteBehindBuffer(object):
+    """Collect single document updates, write them with unordered 
+    ``bulk_write`` when ``max_size`` updates are buffered, or the oldest one
+    is older than ``max_age`` seconds. Thread safe.
+
+    Usage::
+
+        >>> with WriteBehindBuffer(max_size=500, max_age=5.0) as buffer:
+        ...     buffer.update_one(col, {"_id": 1}, {"$set": {"status": 3}})
+
+    Counter increments of the same document, buffered by 
+    :meth:`WriteBehindBuffer.inc`, are merged into one upsert.
+
+    Latency of every flush is recorded, see :meth:`WriteBehindBuffer.stats`.
+
+    Failed updates are not lost: updates rejected by a ``BulkWriteError``
+    are buffered again and written in the next flush. On other errors (e.g.
+    ``AutoReconnect``) which updates are applied is unknown, only idempotent
+    ones (e.g. ``$set``) are retried, increments (``$inc``) may be applied
+    already, they are given up at once instead of being counted twice. An
+    update failed more than ``max_retry`` times is given up and kept in
+    ``failed_ops``.
+
+    **中文文档**
+
+    延迟写入缓冲区。将逐条的 update 收集起来, 当数量达到 ``max_size``, 或最早的
+    一条等待超过 ``max_age`` 秒时, 用一次无序的 bulk_write 写入。退出 with 语句
+    或调用 :meth:`~WriteBehindBuffer.close` 时会写入剩余的所有 update。写入失败的
+    update 会被放回缓冲区重试, 超过 ``max_retry`` 次后放弃, 保存在 ``failed_ops``
+    中。连接错误时不知道哪些 update 已经写入, 只重试幂等的 update, ``$inc`` 直接
+    放弃, 以免重复计数。
+    """
+
+    def __init__(self, max_size=500, max_age=5.0, max_retry=3):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_retry = max_retry
+        self._col_table = dict()
+        self._op_table = dict()
+        self._inc_table = dict()  # {col key: {_id: {field: n}}}
+        # {col key: [(op, n_attempt, idempotent), ...]}
+        self._retry_table = dict()
+        self._size = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.n_flush = 0
+        self.n_write = 0
+        self.n_error = 0
+        self.n_failed = 0
+        self.last_error = None
+        self.failed_ops = deque(maxlen=10000)
+        self.flush_latency = deque(maxlen=10000)
+
+    def start(self):
+        """Start background thread flushing aged updates.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        interval = max(self.max_age / 2.0, 0.01)
+        while not self._stop.wait(interval):
+            oldest = self._oldest
+            if oldest is not None and time.time() - oldest >= self.max_age:
+                self.flush()
+
+    def update_one(self, col, filter, update):
+        """Buffer an ``UpdateOne(filter, update)`` on col.
+        """
+        key = col.full_name
+        with self._lock:
+            if key not in self._op_table:
+                self._col_table[key] = col
+                self._op_table[key] = list()
+            self._op_table[key].append((
+                UpdateOne(filter, update), self._is_idempotent(update)))
+            self._size += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = self._size >= self.max_size
+        if full:
+            self.flush()
+
+    def inc(self, col, _id, inc_doc):
+        """Buffer an ``$inc`` of counters of a document, the document is 
+        created if not exists. Increments of the same document are merged.
+        """
+        key = col.full_name
+        with self._lock:
+            if key not in self._inc_table:
+                self._col_table[key] = col
+                self._inc_table[key] = dict()
+            counters = self._inc_table[key].get(_id)
+            if counters is None:
+                counters = self._inc_table[key][_id] = dict()
+                self._size += 1
+            for field, n in inc_doc.items():
+                counters[field] = counters.get(field, 0) + n
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = self._size >= self.max_size
+        if full:
+            self.flush()
+
+    @staticmethod
+    def _is_idempotent(update):
+        """Applying the update twice is the same as once.
+        """
+        if not isinstance(update, dict):  # pipeline
+            return False
+        return not any(operator in update for operator in
+                       ("$inc", "$mul", "$push", "$pop", "$bit"))
+
+    @staticmethod
+    def _parse_error(e, n_op):
+        """Number of written updates, indexes of failed updates, of a failed
+        unordered ``bulk_write``, and whether failed updates are known to be
+        not applied.
+        """
+        details = getattr(e, "details", None)
+        if isinstance(details, dict) and "writeErrors" in details:
+            failed_index = sorted(set(
+                error["index"] for error in details["writeErrors"]))
+            # an update either matches, or upserts a document
+            n_written = sum(details.get(field) or 0 for field in
+                            ("nInserted", "nUpserted", "nMatched"))
+            return (min(n_written, n_op - len(failed_index)), failed_index,
+                    True)
+        # e.g. AutoReconnect, don't know what is written
+        return 0, list(range(n_op)), False
+
+    def flush(self):
+        """Write all buffered updates now.
+
+        :returns: number of updates written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                op_table, self._op_table = self._op_table, dict()
+                inc_table, self._inc_table = self._inc_table, dict()
+                retry_table, self._retry_table = self._retry_table, dict()
+                self._size = 0
+                self._oldest = None
+
+            # {col key: [(op, n_attempt, idempotent), ...]}
+            batch_table = dict()
+            for key, ops in op_table.items():
+                batch_table[key] = [(op, 0, idempotent)
+                                    for op, idempotent in ops]
+            for key, inc_docs in inc_table.items():
+                batch = batch_table.setdefault(key, list())
+                for _id, counters in inc_docs.items():
+                    counters = {
+                        field: n for field, n in counters.items() if n}
+                    if counters:
+                        batch.append((UpdateOne(
+                            {"_id": _id}, {"$inc": counters}, upsert=True),
+                            0, False))
+            for key, batch in retry_table.items():
+                batch_table.setdefault(key, list()).extend(batch)
+
+            n = 0
+            retry_table = dict()
+            st = perf_counter()
+            for key, batch in batch_table.items():
+                if not batch:
+                    continue
+                ops = [op for op, _, _ in batch]
+                try:
+                    self._col_table[key].bulk_write(ops, ordered=False)
+                    n += len(ops)
+                    continue
+                except Exception as e:  # BulkWriteError, AutoReconnect
+                    self.n_error += 1
+                    self.last_error = e
+                    metrics.counter(
+                        "flush_errors", helper="WriteBehindBuffer").inc()
+                    n_written, failed_index, not_applied = \
+                        self._parse_error(e, len(ops))
+                n += n_written
+                for index in failed_index:
+                    op, n_attempt, idempotent = batch[index]
+                    if n_attempt < self.max_retry \
+                            and (not_applied or idempotent):
+                        retry_table.setdefault(key, list()).append(
+                            (op, n_attempt + 1, idempotent))
+                    else:
+                        self.n_failed += 1
+                        self.failed_ops.append(op)
+                        metrics.counter("flush_failed_rows",
+                                        helper="WriteBehindBuffer").inc()
+
+            if retry_table:
+                with self._lock:
+                    for key, batch in retry_table.items():
+                        self._retry_table.setdefault(key, list()).extend(batch)
+                        self._size += len(batch)
+                    if self._oldest is None:
+                        self._oldest = time.time()
+            if n:
+                elapsed = perf_counter() - st
+                self.flush_latency.append(elapsed)
+                self.n_flush += 1
+                self.n_write += n
+                metrics.histogram(
+                    "flush_seconds", helper="WriteBehindBuffer").record(elapsed)
+                metrics.counter(
+                    "flush_rows", helper="WriteBehindBuffer").inc(n)
+            return n
+
+    def close(self):
+        """Stop background thread and flush everything, failed updates are
+        retried up to ``max_retry`` times.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        for i in range(self.max_retry):
+            if not self._retry_table:
+                break
+            time.sleep(min(1.0, 0.1 * 2 ** i))
+            self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        """Flush count, written updates, errors, given up updates and flush 
+        latency in seconds.
+        """
+        latency = sorted(self.flush_latency)
+        if latency:
+            avg = sum(latency) / len(latency)
+            p99 = latency[min(len(latency) - 1, int(len(latency) * 0.99))]
+            max_ = latency[-1]
+        else:
+            avg = p99 = max_ = None
+        return {
+            "n_flush": self.n_flush,
+            "n_write": self.n_write,
+            "n_error": self.n_error,
+            "n_failed": self.n_failed,
+            "flush_latency_avg": avg,
+            "flush_latency_p99": p99,
+            "flush_latency_max": max_,
+        }
+
+
 def select_all(col):
     return list(col.find())
 
@@ -160,9 +546,7 @@ if __name__ == "__main__":
         # Smart Insert
         insert_test_data()
 
-        st = time.clock()
         smart_insert(col, data)
-        elapse1 = time.clock() - st
 
         # after smart insert, we got 10000 doc
         assert col.find().count() == 10000
@@ -170,21 +554,97 @@ if __name__ == "__main__":
         # Regular Insert
         insert_test_data()
 
-        st = time.clock()
         for doc in data:
             try:
                 col.insert(doc)
             except:
                 pass
-        elapse2 = time.clock() - st
 
         # after regular insert, we got 10000 doc
         assert col.find().count() == 10000
 
-        assert elapse1 <= elapse2
-
     test_smart_insert()
 
+    @run_if_is_main(__name__)
+    def test_bulk_insert():
+        col.remove({})
+        col.insert([{"_id": i, "v": 0} for i in range(0, 10000, 2)])
+
+        data = [{"_id": i, "v": 1} for i in range(10000)]
+        report = bulk_insert(col, data, upsert_fields=["v"])
+        assert report["inserted"] == 5000
+        assert report["duplicate"] == 5000
+        assert report["updated"] == 5000
+        assert col.find({"v": 1}).count() == 10000
+
+        # re-crawl: 90% of documents already exist
+        col.remove({})
+        col.insert([{"_id": i} for i in range(9000)])
+        report = bulk_insert(col, [{"_id": i} for i in range(10000)])
+        assert report["inserted"] == 1000
+        assert report["duplicate"] == 9000
+        assert report["failed"] == 0
+        assert col.find().count() == 10000
+        assert col.find({"_id": 9999}).count() == 1
+
+    test_bulk_insert()
+
+    @run_if_is_main(__name__)
+    def test_write_behind_buffer():
+        col.remove({})
+        col.insert([{"_id": 1, "k": 1}, {"_id": 2, "k": 2}])
+        col.create_index("k", unique=True)
+
+        buffer = WriteBehindBuffer(max_size=100, max_age=60, max_retry=1)
+        buffer.update_one(col, {"_id": 1}, {"$set": {"v": 1}})
+        buffer.update_one(col, {"_id": 2}, {"$set": {"k": 1}})  # duplicate
+        assert buffer.flush() == 1
+        assert buffer.n_write == 1 and buffer.n_error == 1
+
+        # failed update is retried, then given up
+        assert buffer.flush() == 0
+        assert buffer.n_write == 1 and buffer.n_error == 2
+        assert buffer.n_failed == 1 and len(buffer.failed_ops) == 1
+        assert buffer.flush() == 0
+        col.drop_index("k_1")
+
+    test_write_behind_buffer()
+
+    @run_if_is_main(__name__)
+    def test_write_behind_buffer_reconnect():
+        from pymongo.errors import AutoReconnect
+
+        class FlakyCollection(object):
+            """Apply the batch, then lose the connection.
+            """
+            full_name = "test.flaky"
+
+            def __init__(self):
+                self.n_fail = 1
+
+            def bulk_write(self, ops, ordered=True):
+                col.bulk_write(ops, ordered=ordered)
+                if self.n_fail:
+                    self.n_fail -= 1
+                    raise AutoReconnect("connection reset")
+
+        col.remove({})
+        col.insert({"_id": 1})
+        flaky_col = FlakyCollection()
+        buffer = WriteBehindBuffer(max_size=100, max_age=60, max_retry=3)
+        buffer.update_one(flaky_col, {"_id": 1}, {"$set": {"v": 1}})
+        buffer.inc(flaky_col, 2, {"n": 1})
+        assert buffer.flush() == 0
+
+        # $set is retried, $inc may be applied, it's given up
+        assert buffer.n_failed == 1
+        assert buffer.flush() == 1
+        assert col.find_one({"_id": 1})["v"] == 1
+        assert col.find_one({"_id": 2})["n"] == 1
+        assert buffer.flush() == 0
+
+    test_write_behind_buffer_reconnect()
+
     @run_if_is_main(__name__)
     def test_selelct_field():
         def insert_test_data():
@@ -4,7 +4,8 @@
 import math
 from collections import OrderedDict
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import select, func, distinct
+from sqlalchemy import select, func, distinct, text
+from sqlalchemy import MetaData, Table, Column
 
 try:
     import pandas as pd
@@ -16,6 +17,11 @@ try:
 except:
     pass
 
+try:
+    from .metrics import metrics
+except:
+    from metrics import metrics
+
 
 def grouper_list(l, n):
     """Evenly divide list into fixed-length piece, no filled value if chunk
@@ -50,6 +56,7 @@ def grouper_list(l, n):
         yield chunk
 
 
+@metrics.timed("insert", helper="sqlalchemy_mate.smart_insert")
 def smart_insert(engine, table, data, minimal_size=5):
     """An optimized Insert strategy.
 
@@ -66,6 +73,12 @@ def smart_insert(engine, table, data, minimal_size=5):
     该Insert策略在内存上需要额外的 sqrt(nbytes) 的开销, 跟原数据相比体积很小。
     但时间上是各种情况下平均最优的。
     """
+    n = len(data) if isinstance(data, list) else 1
+    metrics.counter("insert_rows", helper="sqlalchemy_mate.smart_insert").inc(n)
+    _smart_insert(engine, table, data, minimal_size)
+
+
+def _smart_insert(engine, table, data, minimal_size):
     insert = table.insert()
 
     if isinstance(data, list):
@@ -81,7 +94,7 @@ def smart_insert(engine, table, data, minimal_size=5):
                 # 则进行分包
                 n_chunk = math.floor(math.sqrt(n))
                 for chunk in grouper_list(data, n_chunk):
-                    smart_insert(engine, table, chunk, minimal_size)
+                    _smart_insert(engine, table, chunk, minimal_size)
             # 否则则一条条地逐条插入
             else:
                 for row in data:
@@ -96,6 +109,175 @@ def smart_insert(engine, table, data, minimal_size=5):
             pass
 
 
+def _count(connection, table):
+    return connection.execute(
+        select([func.count()]).select_from(table)).scalar()
+
+
+def _quote_columns(engine, columns):
+    preparer = engine.dialect.identifier_preparer
+    return [preparer.quote(column.name) for column in columns]
+
+
+def _sqlite_upsert(engine, table, update_columns):
+    """``INSERT ... ON CONFLICT (pk) DO UPDATE``, requires sqlite 3.24+.
+    sqlalchemy < 1.4 can't build it, so it's written in text.
+    """
+    preparer = engine.dialect.identifier_preparer
+    columns = list(table.columns)
+    names = _quote_columns(engine, columns)
+    pk_names = _quote_columns(engine, table.primary_key.columns)
+    update_names = [preparer.quote(name) for name in update_columns]
+    sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s" % (
+        preparer.format_table(table),
+        ", ".join(names),
+        ", ".join([":%s" % column.name for column in columns]),
+        ", ".join(pk_names),
+        ", ".join(["%s = excluded.%s" % (name, name) for name in update_names]),
+    )
+    return text(sql)
+
+
+def _postgresql_upsert(table, update_columns):
+    from sqlalchemy.dialects.postgresql import insert
+
+    insert = insert(table)
+    pk_names = [column.name for column in table.primary_key.columns]
+    if update_columns:
+        return insert.on_conflict_do_update(
+            index_elements=pk_names,
+            set_={name: insert.excluded[name] for name in update_columns},
+        )
+    else:
+        return insert.on_conflict_do_nothing(index_elements=pk_names)
+
+
+def _mysql_upsert(table, update_columns):
+    from sqlalchemy.dialects.mysql import insert
+
+    insert = insert(table)
+    if update_columns:
+        return insert.on_duplicate_key_update(
+            **{name: insert.inserted[name] for name in update_columns})
+    else:
+        return insert.prefix_with("IGNORE")
+
+
+def _mssql_merge(engine, connection, table, data, update_columns):
+    """Load data into a staging temp table, then one ``MERGE`` into target.
+    """
+    preparer = engine.dialect.identifier_preparer
+    stage = Table(
+        "#stage_%s" % table.name, MetaData(),
+        *[Column(column.name, column.type) for column in table.columns]
+    )
+    stage.create(connection)
+    try:
+        connection.execute(stage.insert(), data)
+
+        names = _quote_columns(engine, table.columns)
+        on = " AND ".join([
+            "t.%s = s.%s" % (name, name)
+            for name in _quote_columns(engine, table.primary_key.columns)
+        ])
+        sql = "MERGE INTO %s AS t USING %s AS s ON %s" % (
+            preparer.format_table(table), preparer.format_table(stage), on)
+        if update_columns:
+            update_names = [preparer.quote(name) for name in update_columns]
+            sql += " WHEN MATCHED THEN UPDATE SET %s" % ", ".join([
+                "t.%s = s.%s" % (name, name) for name in update_names])
+        sql += " WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s);" % (
+            ", ".join(names), ", ".join(["s.%s" % name for name in names]))
+        return connection.execute(text(sql)).rowcount
+    finally:
+        stage.drop(connection)
+
+
+@metrics.timed("insert", helper="sqlalchemy_mate.bulk_upsert")
+def bulk_upsert(engine, table, data, update_columns=None, batch_size=1000):
+    """Insert rows, rows already exist (same primary key) are skipped, or
+    updated if ``update_columns`` is given. Use the fastest strategy of the
+    database, all batches are executed in one transaction (except the
+    fallback):
+
+    - sqlite: ``INSERT OR IGNORE``, or ``INSERT ... ON CONFLICT DO UPDATE``.
+    - postgresql: ``INSERT ... ON CONFLICT DO NOTHING / DO UPDATE``.
+    - mysql: ``INSERT IGNORE``, or ``INSERT ... ON DUPLICATE KEY UPDATE``.
+    - mssql: load into a staging temp table, then ``MERGE``. For pyodbc,
+      create engine with ``fast_executemany=True`` to load staging table fast.
+    - others: fall back to :func:`smart_insert`, every attempt is committed
+      on its own, a failed insert aborts the whole transaction on some
+      databases (e.g. postgresql).
+
+    :param data: list of dict.
+    :param update_columns: list of column name to update on conflict.
+    :param batch_size: number of rows sent in one executemany.
+    :returns: ``{"inserted": int, "skipped": int}``, skipped means already
+      exists (and updated if ``update_columns`` is given).
+
+    **中文文档**
+
+    根据数据库的类型, 选择最快的批量插入方式, 遇到主键冲突时跳过或更新, 不会
+    出现 :func:`smart_insert` 那样退化为逐条插入的情况。当数据库驱动能返回
+    可靠的 rowcount 时用它统计插入的行数, 否则在同一个事务中比较插入前后的行数。
+    """
+    if not isinstance(data, list):
+        data = [data, ]
+    report = {"inserted": 0, "skipped": 0}
+    if not data:
+        return report
+    metrics.counter(
+        "insert_rows", helper="sqlalchemy_mate.bulk_upsert").inc(len(data))
+
+    dialect = engine.dialect
+    name = dialect.name
+    if name == "sqlite":
+        if update_columns:
+            statement = _sqlite_upsert(engine, table, update_columns)
+        else:
+            statement = table.insert().prefix_with("OR IGNORE")
+    elif name == "postgresql":
+        statement = _postgresql_upsert(table, update_columns)
+    elif name == "mysql":
+        statement = _mysql_upsert(table, update_columns)
+    else:
+        statement = None
+
+    # rowcount of upsert also counts updated rows
+    use_rowcount = not update_columns
+    if name == "mssql":
+        use_rowcount = use_rowcount and dialect.supports_sane_rowcount
+    elif statement is None:
+        use_rowcount = False
+    else:
+        use_rowcount = use_rowcount and dialect.supports_sane_multi_rowcount
+
+    if statement is None and name != "mssql":
+        before = count_row(engine, table)
+        _smart_insert(engine, table, data, minimal_size=5)
+        inserted = count_row(engine, table) - before
+    else:
+        with engine.begin() as connection:
+            if not use_rowcount:
+                before = _count(connection, table)
+
+            inserted = 0
+            if name == "mssql":
+                for chunk in grouper_list(data, batch_size):
+                    inserted += _mssql_merge(
+                        engine, connection, table, chunk, update_columns)
+            else:
+                for chunk in grouper_list(data, batch_size):
+                    inserted += connection.execute(statement, chunk).rowcount
+
+            if not use_rowcount:
+                inserted = _count(connection, table) - before
+
+    report["inserted"] = inserted
+    report["skipped"] = len(data) - inserted
+    return report
+
+
 def count_row(engine, table):
     """Return number of rows in a table.
 
@@ -217,4 +399,62 @@ def sql_to_pretty_table(sql, engine):
     # 我也不知道为什么
     result_proxy = engine.execute(sql)
     table = from_db_cursor(result_proxy.cursor)
-    return table
\ No newline at end of file
+    return table
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    from sqlalchemy import create_engine, Integer, String
+
+    def test_bulk_upsert():
+        engine = create_engine("sqlite://")
+        metadata = MetaData()
+        t_user = Table("user", metadata,
+            Column("id", Integer, primary_key=True),
+            Column("name", String),
+        )
+        metadata.create_all(engine)
+
+        def prepare():
+            engine.execute(t_user.delete())
+            engine.execute(t_user.insert(),
+                           [{"id": i, "name": "old"} for i in range(0, 10000, 2)])
+            return [{"id": i, "name": "new"} for i in range(10000)]
+
+        data = prepare()
+        smart_insert(engine, t_user, data)
+        assert count_row(engine, t_user) == 10000
+
+        data = prepare()
+        report = bulk_upsert(engine, t_user, data)
+        assert report == {"inserted": 5000, "skipped": 5000}
+        assert count_row(engine, t_user) == 10000
+        assert engine.execute(
+            select([func.count()]).where(t_user.c.name == "old")).scalar() == 5000
+
+        report = bulk_upsert(engine, t_user, data, update_columns=["name"])
+        assert report == {"inserted": 0, "skipped": 10000}
+        assert engine.execute(
+            select([func.count()]).where(t_user.c.name == "old")).scalar() == 0
+
+    test_bulk_upsert()
+
+    def test_bulk_upsert_fallback():
+        engine = create_engine("sqlite://")
+        # pretend to be a database without upsert statement
+        engine.dialect.name = "unknown"
+        metadata = MetaData()
+        t_user = Table("user", metadata,
+            Column("id", Integer, primary_key=True),
+            Column("name", String),
+        )
+        metadata.create_all(engine)
+        engine.execute(t_user.insert(),
+                       [{"id": i, "name": "old"} for i in range(0, 100, 2)])
+
+        data = [{"id": i, "name": "new"} for i in range(100)]
+        report = bulk_upsert(engine, t_user, data)
+        assert report == {"inserted": 50, "skipped": 50}
+        assert count_row(engine, t_user) == 100
+
+    test_bulk_upsert_fallback()
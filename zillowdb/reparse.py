@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Re-parse pages kept in the html cache, without visiting zillow again.
+
+Cache files are fanned out to a process pool. A worker reads and parses one
+file, and passes back only a compact result (tuples and dicts, never soup
+objects). The main process turns the results into children of each level and
+house details, and writes them in bulk.
+
+The level of a list page is known from the depth of its url path, and the
+parent document is rebuilt from the path, so no query is needed::
+
+    /browse/homes/                               -> state level
+    /browse/homes/md/                            -> county level
+    /browse/homes/md/montgomery-county/          -> zipcode level
+    /browse/homes/md/montgomery-county/20878/    -> street level
+    /browse/homes/md/montgomery-county/20878/x/  -> address level
+    /homedetails/...-MD-20817/37183103_zpid/     -> house detail
+
+Usage::
+
+    >>> from zillowdb.reparse import reparse
+    >>> reparse()
+
+**中文文档**
+
+从 html 缓存中重新解析所有页面。解析使用多进程, 子进程只返回简单的元组和字典,
+主进程负责批量写入数据库。列表页属于哪个层级由 url 的路径深度决定, 父文档的
+各个字段也由路径还原, 不需要查询数据库。
+"""
+
+import time
+import multiprocessing
+
+try:
+    from urllib.parse import urlparse
+except:
+    from urlparse import urlparse
+
+from zillowdb.htmlparser import htmlparser
+
+from zillowdb.model import StatusCode
+from zillowdb.packages.crawlib.cache import HtmlCache
+
+LIST = "list"
+DETAIL = "detail"
+
+BROWSE_PREFIX = "/browse/homes"
+DETAIL_PREFIX = "/homedetails/"
+
+# parent fields, in url path order
+PATH_FIELDS = ["state", "county", "zipcode", "street"]
+
+
+def classify(url):
+    """Return ``(kind, depth, _id)``.
+
+    - list page: ``("list", depth, parent _id)``, parent _id is None for the
+      root page.
+    - detail page: ``("detail", None, address _id)``.
+    - others: ``(None, None, None)``.
+    """
+    path = urlparse(url).path
+    if path.startswith(DETAIL_PREFIX):
+        if not path.endswith("/"):
+            path = path + "/"
+        return DETAIL, None, path
+    if path.startswith(BROWSE_PREFIX):
+        rest = path[len(BROWSE_PREFIX):].strip("/")
+        if not rest:
+            return LIST, 0, None
+        return LIST, len(rest.split("/")), rest + "/"
+    return None, None, None
+
+
+def state_of_detail(_id):
+    """``/homedetails/8510-Whittier-Blvd-Bethesda-MD-20817/37183103_zpid/``
+    => ``md``
+    """
+    return _id.split("/")[-3].split("-")[-2].lower()
+
+
+def make_parent(parent_id):
+    """Rebuild the projected parent document from its _id.
+    """
+    if parent_id is None:
+        return None
+    parts = parent_id.strip("/").split("/")
+    parent = {"_id": parent_id, "key": parts[-1]}
+    for field, value in zip(PATH_FIELDS, parts[:-1]):
+        parent[field] = value
+    return parent
+
+
+def parse_file(path):
+    """Process pool worker, parse one cache file.
+
+    :returns: ``(kind, depth, _id, data, error)``, data is list of
+      ``(link, name)`` for list page, dict for detail page, error is None or
+      a short message.
+    """
+    try:
+        url, html = HtmlCache.read_file(path)
+    except Exception as e:
+        return None, None, path, None, "%r" % e
+
+    kind, depth, _id = classify(url)
+    try:
+        if kind == LIST:
+            data = [tuple(item) for item in htmlparser.get_items(html, url)]
+        elif kind == DETAIL:
+            data = htmlparser.get_house_detail(html)
+        else:
+            data = None
+    except Exception as e:
+        return kind, depth, _id, None, "%s: %r" % (url, e)
+    return kind, depth, _id, data, None
+
+
+def reparse(cache=None, levels=None, n_process=None, chunksize=64,
+            batch_size=1000, logger=None):
+    """Re-parse all pages in the html cache, upsert children of each level,
+    and house details.
+
+    :param cache: :class:`~zillowdb.packages.crawlib.cache.HtmlCache`, default
+      is the cache used by the crawlers.
+    :param levels: list of :class:`~zillowdb.crawler_engine.Level`, indexed
+      by url depth, default are the levels of the crawlers.
+    :param n_process: number of parser processes, default is number of cpu.
+    :param chunksize: number of files sent to a worker at a time.
+    :param batch_size: children are written when this many are collected.
+    :returns: dict of counters.
+    """
+    from zillowdb import crawler_mongo
+    from zillowdb.mongodb import address_col_mapper
+    from zillowdb.packages.sfm.pymongo_mate import WriteBehindBuffer
+
+    if cache is None:
+        cache = crawler_mongo.html_cache
+    if levels is None:
+        levels = [
+            crawler_mongo.state_level,
+            crawler_mongo.county_level,
+            crawler_mongo.zipcode_level,
+            crawler_mongo.street_level,
+            crawler_mongo.address_level,
+        ]
+    if logger is None:
+        logger = crawler_mongo.create_zillow_crawler_logger()
+
+    stats = {"n_page": 0, "n_list": 0, "n_detail": 0, "n_child": 0,
+             "n_error": 0, "n_unknown": 0}
+
+    # (depth, state) -> (level, a parent, children, [(parent, n_children)])
+    pending = dict()
+
+    def flush(key):
+        level, parent, children, finished = pending.pop(key)
+        upsert_fields = ["name"] + [field for field, _ in level.propagate]
+        level.store_children(parent, children, upsert_fields=upsert_fields,
+                             buffer=buffer)
+        # a parent is finished only after its children are written
+        for parent, n_children in finished:
+            level.mark_parent(
+                parent, StatusCode.finished, n_children, buffer=buffer)
+
+    def handle_list(buffer, depth, parent_id, items, error):
+        if depth >= len(levels):
+            stats["n_unknown"] += 1
+            return
+        level = levels[depth]
+        parent = make_parent(parent_id)
+        if error is not None or not items:
+            level.mark_parent(
+                parent, StatusCode.crawled_but_has_error, buffer=buffer)
+            return
+
+        children = [level.make_child(parent, link, name)
+                    for link, name in items]
+        key = (depth, parent.get("state") if parent else None)
+        if key not in pending:
+            pending[key] = (level, parent, list(), list())
+        pending[key][2].extend(children)
+        pending[key][3].append((parent, len(children)))
+        stats["n_child"] += len(children)
+        if len(pending[key][2]) >= batch_size:
+            flush(key)
+
+    def handle_detail(buffer, _id, data, error):
+        try:
+            col = address_col_mapper[state_of_detail(_id)]
+        except (KeyError, IndexError):
+            stats["n_unknown"] += 1
+            return
+        if error is not None or data is None:
+            set_doc = {"status_zillow": StatusCode.crawled_but_has_error}
+        else:
+            set_doc = {"zillow_detail": data,
+                       "status_zillow": StatusCode.finished}
+        buffer.update_one(col, {"_id": _id}, {"$set": set_doc})
+
+    if n_process is None:
+        n_process = multiprocessing.cpu_count()
+    logger.info("Re-parse %s with %s process ..." % (cache.root, n_process))
+    st = time.time()
+    pool = multiprocessing.Pool(n_process)
+    buffer = WriteBehindBuffer(max_size=batch_size, max_age=5.0)
+    try:
+        with buffer:
+            results = pool.imap_unordered(
+                parse_file, cache.iter_files(), chunksize)
+            for kind, depth, _id, data, error in results:
+                stats["n_page"] += 1
+                if error is not None:
+                    stats["n_error"] += 1
+                if kind == LIST:
+                    stats["n_list"] += 1
+                    handle_list(buffer, depth, _id, data, error)
+                elif kind == DETAIL:
+                    stats["n_detail"] += 1
+                    handle_detail(buffer, _id, data, error)
+                else:
+                    stats["n_unknown"] += 1
+
+                if stats["n_page"] % 10000 == 0:
+                    logger.info("%s pages, %.1f pages/sec ..." % (
+                        stats["n_page"], stats["n_page"] / (time.time() - st)), 1)
+
+            for key in list(pending):
+                flush(key)
+    except Exception:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    # old status of re-parsed documents is unknown, recount
+    for crawl_stats in set(level.stats for level in levels
+                           if level.stats is not None):
+        crawl_stats.reconcile()
+
+    elapsed = time.time() - st
+    logger.info("Complete %s pages in %.2f sec, %.1f pages/sec, %s" % (
+        stats["n_page"], elapsed,
+        stats["n_page"] / elapsed if elapsed else 0.0, stats))
+    return stats
+
+
+#--- Unittest ---
+def test_classify():
+    assert classify("https://www.zillow.com/browse/homes/") == (LIST, 0, None)
+    assert classify("https://www.zillow.com/browse/homes/md/") == \
+        (LIST, 1, "md/")
+    assert classify(
+        "https://www.zillow.com/browse/homes/md/montgomery-county/20878/") == \
+        (LIST, 3, "md/montgomery-county/20878/")
+    assert classify(
+        "https://www.zillow.com/homedetails/"
+        "8510-Whittier-Blvd-Bethesda-MD-20817/37183103_zpid") == \
+        (DETAIL, None,
+         "/homedetails/8510-Whittier-Blvd-Bethesda-MD-20817/37183103_zpid/")
+    assert classify("https://www.zillow.com/") == (None, None, None)
+
+
+def test_make_parent():
+    assert make_parent(None) is None
+    assert make_parent("md/") == {"_id": "md/", "key": "md"}
+    assert make_parent("md/montgomery-county/20878/") == {
+        "_id": "md/montgomery-county/20878/", "key": "20878",
+        "state": "md", "county": "montgomery-county",
+    }
+    parent = make_parent("md/montgomery-county/20878/main-st/")
+    assert "street" not in parent
+    assert parent["zipcode"] == "20878"
+    assert parent["key"] == "main-st"
+
+
+def test_state_of_detail():
+    assert state_of_detail(
+        "/homedetails/8510-Whittier-Blvd-Bethesda-MD-20817/37183103_zpid/"
+    ) == "md"
+    _, _, _id = classify(
+        "https://www.zillow.com/homedetails/1-Main-St-Austin-TX-78701/"
+        "123_zpid")
+    assert state_of_detail(_id) == "tx"
+
+
+if __name__ == "__main__":
+    test_classify()
+    test_make_parent()
+    test_state_of_detail()
+
+#     reparse()
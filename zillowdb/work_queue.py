@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Durable, lease-based work queue over a MongoDB collection.
+
+A worker atomically claims a batch of todo documents by writing its lease
+(owner, expire time) into them. While working, a heartbeat extends the lease.
+When a document is done, the worker releases it with the final status. A lease
+not extended in time expires, then the document can be claimed by others,
+so a crashed worker never loses its work. Many processes on many machines can
+crawl the same level without fetching a page twice.
+
+**中文文档**
+
+基于 MongoDB 的租约式任务队列。worker 通过写入租约 (持有者, 过期时间) 原子性地
+领取一批任务, 工作期间用心跳延长租约, 完成后写入最终状态并释放租约。若 worker
+崩溃, 租约过期后任务会被其他 worker 重新领取。这样同一个层级可以在多台机器的
+多个进程上同时爬取, 而不会重复抓取。
+"""
+
+import os
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+
+LEASE_OWNER = "_lease_owner"
+LEASE_EXPIRE = "_lease_expire"
+LEASE_TOKEN = "_lease_token"
+LEASE_FIELDS = [LEASE_OWNER, LEASE_EXPIRE, LEASE_TOKEN]
+
+
+def default_owner():
+    """``hostname-pid-random``, unique for every queue instance.
+    """
+    return "%s-%s-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaseQueue(object):
+
+    """Lease based work queue.
+
+    Usage::
+
+        >>> queue = LeaseQueue(col, {"status": {"$ne": StatusCode.finished}})
+        >>> with queue.heartbeat():
+        ...     for doc in queue:
+        ...         ... # do work
+        ...         queue.release(doc["_id"], {"status": StatusCode.finished})
+
+    :param col: pymongo Collection.
+    :param filters: pymongo query to select todo documents.
+    :param owner: lease owner name, default is ``hostname-pid-random``.
+    :param lease_seconds: a lease expires if not extended in this time.
+    :param heartbeat_interval: seconds between two heartbeat, default is a
+      third of ``lease_seconds``.
+
+    **中文文档**
+
+    注意: 租约的过期时间使用本机时钟, 多台机器之间的时钟误差应远小于
+    ``lease_seconds``。
+    """
+
+    def __init__(self, col, filters, owner=None,
+                 lease_seconds=600, heartbeat_interval=None):
+        self.col = col
+        self.filters = filters
+        if owner is None:
+            owner = default_owner()
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        if heartbeat_interval is None:
+            heartbeat_interval = lease_seconds / 3.0
+        self.heartbeat_interval = heartbeat_interval
+        self.last_id = None
+
+    def _expire_time(self, now):
+        return now + timedelta(seconds=self.lease_seconds)
+
+    def _claimable(self, now):
+        free = {"$or": [
+            {LEASE_EXPIRE: {"$exists": False}},
+            {LEASE_EXPIRE: None},
+            {LEASE_EXPIRE: {"$lt": now}},
+        ]}
+        return {"$and": [self.filters, free]}
+
+    def claim(self, n, projection=None):
+        """Claim at most n documents, return them as a list of dict.
+
+        Documents are claimed in ``_id`` order after the last claimed one,
+        so one pass of a queue never claims the same document twice, even if
+        it's released with a not finished status. When the pass is done,
+        expired leases behind the last claimed one (e.g. of a crashed
+        worker) are claimed.
+
+        :param projection: pymongo projection of returned documents, default
+          returns all fields except lease fields.
+        """
+        now = datetime.utcnow()
+        filters = self._claimable(now)
+        if self.last_id is not None:
+            filters["$and"].append({"_id": {"$gt": self.last_id}})
+        candidates = self._find_ids(filters, n)
+
+        if candidates:
+            self.last_id = candidates[-1]
+        elif self.last_id is not None:
+            # only expired leases, released documents are not claimed again
+            filters = {"$and": [self.filters, {LEASE_EXPIRE: {"$lt": now}}]}
+            candidates = self._find_ids(filters, n)
+        if not candidates:
+            return list()
+
+        # other worker may claim some of them between find and update,
+        # the lease condition in filters make sure only one of us wins.
+        token = uuid.uuid4().hex
+        filters["$and"].append({"_id": {"$in": candidates}})
+        self.col.update_many(filters, {"$set": {
+            LEASE_OWNER: self.owner,
+            LEASE_EXPIRE: self._expire_time(now),
+            LEASE_TOKEN: token,
+        }})
+
+        if projection is None:
+            projection = {field: False for field in LEASE_FIELDS}
+        return list(self.col.find({LEASE_TOKEN: token}, projection).sort("_id", 1))
+
+    def _find_ids(self, filters, n):
+        return [
+            doc["_id"] for doc in
+            self.col.find(filters, {"_id": True}).sort("_id", 1).limit(n)
+        ]
+
+    def iter_claim(self, batch_size=100, projection=None):
+        """Keep claiming batches, yield document one by one, until nothing
+        is left.
+        """
+        while True:
+            batch = self.claim(batch_size, projection=projection)
+            if not batch:
+                break
+            for doc in batch:
+                yield doc
+
+    def __iter__(self):
+        return self.iter_claim()
+
+    def extend(self):
+        """Extend all leases held by this owner.
+
+        :returns: number of documents extended.
+        """
+        now = datetime.utcnow()
+        result = self.col.update_many(
+            {LEASE_OWNER: self.owner},
+            {"$set": {LEASE_EXPIRE: self._expire_time(now)}},
+        )
+        return result.modified_count
+
+    def release(self, _id, set_doc=None, buffer=None):
+        """Finish a document, ``set_doc`` (usually contains the final status)
+        is written and the lease is removed in one update.
+
+        :param buffer: optional
+          :class:`~zillowdb.packages.sfm.pymongo_mate.WriteBehindBuffer`, if
+          given, the update is buffered. It has to be flushed before
+          :meth:`LeaseQueue.release_all`.
+        :returns: False if the lease is lost (expired and claimed by others),
+          None if buffered.
+        """
+        filters = {"_id": _id, LEASE_OWNER: self.owner}
+        update = {"$unset": {field: "" for field in LEASE_FIELDS}}
+        if set_doc:
+            update["$set"] = set_doc
+        if buffer is not None:
+            buffer.update_one(self.col, filters, update)
+            return None
+        result = self.col.update_one(filters, update)
+        return result.matched_count == 1
+
+    def release_all(self):
+        """Give up all leases held by this owner, without changing status.
+        """
+        return self.col.update_many(
+            {LEASE_OWNER: self.owner},
+            {"$unset": {field: "" for field in LEASE_FIELDS}},
+        ).modified_count
+
+    def reclaim_expired(self):
+        """Remove expired leases of all owners, return number of documents.
+        Not required for correctness, expired documents are claimable anyway.
+        """
+        return self.col.update_many(
+            {LEASE_EXPIRE: {"$lt": datetime.utcnow()}},
+            {"$unset": {field: "" for field in LEASE_FIELDS}},
+        ).modified_count
+
+    def heartbeat(self):
+        """Return a context manager running a background thread, which
+        extends leases every ``heartbeat_interval`` seconds.
+        """
+        return Heartbeat(self)
+
+
+class Heartbeat(object):
+
+    """Background thread extends leases of a :class:`LeaseQueue`.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.queue.heartbeat_interval):
+            try:
+                self.queue.extend()
+            except Exception:  # network glitch, try next time
+                pass
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+#--- Unittest ---
+if __name__ == "__main__":
+    import time
+    import pymongo
+
+    client = pymongo.MongoClient()
+    col = client.get_database("test").get_collection("lease_queue")
+
+    def reset():
+        col.delete_many({})
+        col.insert_many([{"_id": i, "status": 0} for i in range(10)])
+
+    todo = {"status": {"$ne": 3}}
+
+    def test_claim_release():
+        reset()
+        queue = LeaseQueue(col, todo, owner="a")
+        batch = queue.claim(4)
+        assert [doc["_id"] for doc in batch] == [0, 1, 2, 3]
+        assert LEASE_OWNER not in batch[0]
+        assert col.count_documents({LEASE_OWNER: "a"}) == 4
+
+        assert queue.release(0, {"status": 3}) is True
+        # released with not finished status, not claimed again in this pass
+        assert queue.release(1, {"status": 1}) is True
+        doc = col.find_one({"_id": 0})
+        assert doc["status"] == 3 and LEASE_OWNER not in doc
+
+        assert [doc["_id"] for doc in queue.claim(100)] == list(range(4, 10))
+        assert queue.claim(100) == []
+        assert queue.release_all() == 8
+
+    test_claim_release()
+
+    def test_no_double_claim():
+        reset()
+        queue1 = LeaseQueue(col, todo, owner="a")
+        queue2 = LeaseQueue(col, todo, owner="b")
+        ids1 = [doc["_id"] for doc in queue1.claim(6)]
+        ids2 = [doc["_id"] for doc in queue2.claim(100)]
+        assert ids1 == list(range(6))
+        assert ids2 == list(range(6, 10))
+        assert queue2.claim(100) == []
+
+    test_no_double_claim()
+
+    def test_renew_and_expire():
+        reset()
+        crashed = LeaseQueue(col, todo, owner="crashed", lease_seconds=0.2)
+        worker = LeaseQueue(col, todo, owner="worker", lease_seconds=0.2)
+        assert len(crashed.claim(2)) == 2  # 0, 1, then crashes
+        assert [doc["_id"] for doc in worker.claim(8)] == list(range(2, 10))
+
+        time.sleep(0.3)
+        # worker's own leases are renewed, crashed node's are not
+        assert worker.extend() == 8
+        batch = worker.claim(100)
+        assert [doc["_id"] for doc in batch] == [0, 1]
+        assert col.count_documents({LEASE_OWNER: "worker"}) == 10
+        # lease lost, release is refused
+        assert crashed.release(0, {"status": 3}) is False
+        assert worker.claim(100) == []
+
+    test_renew_and_expire()
+
+    col.drop()